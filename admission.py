@@ -0,0 +1,166 @@
+"""
+Control de Admisión
+Límite de conexiones entrantes y tasa de paquetes/bytes por conexión
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Balde de tokens: `rate` por segundo con ráfagas de hasta `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount=1):
+        """
+        Tomar tokens si alcanzan
+
+        Returns:
+            True si se tomaron
+        """
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def borrow(self, amount):
+        """
+        Tomar tokens aunque no alcancen (el saldo queda negativo)
+
+        Returns:
+            Segundos hasta saldar la deuda (0 si alcanzaban)
+        """
+        self._refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class AdmissionControl:
+    """
+    Admisión de tráfico entrante
+
+    Un peer defectuoso o malicioso no debe agotar threads, memoria ni CPU
+    de los demás:
+
+    - Conexiones entrantes simultáneas limitadas: las sobrantes se cierran
+      al aceptarlas, sin thread ni lectura.
+    - Paquetes por segundo por conexión: el exceso se descarta antes de
+      deserializar (un lote, o un HELLO, cuenta como un paquete).
+    - Bytes por segundo por conexión: el exceso no se descarta sino que
+      frena la lectura de la conexión, y TCP y el control de flujo frenan
+      al emisor; una transferencia legítima solo va más lenta.
+
+    Una tasa 0 desactiva ese límite.
+
+    Los baldes son de la conexión (connection_buckets), no de la dirección
+    que el peer anuncia en su HELLO: esa la elige el peer, y con baldes por
+    dirección cualquiera podría agotar los de otro anunciándose con su
+    .onion. Un atacante con varias conexiones tiene a lo sumo max_inbound
+    pares de baldes.
+    """
+
+    def __init__(self, max_inbound=64, packet_rate=500, packet_burst=1000,
+                 byte_rate=8 * 1024 * 1024, byte_burst=16 * 1024 * 1024):
+        """
+        Args:
+            max_inbound: Conexiones entrantes simultáneas
+            packet_rate: Paquetes por segundo por conexión
+            packet_burst: Ráfaga de paquetes tolerada
+            byte_rate: Bytes por segundo por conexión
+            byte_burst: Ráfaga de bytes tolerada
+        """
+        self.max_inbound = max_inbound
+        self.packet_rate = packet_rate
+        self.packet_burst = packet_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+
+        self.inbound = 0
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'rejected_connections': 0,
+            'rejected_packets': 0,
+            'rejected_bytes': 0,
+            'throttled': 0,
+            'throttle_seconds': 0.0,
+        }
+
+    def open_connection(self):
+        """
+        Admitir una conexión entrante
+
+        Returns:
+            True si hay lugar (llamar a close_connection al terminar)
+        """
+        with self.lock:
+            if self.inbound >= self.max_inbound:
+                self.stats['rejected_connections'] += 1
+                return False
+            self.inbound += 1
+            return True
+
+    def close_connection(self):
+        """Liberar el lugar de una conexión admitida"""
+        with self.lock:
+            self.inbound -= 1
+
+    def connection_buckets(self):
+        """
+        Baldes propios de una conexión entrante
+
+        Los guarda la conexión y se liberan con ella.
+
+        Returns:
+            Tupla (paquetes, bytes) para pasar a admit
+        """
+        return (
+            TokenBucket(self.packet_rate, self.packet_burst),
+            TokenBucket(self.byte_rate, self.byte_burst),
+        )
+
+    def admit(self, connection, size):
+        """
+        Admitir un frame recibido por una conexión
+
+        Args:
+            connection: Baldes de la conexión (connection_buckets)
+            size: Bytes del frame
+
+        Returns:
+            Segundos a esperar antes de procesarlo, o None si se descarta
+        """
+        packets, byte_bucket = connection
+        with self.lock:
+            if self.packet_rate and not packets.consume():
+                self.stats['rejected_packets'] += 1
+                self.stats['rejected_bytes'] += size
+                return None
+
+            if not self.byte_rate:
+                return 0.0
+
+            delay = byte_bucket.borrow(size)
+            if delay:
+                self.stats['throttled'] += 1
+                self.stats['throttle_seconds'] += delay
+            return delay
+
+    def get_stats(self):
+        """Conexiones activas y rechazos por causa"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['throttle_seconds'] = round(stats['throttle_seconds'], 3)
+            stats['inbound_connections'] = self.inbound
+            return stats
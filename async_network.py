@@ -0,0 +1,560 @@
+"""
+Motor asyncio para la Red P2P
+Un único event loop para aceptar, leer y escribir conexiones
+"""
+
+import asyncio
+import threading
+import time
+
+from config import NETWORK_CONFIG
+from p2p_network import P2PNetwork
+from stream_mux import ReceiveWindows, SendWindows
+from wire_protocol import FRAME_HELLO, HEADER_SIZE, FrameError, decode_header
+
+
+class _PeerLink:
+    """Estado de la conexión saliente hacia un peer"""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.wakeup = asyncio.Event()
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.busy = False  # Lote tomado de la cola y aún sin enviar
+        self.last_used = time.time()
+
+        # Control de flujo de la conexión actual y tarea que lee los
+        # frames de control que devuelve el peer
+        self.windows = None
+        self.control_task = None
+
+    def is_open(self):
+        """La conexión existe y el peer no la ha cerrado"""
+        return (
+            self.writer is not None
+            and not self.writer.is_closing()
+            and not self.reader.at_eof()
+        )
+
+    def close(self):
+        """Cerrar la conexión (la tarea puede reabrirla)"""
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class AsyncP2PNetwork(P2PNetwork):
+    """
+    Red P2P sobre asyncio
+
+    Misma API pública que P2PNetwork (start, stop, send_text,
+    get_incoming_message...), pero todo el tráfico corre en un solo thread
+    con un event loop: el número de threads no crece con las conexiones.
+    El procesamiento de cada frame recibido (decodificación y handlers)
+    va al executor por defecto del loop.
+    """
+
+    def __init__(self, tor_manager, crypto_manager, outbox_dir=None):
+        super().__init__(tor_manager, crypto_manager, outbox_dir)
+
+        self.loop = None
+        self.loop_thread = None
+        self.server = None
+        self.outbox_task = None
+
+        self._links = {}
+        self._inbound = {}  # writer -> tarea lectora de cada conexión entrante
+        self._mid_frame = set()  # Conexiones entrantes leyendo un frame
+        self._loop_ready = threading.Event()
+
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'stale_closed': 0,
+            'overflow': 0,
+        }
+
+    def start(self):
+        """Iniciar red P2P en su event loop"""
+        if self.is_running:
+            return
+
+        self.is_running = True
+        self.accepting = True
+        self._loop_ready.clear()
+
+        # Las colas por peer avisan al event loop en vez de a los senders
+        self.scheduler.on_ready = self._notify_ready
+
+        self.loop_thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.loop_thread.start()
+        self._loop_ready.wait()
+
+        print("Red P2P iniciada (asyncio)")
+
+    def stop(self, drain_timeout=None):
+        """
+        Detener red P2P ordenadamente (ver P2PNetwork.stop)
+
+        Args:
+            drain_timeout: Segundos máximos de drenado
+        """
+        if not self.is_running:
+            return
+
+        if drain_timeout is None:
+            drain_timeout = NETWORK_CONFIG['drain_timeout']
+
+        # Frames esperando firma: a la cola antes de drenar
+        if self.media_signer is not None:
+            self.media_signer.flush()
+
+        if self.loop:
+            future = asyncio.run_coroutine_threadsafe(
+                self._shutdown(drain_timeout), self.loop
+            )
+            try:
+                future.result(timeout=drain_timeout + 5)
+            except Exception as e:
+                print(f"Error deteniendo event loop: {e}")
+
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join(timeout=5)
+
+        self.is_running = False
+        self._requeue_pending()
+        self._close_crypto_workers()
+        print("Red P2P detenida")
+
+    def _notify_ready(self, recipient_onion):
+        """Despertar la tarea de escritura del peer (desde cualquier thread)"""
+        if self.loop and self.is_running:
+            self.loop.call_soon_threadsafe(self._wake_peer, recipient_onion)
+
+    def _run_loop(self):
+        """Thread del event loop"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_until_complete(self._start_server())
+        except Exception as e:
+            print(f"Error en listener: {e}")
+            self.is_running = False
+
+        self._loop_ready.set()
+
+        if self.is_running:
+            self.loop.run_forever()
+
+        # Esperar a los handlers y reintentos del outbox en curso
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+
+    async def _start_server(self):
+        """Abrir listener en el puerto del servicio oculto"""
+        self.server = await asyncio.start_server(
+            self._handle_client,
+            '127.0.0.1',
+            self.tor_manager.hidden_service_port,
+            reuse_address=True
+        )
+        print(f"Escuchando en puerto {self.tor_manager.hidden_service_port}")
+
+        self.outbox_task = self.loop.create_task(self._outbox_timer())
+        self._reconnect_recent()
+
+    def _reconnect_recent(self):
+        """Reabrir las conexiones activas antes del stop"""
+        peers, self._recent_peers = self._recent_peers, []
+
+        for onion in peers:
+            if onion in self._links:
+                continue
+            link = _PeerLink(self.scheduler.get_peer(onion))
+            self._links[onion] = link
+            link.task = self.loop.create_task(self._prewarm(onion, link))
+
+    async def _prewarm(self, recipient_onion, link):
+        """
+        Conectar antes de tener algo que enviar y seguir como la tarea de
+        escritura del peer
+        """
+        self._stats['misses'] += 1
+        if not await self._open(recipient_onion, link):
+            link.close()
+        await self._peer_writer(recipient_onion, link)
+
+    async def _outbox_timer(self):
+        """Reintentos del outbox (la lectura de disco va a un executor)"""
+        while self.is_running:
+            try:
+                await self.loop.run_in_executor(None, self._flush_outbox)
+            except Exception as e:
+                print(f"Error en outbox: {e}")
+
+            await asyncio.sleep(1.0)
+
+    async def _shutdown(self, drain_timeout):
+        """Drenar y cerrar listener, conexiones y tareas pendientes"""
+        deadline = self.loop.time() + drain_timeout
+
+        # No aceptar más conexiones
+        self.accepting = False
+        if self.server:
+            self.server.close()
+
+        # Enviar lo encolado y terminar los frames entrantes en curso
+        while self.loop.time() < deadline and (
+                self.scheduler.qsize()
+                or any(link.busy for link in self._links.values())
+                or self._mid_frame):
+            await asyncio.sleep(0.01)
+
+        self._recent_peers = list(self.connections)
+        self.is_running = False
+
+        tasks = []
+        if self.outbox_task:
+            self.outbox_task.cancel()
+            tasks.append(self.outbox_task)
+
+        for link in self._links.values():
+            link.close()
+            for task in (link.task, link.control_task):
+                if task:
+                    task.cancel()
+                    tasks.append(task)
+
+        # Cancelar también los lectores frenados por la tasa de bytes
+        for writer, task in list(self._inbound.items()):
+            writer.close()
+            task.cancel()
+            tasks.append(task)
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # wait_closed espera a las conexiones aceptadas (ya cerradas)
+        if self.server:
+            await self.server.wait_closed()
+
+        self._links.clear()
+        self._inbound.clear()
+        self._mid_frame.clear()
+        self.connections.clear()
+
+    async def _handle_client(self, reader, writer):
+        """Leer frames de una conexión entrante"""
+        # Sin lugar (o deteniendo): cerrar sin leer nada
+        if not self.accepting or not self.admission.open_connection():
+            writer.close()
+            return
+
+        self._inbound[writer] = asyncio.current_task()
+        idle_timeout = NETWORK_CONFIG['pool_idle_timeout']
+        max_frame_size = NETWORK_CONFIG['max_frame_size']
+        receive_windows = ReceiveWindows(NETWORK_CONFIG['stream_window'])
+
+        try:
+            while self.is_running:
+                header = await asyncio.wait_for(
+                    reader.readexactly(HEADER_SIZE), idle_timeout
+                )
+                self._mid_frame.add(writer)
+                frame_type, flags, length = decode_header(header)
+
+                if length > max_frame_size:
+                    raise FrameError(f"Frame demasiado grande: {length} bytes")
+
+                # Vista del payload: separar el stream y decodificar los
+                # campos binarios no vuelve a copiar el frame
+                payload = memoryview(await reader.readexactly(length))
+
+                # Conexión por encima de su tasa de bytes: dejar de leer
+                # la conexión frena al emisor
+                delay = self._admit(frame_type, payload, receive_windows)
+                if delay:
+                    await asyncio.sleep(delay)
+
+                # Descompresión, decodificación y handlers (descifrado,
+                # escritura de chunks a disco) van al executor: el event
+                # loop sigue atendiendo las demás conexiones. La conexión
+                # espera a su frame, así se conserva el orden
+                if frame_type == FRAME_HELLO:
+                    reply = self._receive_frame(
+                        frame_type, flags, payload, receive_windows,
+                        delay is not None
+                    )
+                else:
+                    reply = await self.loop.run_in_executor(
+                        None, self._receive_frame, frame_type, flags, payload,
+                        receive_windows, delay is not None
+                    )
+                if reply:
+                    writer.write(reply)
+                self._mid_frame.discard(writer)
+
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Red detenida: terminar sin propagar (start_server consulta
+            # la excepción de la tarea y fallaría con una cancelada)
+            pass
+        except FrameError as e:
+            print(f"Frame inválido, cerrando conexión: {e}")
+            self.monitor.record_error('frame_invalid')
+        except Exception as e:
+            print(f"Error manejando conexión entrante: {e}")
+        finally:
+            self._inbound.pop(writer, None)
+            self._mid_frame.discard(writer)
+            writer.close()
+            self.admission.close_connection()
+
+    def _wake_peer(self, recipient_onion):
+        """Asegurar que el peer tenga una tarea de escritura activa"""
+        link = self._links.get(recipient_onion)
+
+        if link is None:
+            link = _PeerLink(self.scheduler.get_peer(recipient_onion))
+            self._links[recipient_onion] = link
+
+        if link.task is None or link.task.done():
+            link.task = self.loop.create_task(
+                self._peer_writer(recipient_onion, link)
+            )
+
+        link.wakeup.set()
+
+    async def _peer_writer(self, recipient_onion, link):
+        """Escribir en orden los paquetes de un peer por una conexión"""
+        idle_timeout = NETWORK_CONFIG['pool_idle_timeout']
+
+        try:
+            while self.is_running:
+                link.busy = True
+                batch = await self._collect_batch_async(link)
+
+                if not batch:
+                    link.busy = False
+                    if not await self._wait_wakeup(link, idle_timeout):
+                        break
+                    continue
+
+                success = await self._write(recipient_onion, link, batch)
+                self._batch_sent(link.peer, batch, success)
+                link.busy = False
+
+        finally:
+            link.busy = False
+            if link.writer is not None:
+                link.close()
+                self._stats['stale_closed'] += 1
+
+            self.connections.pop(recipient_onion, None)
+
+            if not link.peer.pending and self._links.get(recipient_onion) is link:
+                del self._links[recipient_onion]
+
+    async def _collect_batch_async(self, link):
+        """
+        Versión asyncio de _collect_batch: agrupa paquetes del mismo peer
+        esperando hasta coalesce_linger_ms sin bloquear el loop
+
+        Returns:
+            Lista de tuplas devuelta por _batch_item
+        """
+        item = self.scheduler.pop(link.peer)
+        if item is None:
+            return []
+
+        priority = item[3]
+        max_packets = NETWORK_CONFIG['coalesce_max_packets']
+        max_bytes = self._batch_budget(link.windows, priority)
+        deadline = self.loop.time() + NETWORK_CONFIG['coalesce_linger_ms'] / 1000
+
+        batch = [self._batch_item(item)]
+        size = len(batch[0][1])
+
+        while len(batch) < max_packets and size < max_bytes:
+            item = self.scheduler.pop(link.peer, priority=priority)
+
+            if item is None:
+                if not await self._wait_wakeup(link, deadline - self.loop.time()):
+                    break
+                continue
+
+            batch.append(self._batch_item(item))
+            size += len(batch[-1][1])
+
+        return batch
+
+    async def _wait_wakeup(self, link, timeout):
+        """
+        Esperar a que lleguen paquetes para el peer
+
+        Returns:
+            False si venció el timeout
+        """
+        if timeout <= 0:
+            return False
+
+        link.wakeup.clear()
+        try:
+            await asyncio.wait_for(link.wakeup.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _write(self, recipient_onion, link, batch):
+        """
+        Enviar un lote, reabriendo la conexión si el peer la cerró
+
+        Returns:
+            True si se envió
+        """
+        for attempt in range(2):
+            reused = link.is_open()
+
+            if reused:
+                self._stats['hits'] += 1
+            else:
+                if link.writer is not None:
+                    link.close()
+                    self._stats['stale_closed'] += 1
+
+                self._stats['misses'] += 1
+                started = time.perf_counter()
+                connected = await self._open(recipient_onion, link)
+                self.monitor.record_connection_attempt(
+                    connected, time.perf_counter() - started
+                )
+                if not connected:
+                    print(f"No se pudo conectar a {recipient_onion}")
+                    return False
+
+            data, stream_id = self._encode_for(link.windows, batch)
+
+            # Con asyncio el envío incluye la espera de drain (backpressure)
+            started = time.perf_counter()
+            try:
+                link.writer.write(data)
+                await link.writer.drain()
+            except (ConnectionError, OSError) as e:
+                link.close()
+                self.connections.pop(recipient_onion, None)
+                if reused and attempt == 0:
+                    self.monitor.record_error('stale_connection')
+                    continue
+                print(f"Error enviando paquete: {e}")
+                self.monitor.record_error('send_failed')
+                return False
+
+            self.monitor.observe('send', time.perf_counter() - started)
+            self._consume_window(recipient_onion, link.windows, batch, stream_id, len(data))
+            link.last_used = time.time()
+            print(f"Paquete enviado a {recipient_onion}")
+            return True
+
+        return False
+
+    async def _open(self, recipient_onion, link):
+        """Abrir conexión SOCKS asíncrona respetando el máximo del pool"""
+        self._make_room()
+
+        result = await self.tor_manager.connect_to_onion_async(
+            recipient_onion,
+            80,
+            timeout=NETWORK_CONFIG['connection_timeout']
+        )
+        if not result:
+            return False
+
+        link.reader, link.writer = result
+        self.connections[recipient_onion] = link.writer
+
+        # Saludo: el peer responde con su ventana si soporta streams
+        link.windows = SendWindows(NETWORK_CONFIG['stream_window'])
+        link.writer.write(self._encode_hello())
+        self.scheduler.unblock(recipient_onion)
+
+        link.control_task = self.loop.create_task(
+            self._read_control(recipient_onion, link, link.reader, link.windows)
+        )
+        return True
+
+    async def _read_control(self, recipient_onion, link, reader, windows):
+        """Leer HELLO y WINDOW_UPDATE que el peer devuelve por la conexión"""
+        hello_timeout = NETWORK_CONFIG['connection_timeout']
+
+        try:
+            while self.is_running:
+                # Solo la respuesta al HELLO tiene plazo
+                timeout = hello_timeout if windows.state == windows.PENDING else None
+
+                try:
+                    header = await asyncio.wait_for(
+                        reader.readexactly(HEADER_SIZE), timeout
+                    )
+                except asyncio.TimeoutError:
+                    # Peer de una versión anterior: sin control de flujo
+                    windows.fallback()
+                    self.scheduler.unblock(recipient_onion)
+                    continue
+
+                frame_type, flags, length = decode_header(header)
+                if length > NETWORK_CONFIG['max_frame_size']:
+                    raise FrameError(f"Frame demasiado grande: {length} bytes")
+
+                payload = await reader.readexactly(length)
+                self._on_control_frame(recipient_onion, windows, frame_type, payload)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except FrameError as e:
+            print(f"Frame inválido de {recipient_onion}: {e}")
+            link.close()
+        finally:
+            # Si no la reemplazó otra conexión, no dejar clases frenadas
+            # esperando crédito que ya no llegará
+            if link.windows is windows:
+                self.scheduler.unblock(recipient_onion)
+
+    def _send_windows(self, recipient_onion):
+        """Control de flujo de la conexión actual hacia el peer (o None)"""
+        link = self._links.get(recipient_onion)
+        return link.windows if link is not None else None
+
+    def _make_room(self):
+        """Cerrar la conexión inactiva más antigua si se alcanzó el máximo"""
+        open_links = [
+            (link.last_used, onion, link)
+            for onion, link in self._links.items()
+            if link.is_open()
+        ]
+
+        if len(open_links) < NETWORK_CONFIG['pool_max_connections']:
+            return
+
+        for _, onion, link in sorted(open_links, key=lambda item: item[0]):
+            if not link.peer.pending:
+                link.close()
+                self.connections.pop(onion, None)
+                self._stats['evictions'] += 1
+                return
+
+        self._stats['overflow'] += 1
+
+    def _pool_stats(self):
+        """Estadísticas de reutilización de conexiones"""
+        stats = dict(self._stats)
+        stats['open_connections'] = len(self.connections)
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
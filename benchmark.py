@@ -0,0 +1,788 @@
+"""
+Benchmarks de la Red P2P
+Throughput, latencia, bytes en el cable y CPU por mensaje sobre Tor simulado
+
+Uso:
+    python benchmark.py                          # Todos los escenarios
+    python benchmark.py --scenario chat group    # Solo algunos
+    python benchmark.py --latency-ms 100 --bandwidth 500000
+    python benchmark.py --output actual.json --compare base.json
+    python benchmark.py --scenario crypto        # MB/s de cada backend de cifrado
+    python benchmark.py --scenario verify        # Firmas ECDSA verificadas por segundo
+"""
+
+import argparse
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+from ecdsa import VerifyingKey, SECP256k1
+
+from config import APP_VERSION, NETWORK_CONFIG
+from crypto_backend import BACKENDS, StreamCipher
+from crypto_manager import CryptoManager
+from merkle_auth import leaf_hash, merkle_proof, sign_root
+from mock_tor import MockTorManager, MockTorNetwork
+from p2p_network import create_p2p_network
+from packet_codec import encode_packet, now_ms
+from wire_protocol import FRAME_BINARY, encode_frame
+
+# Métricas donde un valor más alto es mejor (el resto: más bajo es mejor)
+HIGHER_IS_BETTER = (
+    'messages_per_sec', 'deliveries_per_sec', 'mb_per_sec', 'decrypt_mb_per_sec',
+    'verifications_per_sec', 'stream_mb_per_sec',
+)
+
+# Métricas comparadas con --compare
+COMPARED_METRICS = (
+    'messages_per_sec', 'deliveries_per_sec', 'mb_per_sec',
+    'latency_p50_ms', 'latency_p95_ms', 'latency_p99_ms',
+    'bytes_per_message', 'wire_overhead', 'cpu_us_per_message',
+    'alloc_peak_kb_per_mb', 'decrypt_mb_per_sec', 'verifications_per_sec',
+    'stream_mb_per_sec',
+)
+
+# Tamaños de payload del escenario crypto: texto, paquete, chunk de archivo
+CRYPTO_SIZES = (64, 1024, 64 * 1024)
+
+
+class BenchCrypto(CryptoManager):
+    """
+    CryptoManager con la identidad del peer
+
+    Los gestores piden la dirección propia con load_identity(), que en la
+    app resuelve el perfil; todo lo demás (mensajes, streams, firmas) es
+    la API de CryptoManager con la sesión real de cada par de peers.
+    """
+
+    def __init__(self, onion_address):
+        super().__init__()
+        self.onion_address = onion_address
+        self.generate_keypair()
+
+    def load_identity(self):
+        """Identidad del peer"""
+        return {'onion_address': self.onion_address}
+
+
+class BenchPeer:
+    """Peer completo (Tor simulado + red P2P) con directorio propio"""
+
+    def __init__(self, network, work_dir, index):
+        self.dir = Path(work_dir) / f'peer{index}'
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+        self.tor = MockTorManager(network)
+        self.onion = self.tor.start_hidden_service()
+        self.crypto = BenchCrypto(self.onion)
+        self.p2p = create_p2p_network(self.tor, self.crypto, self.dir / 'outbox')
+
+    def data_dir(self, name):
+        """Directorio de datos de un gestor (cada peer simula un equipo)"""
+        path = self.dir / name
+        path.mkdir(exist_ok=True)
+        return path
+
+    def start(self):
+        self.p2p.start()
+
+    def stop(self):
+        self.p2p.stop()
+        self.tor.stop()
+
+
+class Recorder:
+    """Marcas de envío y recepción para calcular latencias"""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.sent = {}
+        self.received = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def mark_sent(self, key):
+        self.sent[key] = time.perf_counter()
+
+    def mark_received(self, key):
+        now = time.perf_counter()
+        with self.lock:
+            if key not in self.sent:
+                return  # Calentamiento u otro tráfico
+            self.received.setdefault(key, now)
+            if len(self.received) >= self.expected:
+                self.done.set()
+
+    def latencies_ms(self):
+        """Latencias de extremo a extremo de lo recibido"""
+        return [
+            (self.received[key] - self.sent[key]) * 1000
+            for key in self.received
+            if key in self.sent
+        ]
+
+
+class Measurement:
+    """CPU, tiempo y bytes en el cable de un escenario"""
+
+    def __init__(self, network):
+        self.network = network
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.bytes = self.network.get_stats()['bytes_relayed']
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+        self.bytes = self.network.get_stats()['bytes_relayed'] - self.bytes
+
+
+def percentile(values, fraction):
+    """Percentil por rango más cercano"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return round(ordered[index], 2)
+
+
+def latency_summary(latencies):
+    """p50/p95/p99 y máximo en milisegundos"""
+    return {
+        'latency_p50_ms': percentile(latencies, 0.50),
+        'latency_p95_ms': percentile(latencies, 0.95),
+        'latency_p99_ms': percentile(latencies, 0.99),
+        'latency_max_ms': round(max(latencies), 2) if latencies else None,
+    }
+
+
+def start_peers(network, work_dir, count):
+    """Crear e iniciar peers que ya se conocen (claves fijadas)"""
+    peers = [BenchPeer(network, work_dir, index) for index in range(count)]
+    for peer in peers:
+        for other in peers:
+            if other is not peer:
+                peer.p2p.peer_keys[other.onion] = other.crypto.export_public_key()
+        peer.start()
+    return peers
+
+
+def open_session(sender, receiver, timeout=10):
+    """Negociar la sesión ECDH antes de medir (archivos y media la necesitan)"""
+    deadline = time.time() + timeout
+    while sender.p2p.session_manager.stream_secret(receiver.onion) is None:
+        if time.time() > deadline:
+            raise RuntimeError(f"Sin sesión con {receiver.onion}")
+        time.sleep(0.05)
+
+
+def stop_peers(peers):
+    for peer in peers:
+        peer.stop()
+
+
+def bench_chat(network, work_dir, count=1000, size=200, rate=None, timeout=60):
+    """
+    Chat 1:1: `count` mensajes cifrados de A a B
+
+    Args:
+        rate: Mensajes por segundo (None = ráfaga, mide throughput)
+    """
+    sender, receiver = start_peers(network, work_dir, 2)
+    recorder = Recorder(count)
+
+    def on_event(event):
+        if event.get('type') == 'chat_message':
+            recorder.mark_received(event['text'].split(':', 1)[0])
+
+    receiver.p2p.subscribe(on_event)
+    padding = 'x' * max(0, size - 8)
+
+    # Calentamiento: abrir la conexión antes de medir
+    sender.p2p.send_text(receiver.onion, 'warmup:')
+    time.sleep(0.5)
+
+    with Measurement(network) as measurement:
+        for index in range(count):
+            key = str(index)
+            recorder.mark_sent(key)
+            sender.p2p.send_text(receiver.onion, f'{key}:{padding}')
+
+            if rate:
+                time.sleep(1.0 / rate)
+
+        recorder.done.wait(timeout)
+
+    stop_peers([sender, receiver])
+
+    delivered = len(recorder.received)
+    result = {
+        'messages': count,
+        'delivered': delivered,
+        'message_size': size,
+        'messages_per_sec': round(delivered / measurement.wall, 1),
+        'bytes_per_message': round(measurement.bytes / max(1, delivered), 1),
+        'cpu_us_per_message': round(measurement.cpu / max(1, delivered) * 1e6, 1),
+    }
+    result.update(latency_summary(recorder.latencies_ms()))
+    return result
+
+
+def bench_group(network, work_dir, members, broadcasts=20, size=200, timeout=120):
+    """Fan-out de GroupManager.send_group_message a `members` miembros"""
+    from group_manager import GroupManager
+
+    peers = start_peers(network, work_dir, members + 1)
+    sender, receivers = peers[0], peers[1:]
+
+    sender_groups = GroupManager(sender.crypto, sender.p2p)
+    sender_groups.data_dir = sender.data_dir('groups')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        group_id = sender_groups.create_group(
+            'benchmark', [peer.onion for peer in receivers]
+        )
+    group = sender_groups.get_group(group_id)
+
+    recorder = Recorder(members * broadcasts)
+
+    for index, peer in enumerate(receivers):
+        manager = GroupManager(peer.crypto, peer.p2p)
+        manager.data_dir = peer.data_dir('groups')
+        manager.groups = {group_id: dict(group)}
+
+        def on_event(event, index=index):
+            if event.get('type') == 'group_message':
+                key = event['text'].split(':', 1)[0]
+                recorder.mark_received((key, index))
+
+        peer.p2p.subscribe(on_event)
+
+    # Dejar que lleguen las invitaciones y se abran las conexiones
+    time.sleep(1.0 + members * 0.01)
+
+    padding = 'x' * max(0, size - 8)
+    fanout_ms = []
+
+    with Measurement(network) as measurement:
+        for broadcast in range(broadcasts):
+            key = str(broadcast)
+            started = time.perf_counter()
+            for index in range(members):
+                recorder.sent[(key, index)] = started
+
+            sender_groups.send_group_message(group_id, f'{key}:{padding}')
+
+        recorder.done.wait(timeout)
+
+    for broadcast in range(broadcasts):
+        key = str(broadcast)
+        times = [
+            recorder.received[(key, index)]
+            for index in range(members)
+            if (key, index) in recorder.received
+        ]
+        if len(times) == members:
+            fanout_ms.append((max(times) - recorder.sent[(key, 0)]) * 1000)
+
+    stop_peers(peers)
+
+    delivered = len(recorder.received)
+    result = {
+        'members': members,
+        'broadcasts': broadcasts,
+        'delivered': delivered,
+        'expected': members * broadcasts,
+        'messages_per_sec': round(broadcasts / measurement.wall, 1),
+        'deliveries_per_sec': round(delivered / measurement.wall, 1),
+        'bytes_per_message': round(measurement.bytes / max(1, delivered), 1),
+        'cpu_us_per_message': round(measurement.cpu / max(1, delivered) * 1e6, 1),
+        'fanout_complete_p50_ms': percentile(fanout_ms, 0.50),
+        'fanout_complete_p95_ms': percentile(fanout_ms, 0.95),
+    }
+    result.update(latency_summary(recorder.latencies_ms()))
+    return result
+
+
+def bench_file(network, work_dir, file_size, repeats=3, timeout=300):
+    """FileTransferManager.send_file de un archivo de `file_size` bytes"""
+    from file_transfer import FileTransferManager
+
+    sender, receiver = start_peers(network, work_dir, 2)
+
+    sender_files = FileTransferManager(sender.crypto, sender.p2p)
+    sender_files.data_dir = sender.data_dir('file_transfers')
+    receiver_files = FileTransferManager(receiver.crypto, receiver.p2p)
+    receiver_files.data_dir = receiver.data_dir('file_transfers')
+
+    recorder = Recorder(repeats)
+    verified = []
+
+    def on_event(event):
+        # Un checksum inválido también termina la transferencia
+        if event.get('type') in ('file_received', 'file_failed'):
+            recorder.mark_received(event['filename'])
+            if event['type'] == 'file_received':
+                verified.append(event['filename'])
+
+    receiver.p2p.subscribe(on_event)
+
+    paths = []
+    for repeat in range(repeats):
+        path = sender.dir / f'bench_{file_size}_{repeat}.bin'
+        path.write_bytes(os.urandom(file_size))
+        paths.append(path)
+
+    # Calentamiento: conexión y sesión abiertas antes de medir
+    sender.p2p.send_text(receiver.onion, 'warmup:')
+    open_session(sender, receiver)
+    time.sleep(0.5)
+
+    with Measurement(network) as measurement:
+        for path in paths:
+            recorder.mark_sent(path.name)
+            sender_files.send_file(path, receiver.onion)
+
+        recorder.done.wait(timeout)
+
+    stop_peers([sender, receiver])
+
+    delivered = len(recorder.received)
+    total_bytes = file_size * delivered
+    result = {
+        'file_size': file_size,
+        'files': repeats,
+        'delivered': delivered,
+        'checksum_ok': len(verified),
+        'mb_per_sec': round(total_bytes / measurement.wall / 1e6, 2),
+        'wire_overhead': round(measurement.bytes / max(1, total_bytes), 3),
+        'cpu_us_per_message': round(measurement.cpu / max(1, delivered) * 1e6, 1),
+        'cpu_ms_per_mb': round(measurement.cpu * 1000 / max(1, total_bytes / 1e6), 1),
+    }
+    result.update(latency_summary(recorder.latencies_ms()))
+    return result
+
+
+def bench_mixed(network, work_dir, file_size, count=50, rate=10, timeout=300):
+    """
+    Chat durante una transferencia de archivo al mismo peer
+
+    Mide la latencia del chat mientras los chunks ocupan la conexión:
+    un archivo grande no debe retrasar los mensajes interactivos.
+    """
+    from file_transfer import FileTransferManager
+
+    sender, receiver = start_peers(network, work_dir, 2)
+
+    sender_files = FileTransferManager(sender.crypto, sender.p2p)
+    sender_files.data_dir = sender.data_dir('file_transfers')
+    receiver_files = FileTransferManager(receiver.crypto, receiver.p2p)
+    receiver_files.data_dir = receiver.data_dir('file_transfers')
+
+    recorder = Recorder(count)
+    file_done = threading.Event()
+
+    def on_event(event):
+        if event.get('type') == 'chat_message':
+            recorder.mark_received(event['text'].split(':', 1)[0])
+        elif event.get('type') in ('file_received', 'file_failed'):
+            file_done.set()
+
+    receiver.p2p.subscribe(on_event)
+
+    path = sender.dir / f'mixed_{file_size}.bin'
+    path.write_bytes(os.urandom(file_size))
+
+    sender.p2p.send_text(receiver.onion, 'warmup:')
+    open_session(sender, receiver)
+    time.sleep(0.5)
+
+    with Measurement(network) as measurement:
+        transfer = threading.Thread(
+            target=sender_files.send_file, args=(path, receiver.onion), daemon=True
+        )
+        transfer.start()
+        time.sleep(0.2)  # Que los chunks ya estén en la conexión
+
+        for index in range(count):
+            key = str(index)
+            recorder.mark_sent(key)
+            sender.p2p.send_text(receiver.onion, f'{key}:')
+            time.sleep(1.0 / rate)
+
+        recorder.done.wait(timeout)
+        file_done.wait(timeout)
+
+    stop_peers([sender, receiver])
+
+    result = {
+        'file_size': file_size,
+        'messages': count,
+        'delivered': len(recorder.received),
+        'file_done': file_done.is_set(),
+        'transfer_sec': round(measurement.wall, 2),
+    }
+    result.update(latency_summary(recorder.latencies_ms()))
+    return result
+
+
+def bench_receive(network, work_dir, file_size, timeout=120):
+    """
+    Camino de recepción aislado: memoria asignada por MB recibido
+
+    Los frames de un archivo se codifican antes de medir y se escriben
+    directo al puerto del receptor (sin relay ni emisor en el proceso),
+    de modo que tracemalloc solo ve lo que asigna la recepción: lectura
+    de frames, decodificación, handlers y escritura a disco.
+    """
+    from file_transfer import FileTransferManager
+
+    receiver, = start_peers(network, work_dir, 1)
+    receiver_files = FileTransferManager(receiver.crypto, receiver.p2p)
+    receiver_files.data_dir = receiver.data_dir('file_transfers')
+    chunk_size = receiver_files.chunk_size
+
+    done = threading.Event()
+    outcome = {}
+
+    def on_event(event):
+        if event.get('type') in ('file_received', 'file_failed'):
+            outcome['type'] = event['type']
+            done.set()
+
+    receiver.p2p.subscribe(on_event)
+
+    data = os.urandom(file_size)
+    total_chunks = (file_size + chunk_size - 1) // chunk_size
+    transfer_id = os.urandom(8).hex()
+
+    # Emisor conocido: la transferencia va firmada como la de send_file
+    sender = BenchCrypto('bench')
+    receiver.p2p.peer_keys['bench'] = sender.export_public_key()
+    levels, header = sign_root(sender, [
+        leaf_hash(data[index * chunk_size:(index + 1) * chunk_size])
+        for index in range(total_chunks)
+    ], transfer_id)
+
+    metadata = {
+        'transfer_id': transfer_id, 'filename': 'receive.bin',
+        'file_size': file_size, 'total_chunks': total_chunks,
+        'chunk_size': chunk_size,
+        'checksum': hashlib.sha256(data).hexdigest(),
+        'merkle': header,
+    }
+    frames = [encode_frame(FRAME_BINARY, encode_packet({
+        'type': 'file_metadata', 'from': 'bench', 'timestamp': now_ms(),
+        'metadata': metadata,
+    }))]
+    for index in range(total_chunks):
+        frames.append(encode_frame(FRAME_BINARY, encode_packet({
+            'type': 'file_chunk', 'from': 'bench', 'timestamp': now_ms(),
+            'transfer_id': transfer_id, 'chunk_index': index,
+            'total_chunks': total_chunks,
+            'data': data[index * chunk_size:(index + 1) * chunk_size],
+            'proof': merkle_proof(levels, index),
+        })))
+    stream = b''.join(frames)
+    del frames, data
+
+    sock = socket.create_connection(('127.0.0.1', receiver.tor.hidden_service_port))
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+
+    sock.sendall(stream)
+    done.wait(timeout)
+
+    wall = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    sock.close()
+    stop_peers([receiver])
+
+    megabytes = file_size / 1e6
+    return {
+        'file_size': file_size,
+        'file_ok': outcome.get('type') == 'file_received',
+        'receive_sec': round(wall, 3),
+        'alloc_peak_kb': round(peak / 1024, 1),
+        'alloc_peak_kb_per_mb': round(peak / 1024 / megabytes, 1),
+    }
+
+
+def bench_crypto(backend, size, budget=0.3):
+    """
+    Microbenchmark de un backend de cifrado (sin red)
+
+    Args:
+        backend: Backend de crypto_backend
+        size: Bytes del payload
+        budget: Segundos de medición por operación
+    """
+    prepared = backend.prepare(os.urandom(32))
+    payload = os.urandom(size)
+    encrypted = backend.encrypt(prepared, payload)
+
+    def throughput(operation, data):
+        count = 0
+        started = time.perf_counter()
+        while True:
+            operation(prepared, data)
+            count += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= budget:
+                return count * size / elapsed / 1e6, elapsed / count
+
+    encrypt_mb, encrypt_sec = throughput(backend.encrypt, payload)
+    decrypt_mb, _ = throughput(backend.decrypt, encrypted)
+
+    # API de streams: nonce por índice y salida preasignada
+    stream = StreamCipher(backend, prepared, os.urandom(8))
+    out = bytearray(size + stream.overhead)
+    counter = iter(range(1 << 62))
+    stream_mb, _ = throughput(
+        lambda _, data: stream.encrypt(next(counter), data, out), payload
+    )
+
+    return {
+        'backend': backend.name,
+        'payload_size': size,
+        'mb_per_sec': round(encrypt_mb, 2),
+        'decrypt_mb_per_sec': round(decrypt_mb, 2),
+        'stream_mb_per_sec': round(stream_mb, 2),
+        'encrypt_us': round(encrypt_sec * 1e6, 1),
+        'overhead_bytes': len(encrypted) - size,
+    }
+
+
+def bench_verify(mode, members=10, count=400):
+    """
+    Firmas verificadas por segundo (sin red)
+    
+    Simula los mensajes firmados de un grupo: `count` firmas repartidas
+    entre `members` claves.
+    
+    Args:
+        mode: 'uncached' (interpretar la clave en cada firma, como antes
+            de la caché), 'cached' (verify_signature) o 'batch' (verify_many)
+    """
+    signers = [CryptoManager() for _ in range(members)]
+    items = []
+    for index in range(count):
+        signer = signers[index % members]
+        if signer.private_key is None:
+            signer.generate_keypair()
+        message = f'mensaje {index}'
+        items.append((message, signer.sign_message(message), signer.get_public_key_hex()))
+    
+    verifier = CryptoManager()
+    
+    def uncached(message, signature, key):
+        try:
+            vk = VerifyingKey.from_string(bytes.fromhex(key), curve=SECP256k1)
+            return vk.verify(
+                base64.b64decode(signature),
+                hashlib.sha256(message.encode()).digest()
+            )
+        except Exception:
+            return False
+    
+    started = time.perf_counter()
+    if mode == 'batch':
+        valid = verifier.verify_many(items)
+    elif mode == 'cached':
+        valid = [verifier.verify_signature(*item) for item in items]
+    else:
+        valid = [uncached(*item) for item in items]
+    elapsed = time.perf_counter() - started
+    
+    return {
+        'mode': mode,
+        'members': members,
+        'signatures': count,
+        'all_valid': all(valid),
+        'verifications_per_sec': round(count / elapsed, 1),
+        'workers': verifier.verify_workers if mode == 'batch' else 1,
+    }
+
+
+def run_scenarios(args, work_dir):
+    """Ejecutar los escenarios seleccionados (cada uno en una red nueva)"""
+    results = {}
+
+    def network():
+        return MockTorNetwork(
+            latency_ms=args.latency_ms,
+            bandwidth=args.bandwidth,
+            loss=args.loss,
+            seed=args.seed
+        )
+
+    def run(name, function, *function_args, **kwargs):
+        print(f"▶ {name}...", file=sys.stderr)
+        scenario_dir = Path(work_dir) / name
+        net = network()
+        net.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name] = function(net, scenario_dir, *function_args, **kwargs)
+        finally:
+            net.stop()
+        print(f"  {results[name]}", file=sys.stderr)
+
+    if 'chat' in args.scenario:
+        run('chat_burst', bench_chat, count=args.messages)
+        run('chat_paced', bench_chat, count=min(args.messages, 200), rate=100)
+
+    if 'group' in args.scenario:
+        for members in args.group_sizes:
+            run(f'group_{members}', bench_group, members)
+
+    if 'file' in args.scenario:
+        for file_size in args.file_sizes:
+            run(f'file_{file_size // 1024}k', bench_file, file_size)
+
+    if 'mixed' in args.scenario:
+        run('mixed', bench_mixed, max(args.file_sizes))
+
+    if 'receive' in args.scenario:
+        run('receive', bench_receive, max(args.file_sizes))
+
+    if 'crypto' in args.scenario:
+        # Sin red: solo CPU de cifrado por backend disponible
+        for backend in BACKENDS.values():
+            for size in CRYPTO_SIZES:
+                name = f'crypto_{backend.name}_{size}'
+                print(f"▶ {name}...", file=sys.stderr)
+                results[name] = bench_crypto(backend, size)
+                print(f"  {results[name]}", file=sys.stderr)
+
+    if 'verify' in args.scenario:
+        for mode in ('uncached', 'cached', 'batch'):
+            name = f'verify_{mode}'
+            print(f"▶ {name}...", file=sys.stderr)
+            results[name] = bench_verify(mode)
+            print(f"  {results[name]}", file=sys.stderr)
+
+    return results
+
+
+def compare(current, baseline, tolerance):
+    """
+    Comparar resultados con una ejecución anterior
+
+    Returns:
+        Lista de regresiones (texto) que superan la tolerancia
+    """
+    regressions = []
+
+    for name, metrics in current['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+
+        for metric in COMPARED_METRICS:
+            new, old = metrics.get(metric), previous.get(metric)
+            if not new or not old:
+                continue
+
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            line = f"{name}.{metric}: {old} -> {new} ({change:+.1%})"
+
+            if worse > tolerance:
+                regressions.append(line)
+                print(f"  ✗ {line}")
+            else:
+                print(f"    {line}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks de la red P2P')
+    parser.add_argument('--scenario', nargs='+',
+                        default=['chat', 'group', 'file', 'mixed', 'receive'],
+                        choices=['chat', 'group', 'file', 'mixed', 'receive',
+                                 'crypto', 'verify'])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--group-sizes', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--file-sizes', type=int, nargs='+',
+                        default=[64 * 1024, 1024 * 1024, 8 * 1024 * 1024])
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                        default=NETWORK_CONFIG['engine'])
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='Bytes/s por conexión y sentido (0 = sin límite)')
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None,
+                        help='Archivo JSON (por defecto benchmark_<fecha>.json)')
+    parser.add_argument('--compare', default=None,
+                        help='JSON de una ejecución anterior')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='Empeoramiento relativo tolerado en --compare')
+    args = parser.parse_args()
+
+    NETWORK_CONFIG['engine'] = args.engine
+
+    with tempfile.TemporaryDirectory(prefix='deepchat-bench-') as work_dir:
+        # Los gestores escriben en ~/.deepchat: aislarlos del usuario real
+        os.environ['HOME'] = work_dir
+        results = run_scenarios(args, work_dir)
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'app_version': APP_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'engine': args.engine,
+            'wire_format': NETWORK_CONFIG['wire_format'],
+            'sender_workers': NETWORK_CONFIG['sender_workers'],
+            'coalesce_max_packets': NETWORK_CONFIG['coalesce_max_packets'],
+            'latency_ms': args.latency_ms,
+            'bandwidth': args.bandwidth,
+            'loss': args.loss,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    output = args.output or f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Resultados guardados en {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+        print(f"\nComparación con {args.compare}:", file=sys.stderr)
+        with contextlib.redirect_stdout(sys.stderr):
+            regressions = compare(report, baseline, args.tolerance)
+
+        if regressions:
+            print(f"{len(regressions)} regresiones", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Compresión de Payloads
+zlib negociado por conexión, con chequeo de entropía y diccionario compartido
+"""
+
+import hashlib
+import json
+import math
+import threading
+import time
+import zlib
+from collections import Counter
+
+from packet_codec import encode_packet
+
+# Muestras de los paquetes más comunes: sus nombres de campo, tipos y
+# valores fijos son el diccionario inicial de zlib, que así comprime bien
+# también paquetes de pocos cientos de bytes
+_SAMPLE_ONION = 'a' * 56 + '.onion'
+_SAMPLE_PACKETS = [
+    {'type': 'group_invitation', 'group_id': '', 'group_name': '',
+     'creator': _SAMPLE_ONION, 'encryption_key': '',
+     'members': [_SAMPLE_ONION, _SAMPLE_ONION], 'timestamp': 0},
+    {'type': 'file_metadata', 'metadata': {
+        'transfer_id': '', 'filename': '', 'file_size': 0, 'total_chunks': 0,
+        'chunk_size': 0, 'checksum': '', 'sender': _SAMPLE_ONION, 'timestamp': 0}},
+    {'type': 'transfer_complete', 'transfer_id': ''},
+    {'type': 'member_added', 'group_id': '', 'member': _SAMPLE_ONION},
+    {'type': 'group_call_invitation', 'group_id': '', 'call_id': ''},
+    {'type': 'read_receipt', 'message_id': '', 'up_to': 0},
+    {'type': 'typing', 'active': True, 'ttl': 6.0},
+    {'type': 'message', 'from': _SAMPLE_ONION, 'to': _SAMPLE_ONION,
+     'timestamp': 0, 'data': '', 'message_id': ''},
+]
+
+# zlib da más peso al final del diccionario: JSON primero, binario después
+DICTIONARY = b''.join(
+    [json.dumps(packet).encode('utf-8') for packet in _SAMPLE_PACKETS]
+    + [encode_packet(packet) for packet in _SAMPLE_PACKETS]
+)
+
+# Los métodos llevan la huella del diccionario: dos versiones con muestras
+# distintas no lo negocian y se quedan con zlib sin diccionario
+METHOD_ZLIB = 'zlib'
+METHOD_ZLIB_DICT = 'zlib-' + hashlib.blake2b(DICTIONARY, digest_size=4).hexdigest()
+METHODS = (METHOD_ZLIB_DICT, METHOD_ZLIB)
+
+
+class CompressionError(Exception):
+    """Payload comprimido corrupto o que excede el tamaño permitido"""
+
+
+def choose_method(offered):
+    """
+    Elegir método entre los que ofrece el peer (en su orden de preferencia)
+
+    Args:
+        offered: Lista de métodos del HELLO del peer (o None)
+
+    Returns:
+        Método común o None
+    """
+    if not isinstance(offered, (list, tuple)):
+        return None
+    for method in offered:
+        if method in METHODS:
+            return method
+    return None
+
+
+def entropy(data):
+    """Entropía de Shannon en bits por byte"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(
+        count / total * math.log2(count / total)
+        for count in Counter(data).values()
+    )
+
+
+class PayloadCompressor:
+    """
+    Compresión de frames de datos
+
+    Solo vale la pena con texto y paquetes estructurados. Se envía sin
+    comprimir:
+
+    - Un payload menor a `threshold` (cabeceras de zlib > ahorro).
+    - Uno que parece incompresible: la entropía de una muestra supera
+      `max_entropy` bits/byte (JPEG, audio, datos ya cifrados en binario).
+    - Uno que al comprimir no baja de `min_ratio` de su tamaño.
+
+    Comprimir va antes del cifrado de Tor, pero después del de la app: el
+    cuerpo de un mensaje de chat o una invitación ya llega cifrado en
+    base64 y de él solo se recupera el exceso del base64; lo que se ahorra
+    de verdad es el sobre (campos, direcciones, IDs) y los paquetes que
+    viajan en claro. El texto no se comprime antes de encrypt_message: el
+    formato cambiaría para los peers anteriores y el tamaño del cifrado
+    delataría el contenido.
+    """
+
+    def __init__(self, level=6, threshold=256, max_entropy=7.5,
+                 min_ratio=0.9, sample_size=1024):
+        """
+        Args:
+            level: Nivel de zlib (1 = rápido, 9 = máximo)
+            threshold: Bytes mínimos para intentar comprimir
+            max_entropy: Bits por byte a partir de los cuales no se intenta
+            min_ratio: Tamaño comprimido / original máximo para usarlo
+            sample_size: Bytes de la muestra del chequeo de entropía
+        """
+        self.level = level
+        self.threshold = threshold
+        self.max_entropy = max_entropy
+        self.min_ratio = min_ratio
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'compressed': 0,
+            'skipped_small': 0,
+            'skipped_entropy': 0,
+            'skipped_ratio': 0,
+            'decompressed': 0,
+            'bytes_in': 0,  # Bytes originales de los frames comprimidos
+            'bytes_out': 0,  # Bytes que ocuparon comprimidos
+            'compress_seconds': 0.0,  # Incluye intentos descartados
+            'decompress_seconds': 0.0,
+        }
+
+    def compress(self, payload, method):
+        """
+        Comprimir un payload si conviene
+
+        Args:
+            payload: Paquete (o lote) serializado
+            method: Método negociado con el peer
+
+        Returns:
+            Bytes comprimidos o None si se envía tal cual
+        """
+        if len(payload) < self.threshold:
+            self._count('skipped_small')
+            return None
+
+        started = time.perf_counter()
+
+        if entropy(payload[:self.sample_size]) > self.max_entropy:
+            self._count('skipped_entropy', time.perf_counter() - started)
+            return None
+
+        compressor = self._compressobj(method)
+        compressed = compressor.compress(payload) + compressor.flush()
+        elapsed = time.perf_counter() - started
+
+        if len(compressed) > len(payload) * self.min_ratio:
+            self._count('skipped_ratio', elapsed)
+            return None
+
+        with self.lock:
+            self.stats['compressed'] += 1
+            self.stats['bytes_in'] += len(payload)
+            self.stats['bytes_out'] += len(compressed)
+            self.stats['compress_seconds'] += elapsed
+        return compressed
+
+    def decompress(self, data, method, max_size):
+        """
+        Descomprimir un payload recibido
+
+        Args:
+            data: Bytes comprimidos
+            method: Método negociado con el peer
+            max_size: Tamaño máximo descomprimido (frena bombas de zlib)
+
+        Returns:
+            Bytes originales
+        """
+        started = time.perf_counter()
+
+        try:
+            decompressor = self._decompressobj(method)
+            payload = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise CompressionError(f"Payload comprimido corrupto: {e}")
+
+        if decompressor.unconsumed_tail:
+            raise CompressionError(f"Payload descomprimido mayor a {max_size} bytes")
+        if not decompressor.eof:
+            raise CompressionError("Payload comprimido truncado")
+
+        with self.lock:
+            self.stats['decompressed'] += 1
+            self.stats['decompress_seconds'] += time.perf_counter() - started
+        return payload
+
+    def get_stats(self):
+        """Frames comprimidos u omitidos, bytes ahorrados y CPU gastada"""
+        with self.lock:
+            stats = dict(self.stats)
+        stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+        stats['ratio'] = (
+            stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] else 1.0
+        )
+        stats['compress_seconds'] = round(stats['compress_seconds'], 4)
+        stats['decompress_seconds'] = round(stats['decompress_seconds'], 4)
+        return stats
+
+    def _compressobj(self, method):
+        if method == METHOD_ZLIB_DICT:
+            return zlib.compressobj(self.level, zdict=DICTIONARY)
+        return zlib.compressobj(self.level)
+
+    @staticmethod
+    def _decompressobj(method):
+        if method == METHOD_ZLIB_DICT:
+            return zlib.decompressobj(zdict=DICTIONARY)
+        if method == METHOD_ZLIB:
+            return zlib.decompressobj()
+        raise CompressionError(f"Método de compresión no negociado: {method}")
+
+    def _count(self, reason, elapsed=0.0):
+        with self.lock:
+            self.stats[reason] += 1
+            self.stats['compress_seconds'] += elapsed
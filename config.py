@@ -15,8 +15,67 @@ NETWORK_CONFIG = {
     'call_timeout': 60,
     
     # Reintentos
-    'max_retries': 3,
-    'retry_delay': 5,
+    'max_retries': 3,  # Reintentos fallidos de un paquete del outbox antes de descartarlo
+    'retry_delay': 5,  # Backoff base del outbox (se duplica en cada fallo)
+    
+    # Outbox en disco (~/.deepchat/outbox) para peers offline
+    'outbox_max_bytes': 64 * 1024 * 1024,
+    'outbox_max_age': 7 * 24 * 3600,  # Segundos antes de descartar
+    'outbox_max_backoff': 600,
+    'outbox_ack_timeout': 30,  # Segundos sin acuse del receptor antes de reenviar
+    
+    # Pool de conexiones persistentes por peer
+    'pool_max_connections': 32,
+    'pool_idle_timeout': 300,  # Segundos sin uso antes de cerrar
+    
+    # Protocolo de cable
+    'max_frame_size': 2 * 1024 * 1024,  # Mayor frame que se arma en memoria al recibir
+    'wire_format': 'binary',  # 'json' solo para peers antiguos
+    
+    # Compresión de frames (zlib), negociada en el HELLO de cada conexión
+    'compression': True,
+    'compression_level': 6,
+    'compression_threshold': 256,  # Bytes mínimos del paquete para comprimir
+    
+    # Streams: cada clase de tráfico (control, chat, archivos, media) es un
+    # stream de la conexión con su propia ventana de control de flujo
+    'stream_window': 256 * 1024,  # Bytes en vuelo por stream sin crédito del receptor
+    
+    # Admisión de tráfico entrante (una tasa 0 desactiva el límite)
+    'max_inbound_connections': 64,
+    'rate_limit_packets': 500,  # Paquetes/s por conexión (exceso: se descarta)
+    'rate_limit_packets_burst': 1000,
+    'rate_limit_bytes': 8 * 1024 * 1024,  # Bytes/s por conexión (exceso: se frena)
+    'rate_limit_bytes_burst': 16 * 1024 * 1024,
+    
+    # Segundos que stop() espera a que salga lo encolado antes de cerrar
+    # (lo que no sale queda en el outbox para el próximo start)
+    'drain_timeout': 2.0,
+    
+    # Deduplicación de mensajes reintentados (memoria fija)
+    'dedup_capacity': 4096,  # IDs exactos recientes (LRU)
+    'dedup_window': 3600,  # Segundos cubiertos por cada filtro Bloom
+    'dedup_expected': 50000,  # IDs por ventana (~180 KB por filtro)
+    
+    # Motor de transporte: 'threads' (un thread por conexión) o 'asyncio'
+    # (un único event loop para aceptar, leer y escribir)
+    'engine': 'threads',
+    
+    # Senders: threads que atienden las colas por destinatario
+    'sender_workers': 4,
+    'sender_burst': 16,  # Frames por peer antes de ceder el sender
+    
+    # Agrupación de paquetes al mismo peer en un solo frame
+    'coalesce_max_packets': 32,
+    'coalesce_max_bytes': 256 * 1024,
+    'coalesce_linger_ms': 5,  # Espera máxima por más paquetes (0 = no esperar)
+    
+    # Media en tiempo real: frames no enviados antes del deadline se descartan
+    'media_deadline_ms': 250,
+    
+    # Señales efímeras (escribiendo, leído): nunca pasan por el outbox
+    'typing_interval': 3.0,  # Segundos mínimos entre 'typing' de una conversación
+    'receipt_delay_ms': 500,  # Acuses de lectura acumulados en uno solo
 }
 
 # Configuración de Encriptación
@@ -85,6 +144,38 @@ SECURITY_CONFIG = {
     # Auto-bloqueo
     'enable_auto_lock': True,
     'auto_lock_timeout': 300,  # 5 minutos
+    'session_cache_size': 256,  # Claves de sesión derivadas en memoria (LRU)
+    
+    # Verificación de firmas: claves públicas interpretadas en memoria (LRU),
+    # usos antes de precomputar una clave y procesos de verify_many
+    # (0 = núcleos - 1; con 1 o menos se verifica en el proceso actual)
+    'verify_key_cache_size': 256,
+    'verify_precompute_after': 8,
+    'verify_workers': 0,
+    
+    # Firma por lotes (merkle_auth.py): una firma por raíz de Merkle en vez
+    # de una por paquete. Media: ventana de latencia (ms) y frames por
+    # ventana; archivos: una raíz por transferencia. Desactivarla solo vale
+    # entre peers sin clave fijada: de uno conocido se exige la firma
+    'sign_media': True,
+    'media_sign_window_ms': 50,
+    'media_sign_max_packets': 64,
+    'sign_files': True,
+    
+    # Cifrado de mensajes: 'auto' (AES-GCM si está instalado cryptography),
+    # 'aes-gcm', 'chacha20-poly1305' o 'pyaes-ctr' (formato que leen todas
+    # las versiones anteriores)
+    'crypto_backend': 'auto',
+    
+    # Sesiones ECDH por peer (secure_session.py): se renuevan tras N
+    # mensajes enviados o T segundos. Un handshake sin respuesta se olvida
+    # tras `session_handshake_ttl` segundos; los que inicia un mensaje de
+    # sesión desconocida se limitan a N por segundo en total
+    'session_rekey_messages': 10000,
+    'session_rekey_seconds': 3600,
+    'session_handshake_ttl': 600,
+    'session_unsolicited_rate': 1,
+    'session_unsolicited_burst': 8,
     
     # Mensajes
     'enable_self_destruct': False,
@@ -101,6 +192,13 @@ DEV_CONFIG = {
     'verbose_logging': False,
     'enable_profiling': False,
     'mock_tor': False,  # Usar mock en lugar de Tor real (solo desarrollo)
+    
+    # Condiciones de la red simulada (mock_tor.py)
+    'mock_tor_latency_ms': 0,  # Latencia de un sentido
+    'mock_tor_bandwidth': 0,  # Bytes/s por conexión y sentido (0 = sin límite)
+    'mock_tor_loss': 0.0,  # Probabilidad de retransmisión por chunk
+    'mock_tor_connect_failure': 0.0,  # Probabilidad de fallo de circuito
+    'mock_tor_seed': None,  # Semilla para resultados repetibles
 }
 
 # Constantes
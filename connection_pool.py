@@ -0,0 +1,269 @@
+"""
+Pool de Conexiones P2P
+Sockets Tor persistentes por dirección .onion
+"""
+
+import select
+import socket
+import threading
+import time
+
+
+class PooledConnection:
+    """Conexión persistente hacia un peer"""
+
+    def __init__(self, onion_address, sock):
+        self.onion_address = onion_address
+        self.sock = sock
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.uses = 0
+        self.lock = threading.Lock()
+        self.pooled = True
+
+        # Control de flujo de los streams (lo asigna la red al conectar) y
+        # cierre detectado por el thread que lee las respuestas del peer
+        self.windows = None
+        self.closed = False
+        self.has_reader = False  # Un thread lee el socket y mantiene `closed`
+
+    def is_healthy(self):
+        """
+        Verificar que el socket siga abierto sin bloquear
+
+        Returns:
+            True si la conexión puede reutilizarse
+        """
+        if self.closed:
+            return False
+
+        # El lector es el único que consume el socket: un EOF o error ya
+        # lo dejó en `closed`, mirar el socket aquí solo competiría con él
+        if self.has_reader:
+            return True
+
+        try:
+            readable, _, errored = select.select([self.sock], [], [self.sock], 0)
+        except (OSError, ValueError):
+            return False
+
+        if errored:
+            return False
+
+        if readable:
+            # El receptor solo escribe frames de control (HELLO,
+            # WINDOW_UPDATE): datos legibles son esos frames, y una lectura
+            # vacía es un cierre (EOF). MSG_DONTWAIT: nunca esperar al
+            # timeout del socket
+            try:
+                return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+            except (BlockingIOError, InterruptedError, socket.timeout):
+                return True
+            except OSError:
+                return False
+
+        return True
+
+    def close(self):
+        """Cerrar socket (despierta al thread que lee de él)"""
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones hacia servicios .onion
+
+    Mantiene un socket abierto por peer para no repetir el handshake SOCKS5
+    y el rendezvous del servicio oculto en cada paquete.
+    """
+
+    def __init__(self, tor_manager, max_connections=32, idle_timeout=300,
+                 connections=None, on_connect=None):
+        """
+        Args:
+            tor_manager: TorManager usado para abrir conexiones nuevas
+            max_connections: Máximo de sockets abiertos simultáneamente
+            idle_timeout: Segundos sin uso antes de cerrar un socket
+            connections: Diccionario compartido onion -> PooledConnection
+            on_connect: Callback(conn) al abrir una conexión, antes del
+                        primer envío (saludo del protocolo)
+        """
+        self.tor_manager = tor_manager
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.on_connect = on_connect
+
+        self.connections = connections if connections is not None else {}
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'stale_closed': 0,
+            'overflow': 0,
+        }
+
+    def acquire(self, onion_address, port=80):
+        """
+        Obtener conexión hacia un peer (reutilizada o nueva)
+
+        La conexión se devuelve bloqueada; llamar a release() o discard()
+        al terminar de escribir.
+
+        Args:
+            onion_address: Dirección .onion del peer
+            port: Puerto virtual del servicio oculto
+
+        Returns:
+            PooledConnection o None si no se pudo conectar
+        """
+        with self.lock:
+            conn = self.connections.get(onion_address)
+
+        if conn:
+            conn.lock.acquire()
+
+            expired = time.time() - conn.last_used > self.idle_timeout
+            if not expired and conn.is_healthy():
+                with self.lock:
+                    self.stats['hits'] += 1
+                return conn
+
+            self._remove(conn)
+            conn.lock.release()
+            conn.close()
+            with self.lock:
+                self.stats['stale_closed'] += 1
+
+        with self.lock:
+            self.stats['misses'] += 1
+
+        sock = self.tor_manager.connect_to_onion(onion_address, port)
+        if not sock:
+            return None
+
+        conn = PooledConnection(onion_address, sock)
+        conn.lock.acquire()
+
+        if self.on_connect is not None:
+            try:
+                self.on_connect(conn)
+            except Exception as e:
+                print(f"Error iniciando conexión con {onion_address}: {e}")
+                conn.lock.release()
+                conn.close()
+                return None
+
+        with self.lock:
+            existing = self.connections.get(onion_address)
+            if existing is None and self._make_room():
+                self.connections[onion_address] = conn
+            else:
+                # Otro sender ya tiene una conexión abierta o el pool está
+                # lleno: usar esta conexión una sola vez
+                conn.pooled = False
+                self.stats['overflow'] += 1
+
+        return conn
+
+    def release(self, conn):
+        """Devolver conexión al pool tras un envío exitoso"""
+        conn.last_used = time.time()
+        conn.uses += 1
+        conn.lock.release()
+
+        if not conn.pooled:
+            conn.close()
+
+    def discard(self, conn):
+        """Cerrar y quitar del pool una conexión que falló"""
+        self._remove(conn)
+        conn.lock.release()
+        conn.close()
+
+    def prune_idle(self):
+        """
+        Cerrar conexiones inactivas más allá del timeout
+
+        Returns:
+            Número de conexiones cerradas
+        """
+        now = time.time()
+
+        with self.lock:
+            expired = [
+                conn for conn in self.connections.values()
+                if now - conn.last_used > self.idle_timeout
+            ]
+
+        closed = 0
+        for conn in expired:
+            # No bloquear si un sender la está usando
+            if not conn.lock.acquire(blocking=False):
+                continue
+            self._remove(conn)
+            conn.lock.release()
+            conn.close()
+            closed += 1
+
+        if closed:
+            with self.lock:
+                self.stats['stale_closed'] += closed
+
+        return closed
+
+    def close_all(self):
+        """Cerrar todas las conexiones"""
+        with self.lock:
+            conns = list(self.connections.values())
+            self.connections.clear()
+
+        for conn in conns:
+            conn.close()
+
+    def get_stats(self):
+        """Obtener estadísticas del pool"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['open_connections'] = len(self.connections)
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _remove(self, conn):
+        """Quitar conexión del diccionario si sigue registrada"""
+        with self.lock:
+            if self.connections.get(conn.onion_address) is conn:
+                del self.connections[conn.onion_address]
+
+    def _make_room(self):
+        """
+        Liberar un hueco cerrando la conexión inactiva más antigua
+        (llamar con self.lock tomado)
+
+        Returns:
+            True si hay espacio para una conexión nueva
+        """
+        if len(self.connections) < self.max_connections:
+            return True
+
+        idle = sorted(self.connections.values(), key=lambda c: c.last_used)
+        for victim in idle:
+            if victim.lock.acquire(blocking=False):
+                del self.connections[victim.onion_address]
+                victim.lock.release()
+                victim.close()
+                self.stats['evictions'] += 1
+                return True
+
+        return False
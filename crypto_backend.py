@@ -0,0 +1,232 @@
+"""
+Backends de Cifrado
+AEAD acelerado (cryptography) con respaldo en AES puro de pyaes
+"""
+
+import os
+
+import pyaes
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+except ImportError:  # APK sin cryptography: solo pyaes
+    AESGCM = ChaCha20Poly1305 = None
+
+
+class CipherError(Exception):
+    """Texto cifrado alterado, corrupto o de un formato no disponible"""
+
+
+class _SessionCTR(pyaes.AESModeOfOperationCTR):
+    """AES-CTR sobre una expansión de clave ya calculada (pyaes la rehace en cada modo)"""
+
+    def __init__(self, aes, counter):
+        self._aes = aes
+        self._counter = counter
+        self._remaining_counter = []
+
+
+def _into(result, out):
+    """Copiar el resultado a la salida preasignada, si la hay"""
+    if out is None:
+        return result
+    view = memoryview(out)[:len(result)]
+    view[:] = result
+    return view
+
+
+class PyaesCTR:
+    """
+    AES-256-CTR en Python puro (formato v1, sin autenticación)
+
+    Es el formato original: lo leen todas las versiones, pero cifra a
+    pocos MB/s y no detecta textos alterados.
+    """
+
+    name = 'pyaes-ctr'
+    version = 1
+    IV_SIZE = 16
+    TAG_SIZE = 0
+
+    def prepare(self, key):
+        """Expansión de la clave (reutilizable entre mensajes)"""
+        return pyaes.AES(key)
+
+    def encrypt(self, prepared, plaintext):
+        """IV aleatorio + texto cifrado"""
+        iv = os.urandom(self.IV_SIZE)
+        aes = _SessionCTR(prepared, pyaes.Counter(int.from_bytes(iv, 'big')))
+        return iv + aes.encrypt(plaintext)
+
+    def decrypt(self, prepared, data):
+        iv = data[:self.IV_SIZE]
+        aes = _SessionCTR(prepared, pyaes.Counter(int.from_bytes(iv, 'big')))
+        return aes.decrypt(data[self.IV_SIZE:])
+
+    def encrypt_at(self, prepared, index, data, out=None):
+        """
+        Cifrar el buffer `index` de un stream
+
+        El IV es el índice en los 64 bits altos: los bloques de un buffer
+        cuentan en los bajos sin pisar los del siguiente.
+        """
+        aes = _SessionCTR(prepared, pyaes.Counter(index << 64))
+        return _into(aes.encrypt(bytes(data)), out)
+
+    decrypt_at = encrypt_at
+
+
+class _AEAD:
+    """AEAD de cryptography: nonce aleatorio + texto cifrado + tag"""
+
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    cipher = None
+
+    def prepare(self, key):
+        return self.cipher(key)
+
+    def encrypt(self, prepared, plaintext):
+        nonce = os.urandom(self.NONCE_SIZE)
+        return nonce + prepared.encrypt(nonce, plaintext, None)
+
+    def decrypt(self, prepared, data):
+        try:
+            return prepared.decrypt(data[:self.NONCE_SIZE], data[self.NONCE_SIZE:], None)
+        except InvalidTag:
+            raise CipherError("Texto cifrado alterado o clave incorrecta")
+
+    def encrypt_at(self, prepared, index, data, out=None):
+        """Cifrar el buffer `index` de un stream (nonce = índice): texto cifrado + tag"""
+        nonce = index.to_bytes(self.NONCE_SIZE, 'big')
+        # encrypt_into solo existe desde cryptography 45
+        if out is None or not hasattr(prepared, 'encrypt_into'):
+            return _into(prepared.encrypt(nonce, data, None), out)
+
+        view = memoryview(out)[:len(data) + self.TAG_SIZE]
+        prepared.encrypt_into(nonce, data, None, view)
+        return view
+
+    def decrypt_at(self, prepared, index, data, out=None):
+        nonce = index.to_bytes(self.NONCE_SIZE, 'big')
+        try:
+            if out is None or not hasattr(prepared, 'decrypt_into'):
+                return _into(prepared.decrypt(nonce, data, None), out)
+
+            view = memoryview(out)[:len(data) - self.TAG_SIZE]
+            prepared.decrypt_into(nonce, data, None, view)
+            return view
+        except InvalidTag:
+            raise CipherError("Buffer alterado o clave incorrecta")
+
+
+class AesGcm(_AEAD):
+    """AES-256-GCM (formato v2): rápido donde la CPU tiene AES por hardware"""
+
+    name = 'aes-gcm'
+    version = 2
+    cipher = AESGCM
+
+
+class ChaCha20(_AEAD):
+    """ChaCha20-Poly1305 (formato v3): rápido en CPUs sin AES por hardware"""
+
+    name = 'chacha20-poly1305'
+    version = 3
+    cipher = ChaCha20Poly1305
+
+
+class StreamCipher:
+    """
+    Cifrado de bytes de una transferencia o llamada
+
+    Una clave por stream y un nonce por buffer derivado de su índice
+    (número de chunk, número de frame): sin base64 ni texto, y sin
+    generar nonces aleatorios. Cada índice se cifra una sola vez.
+
+    Con `out` el resultado se escribe en un buffer preasignado de al
+    menos len(data) + overhead bytes y se devuelve una memoryview sobre él.
+    """
+
+    def __init__(self, backend, prepared, stream_id):
+        """
+        Args:
+            backend: Backend del formato
+            prepared: Clave del stream preparada para el backend
+            stream_id: Identificador aleatorio del stream (viaja en claro)
+        """
+        self.backend = backend
+        self.prepared = prepared
+        self.stream_id = stream_id
+        self.overhead = backend.TAG_SIZE
+
+    def header(self):
+        """Lo que el receptor necesita para descifrar (sin la clave)"""
+        return {'version': self.backend.version, 'stream_id': self.stream_id}
+
+    def encrypt(self, index, data, out=None):
+        """
+        Cifrar un buffer
+
+        Args:
+            index: Posición del buffer en el stream
+            data: Bytes (o memoryview) a cifrar
+            out: Buffer preasignado opcional
+
+        Returns:
+            Bytes cifrados (memoryview sobre `out` si se pasó)
+        """
+        return self.backend.encrypt_at(self.prepared, index, data, out)
+
+    def decrypt(self, index, data, out=None):
+        """
+        Descifrar un buffer
+
+        Raises:
+            CipherError: Buffer alterado, de otra posición o de otro stream
+        """
+        return self.backend.decrypt_at(self.prepared, index, data, out)
+
+
+# Backends disponibles por versión de formato
+BACKENDS = {PyaesCTR.version: PyaesCTR()}
+if AESGCM is not None:
+    BACKENDS[AesGcm.version] = AesGcm()
+    BACKENDS[ChaCha20.version] = ChaCha20()
+
+BACKENDS_BY_NAME = {backend.name: backend for backend in BACKENDS.values()}
+
+
+def select_backend(name='auto'):
+    """
+    Backend para cifrar
+
+    Args:
+        name: 'auto' (AES-GCM si está cryptography, si no pyaes) o el
+            nombre de un backend
+
+    Returns:
+        Backend elegido
+    """
+    if name == 'auto':
+        return BACKENDS.get(AesGcm.version, BACKENDS[PyaesCTR.version])
+
+    backend = BACKENDS_BY_NAME.get(name)
+    if backend is None:
+        print(f"Backend de cifrado no disponible: {name}, usando pyaes")
+        return BACKENDS[PyaesCTR.version]
+    return backend
+
+
+def backend_for(version):
+    """
+    Backend que descifra un formato
+
+    Raises:
+        CipherError: Formato desconocido o sin la librería necesaria
+    """
+    backend = BACKENDS.get(version)
+    if backend is None:
+        raise CipherError(f"Formato de cifrado v{version} no disponible")
+    return backend
@@ -5,11 +5,152 @@ Encriptación AES-256 + ECDSA para firmas digitales
 
 import pyaes
 import hashlib
+import hmac
+import multiprocessing
 import os
 import base64
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from ecdsa import SigningKey, VerifyingKey, SECP256k1
+from ecdsa.ellipticcurve import PointJacobi
 import json
 
+from config import SECURITY_CONFIG
+from crypto_backend import PyaesCTR, StreamCipher, backend_for, select_backend
+
+
+class SessionKeyTable:
+    """
+    Valores derivados por clave (clave AES de un secreto de sesión)
+    calculados una sola vez
+    
+    LRU acotado con caducidad por inactividad: una entrada sin uso durante
+    `ttl` segundos se descarta, igual que al bloquear la app con wipe().
+    """
+    
+    def __init__(self, derive, max_entries=256, ttl=300):
+        """
+        Args:
+            derive: Función clave -> valor derivado
+            max_entries: Entradas en memoria
+            ttl: Segundos sin uso antes de derivar de nuevo
+        """
+        self.derive = derive
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # clave -> [valor, último uso]
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+    
+    def get(self, key):
+        """Valor derivado de `key` (lo calcula si no está o caducó)"""
+        now = time.monotonic()
+        
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    entry[1] = now
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[0]
+                del self.entries[key]
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+        
+        # Derivar fuera del lock: otros peers no esperan
+        value = self.derive(key)
+        
+        with self.lock:
+            self.entries[key] = [value, now]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return value
+    
+    def wipe(self):
+        """Olvidar todas las claves"""
+        with self.lock:
+            self.entries.clear()
+    
+    def get_stats(self):
+        """Aciertos, derivaciones y entradas descartadas"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            return stats
+
+
+class VerifyingKeyCache:
+    """
+    Claves públicas ya interpretadas, por su hex
+    
+    Interpretar el hex es barato; lo caro es verificar. Las claves que se
+    usan a menudo (miembros activos de un grupo) reciben además la
+    precomputación de ecdsa: tablas de múltiplos del punto que aceleran
+    cada verificación posterior, a cambio de unos milisegundos y ~100 KB.
+    Con `precompute_after` usos la inversión ya se recuperó.
+    """
+    
+    def __init__(self, max_entries=256, precompute_after=8):
+        """
+        Args:
+            max_entries: Claves en memoria (LRU)
+            precompute_after: Verificaciones con una clave antes de
+                precomputar sus tablas (0 = nunca)
+        """
+        self.max_entries = max_entries
+        self.precompute_after = precompute_after
+        self.entries = OrderedDict()  # hex -> [VerifyingKey, usos]
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'precomputed': 0}
+    
+    def get(self, public_key_hex):
+        """
+        VerifyingKey de una clave pública en hex
+        
+        Raises:
+            ValueError: Hex o punto inválido
+        """
+        with self.lock:
+            entry = self.entries.get(public_key_hex)
+            if entry is not None:
+                self.entries.move_to_end(public_key_hex)
+                self.stats['hits'] += 1
+                entry[1] += 1
+                # Solo el hilo que llega justo al umbral precomputa
+                precompute = entry[1] == self.precompute_after
+                vk = entry[0]
+            else:
+                self.stats['misses'] += 1
+                vk = None
+        
+        if vk is None:
+            vk = _parse_verifying_key(public_key_hex)
+            with self.lock:
+                self.entries[public_key_hex] = [vk, 1]
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+            precompute = self.precompute_after == 1
+        
+        if precompute:
+            vk.precompute()
+            with self.lock:
+                self.stats['precomputed'] += 1
+        return vk
+    
+    def get_stats(self):
+        """Aciertos, claves interpretadas y precomputadas"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            return stats
+
+
 class CryptoManager:
     """Gestor de criptografía usando AES-256 y ECDSA"""
     
@@ -17,6 +158,28 @@ class CryptoManager:
         self.private_key = None
         self.public_key = None
         
+        # Claves AES por secreto de sesión, derivadas una vez (el bloqueo o
+        # la inactividad las borran)
+        cache_size = SECURITY_CONFIG['session_cache_size']
+        ttl = SECURITY_CONFIG['auto_lock_timeout']
+        self.session_keys = SessionKeyTable(_derive_session_key, cache_size, ttl)
+        self.stream_keys = SessionKeyTable(_derive_stream_key, cache_size, ttl)
+        # Otros módulos con claves en memoria (sesiones ECDH, streams de
+        # media) se registran para olvidarlas al bloquear
+        self.lock_listeners = []
+        
+        # AEAD acelerado si está disponible; descifra también formatos viejos
+        self.backend = select_backend(SECURITY_CONFIG['crypto_backend'])
+        
+        # Claves públicas de peers listas para verificar firmas
+        self.verifying_keys = VerifyingKeyCache(
+            SECURITY_CONFIG['verify_key_cache_size'],
+            SECURITY_CONFIG['verify_precompute_after']
+        )
+        self.verify_pool = None  # Procesos de verify_many (al primer lote grande)
+        self.verify_pool_lock = threading.Lock()
+        self.verify_workers = _verify_workers(SECURITY_CONFIG['verify_workers'])
+        
     def generate_keypair(self):
         """Genera par de claves ECDSA"""
         self.private_key = SigningKey.generate(curve=SECP256k1)
@@ -29,6 +192,10 @@ class CryptoManager:
             return self.public_key.to_string().hex()
         return None
     
+    def export_public_key(self):
+        """Clave pública para enviar a otros peers (hex)"""
+        return self.get_public_key_hex()
+    
     def save_keys(self, filepath, password):
         """Guarda claves encriptadas"""
         if not self.private_key:
@@ -65,41 +232,110 @@ class CryptoManager:
         self.private_key = SigningKey.from_string(private_key_bytes, curve=SECP256k1)
         self.public_key = self.private_key.get_verifying_key()
     
-    def encrypt_message(self, message, shared_secret):
-        """Encripta mensaje con AES-256"""
-        # Derivar clave de 32 bytes del secreto compartido
-        key = hashlib.sha256(shared_secret.encode()).digest()
+    def add_lock_listener(self, callback):
+        """
+        Registrar una función a llamar al bloquear la app
         
-        # Generar IV aleatorio
-        iv = os.urandom(16)
+        Args:
+            callback: Función sin argumentos que borra sus claves
+        """
+        self.lock_listeners.append(callback)
+    
+    def lock(self):
+        """Bloqueo de la app: borrar de memoria las claves de sesión"""
+        self.session_keys.wipe()
+        self.stream_keys.wipe()
+        for callback in list(self.lock_listeners):
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error al bloquear: {e}")
+    
+    def get_cache_stats(self):
+        """Aciertos y derivaciones de las tablas de claves"""
+        return {
+            'session_keys': self.session_keys.get_stats(),
+            'stream_keys': self.stream_keys.get_stats(),
+            'verifying_keys': self.verifying_keys.get_stats(),
+        }
+    
+    def encrypt_message(self, message, shared_secret):
+        """
+        Encripta mensaje con AES-256
         
-        # Encriptar con AES-256-CTR
-        aes = pyaes.AESModeOfOperationCTR(key, counter=pyaes.Counter(int.from_bytes(iv, 'big')))
+        Formato: base64 de IV + texto cifrado (v1, pyaes) o 'vN.' + base64
+        de nonce + texto cifrado + tag (AEAD)
+        """
+        backend = self.backend
+        # Clave (ya preparada para el backend) del secreto compartido
+        prepared = self.session_keys.get((shared_secret, backend.version))
         
-        message_bytes = message.encode('utf-8')
-        encrypted = aes.encrypt(message_bytes)
+        encrypted = backend.encrypt(prepared, message.encode('utf-8'))
+        encoded = base64.b64encode(encrypted).decode('utf-8')
         
-        # Retornar IV + mensaje encriptado en base64
-        result = iv + encrypted
-        return base64.b64encode(result).decode('utf-8')
+        if backend.version == PyaesCTR.version:
+            return encoded
+        return f'v{backend.version}.{encoded}'
     
     def decrypt_message(self, encrypted_message, shared_secret):
-        """Desencripta mensaje AES-256"""
-        # Derivar clave
-        key = hashlib.sha256(shared_secret.encode()).digest()
+        """
+        Desencripta mensaje AES-256 (cualquier formato de encrypt_message)
         
-        # Decodificar base64
-        data = base64.b64decode(encrypted_message.encode('utf-8'))
+        Raises:
+            CipherError: Mensaje alterado o formato no disponible
+        """
+        # '.' no es de base64: sin prefijo es el formato original
+        version, dot, encoded = encrypted_message.partition('.')
+        if dot and version[:1] == 'v' and version[1:].isdigit():
+            backend = backend_for(int(version[1:]))
+        else:
+            backend, encoded = backend_for(PyaesCTR.version), encrypted_message
         
-        # Extraer IV y mensaje
-        iv = data[:16]
-        encrypted = data[16:]
+        prepared = self.session_keys.get((shared_secret, backend.version))
+        data = base64.b64decode(encoded.encode('utf-8'))
         
-        # Desencriptar
-        aes = pyaes.AESModeOfOperationCTR(key, counter=pyaes.Counter(int.from_bytes(iv, 'big')))
-        decrypted = aes.decrypt(encrypted)
+        return backend.decrypt(prepared, data).decode('utf-8')
+    
+    def encrypt_stream(self, shared_secret, stream_id=None):
+        """
+        Cifrador de bytes para una transferencia o llamada
+        
+        A diferencia de encrypt_message no codifica texto ni base64: cifra
+        buffers binarios con una clave propia del stream (derivada del
+        secreto compartido) y un nonce por índice de buffer.
         
-        return decrypted.decode('utf-8')
+        Args:
+            shared_secret: Secreto de la sesión con el peer (SessionManager)
+            stream_id: Identificador del stream (por defecto uno aleatorio)
+        
+        Returns:
+            StreamCipher; su header() se envía al receptor
+        """
+        stream_id = stream_id or os.urandom(8)
+        backend = self.backend
+        prepared = self.stream_keys.get((shared_secret, backend.version, stream_id))
+        return StreamCipher(backend, prepared, stream_id)
+    
+    def decrypt_stream(self, header, shared_secret):
+        """
+        Descifrador de un stream recibido
+        
+        Args:
+            header: header() del StreamCipher del emisor
+            shared_secret: Secreto de la sesión con el peer (SessionManager)
+        
+        Raises:
+            CipherError: Formato no disponible
+        """
+        stream_id = header['stream_id']
+        # Peers en formato JSON envían los bytes en base64
+        if isinstance(stream_id, str):
+            stream_id = base64.b64decode(stream_id)
+        stream_id = bytes(stream_id)
+        
+        backend = backend_for(header['version'])
+        prepared = self.stream_keys.get((shared_secret, backend.version, stream_id))
+        return StreamCipher(backend, prepared, stream_id)
     
     def sign_message(self, message):
         """Firma mensaje con ECDSA"""
@@ -112,26 +348,143 @@ class CryptoManager:
     
     def verify_signature(self, message, signature, public_key_hex):
         """Verifica firma ECDSA"""
-        try:
-            # Reconstruir clave pública
-            public_key_bytes = bytes.fromhex(public_key_hex)
-            vk = VerifyingKey.from_string(public_key_bytes, curve=SECP256k1)
-            
-            # Verificar
-            message_hash = hashlib.sha256(message.encode()).digest()
-            signature_bytes = base64.b64decode(signature.encode('utf-8'))
-            
-            return vk.verify(signature_bytes, message_hash)
-        except:
-            return False
-    
-    def derive_shared_secret(self, peer_public_key_hex):
-        """Deriva secreto compartido simple (no ECDH completo, versión simplificada)"""
-        # En versión completa usaríamos ECDH, aquí usamos hash simple
-        my_public = self.get_public_key_hex()
-        combined = sorted([my_public, peer_public_key_hex])
-        secret = hashlib.sha256(''.join(combined).encode()).hexdigest()
-        return secret
+        return _verify(self.verifying_keys, message, signature, public_key_hex)
+    
+    def verify_many(self, items):
+        """
+        Verifica un lote de firmas (mensajes de un grupo, historial)
+        
+        Con varios núcleos el lote se reparte entre procesos: ecdsa es
+        Python puro y con hilos no verificaría en paralelo. Cada proceso
+        guarda sus propias claves interpretadas y precomputadas.
+        
+        Args:
+            items: Lista de tuplas (mensaje, firma, clave pública hex)
+        
+        Returns:
+            Lista de bool, en el orden de `items`
+        """
+        items = list(items)
+        
+        if self.verify_workers > 1 and len(items) >= VERIFY_POOL_MIN_BATCH:
+            try:
+                return self._verify_in_pool(items)
+            except Exception as e:
+                # Sin multiprocessing (Android) o pool roto: verificar aquí
+                print(f"Verificación en paralelo no disponible: {e}")
+                self.verify_workers = 0
+                self.close_verify_pool()
+        
+        return [
+            _verify(self.verifying_keys, message, signature, key)
+            for message, signature, key in items
+        ]
+    
+    def close_verify_pool(self):
+        """Terminar los procesos de verify_many (al detener la red)"""
+        with self.verify_pool_lock:
+            pool, self.verify_pool = self.verify_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _verify_in_pool(self, items):
+        """Repartir el lote en un trozo por proceso"""
+        with self.verify_pool_lock:
+            if self.verify_pool is None:
+                # spawn: un fork copiaría un proceso con threads de red (y
+                # sus locks tomados) a medio funcionar
+                self.verify_pool = ProcessPoolExecutor(
+                    max_workers=self.verify_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            pool = self.verify_pool
+        
+        size = -(-len(items) // self.verify_workers)
+        chunks = [items[i:i + size] for i in range(0, len(items), size)]
+        
+        results = []
+        for chunk_results in pool.map(_verify_chunk, chunks):
+            results.extend(chunk_results)
+        return results
+    
+
+
+# Lotes menores se verifican en el proceso actual (repartir cuesta más)
+VERIFY_POOL_MIN_BATCH = 64
+
+
+def _parse_verifying_key(public_key_hex):
+    """
+    VerifyingKey de una clave pública en hex
+    
+    El punto lleva el orden de la curva: sin él ecdsa no puede
+    precomputar sus múltiplos (from_string lo omite).
+    """
+    point = PointJacobi.from_bytes(
+        SECP256k1.curve, bytes.fromhex(public_key_hex),
+        order=SECP256k1.order, generator=True
+    )
+    return VerifyingKey.from_public_point(point, curve=SECP256k1)
+
+
+def _verify(verifying_keys, message, signature, public_key_hex):
+    """Verificar una firma con la clave de la caché (False si no vale)"""
+    try:
+        vk = verifying_keys.get(public_key_hex)
+        message_hash = hashlib.sha256(message.encode()).digest()
+        signature_bytes = base64.b64decode(signature.encode('utf-8'))
+        return vk.verify(signature_bytes, message_hash)
+    except Exception:
+        return False
+
+
+# Caché propia de cada proceso de verify_many
+_worker_keys = None
+
+
+def _verify_chunk(items):
+    """Verificar un trozo de lote (en un proceso del pool)"""
+    global _worker_keys
+    if _worker_keys is None:
+        _worker_keys = VerifyingKeyCache(
+            SECURITY_CONFIG['verify_key_cache_size'],
+            SECURITY_CONFIG['verify_precompute_after']
+        )
+    return [_verify(_worker_keys, *item) for item in items]
+
+
+def _verify_workers(configured):
+    """Procesos para verify_many (0 = un núcleo libre para la UI y la red)"""
+    if configured:
+        return configured
+    return max(0, (os.cpu_count() or 1) - 1)
+
+
+def _derive_session_key(key):
+    """
+    Clave de 256 bits de un secreto compartido, preparada para un backend
+    (rondas expandidas en pyaes, objeto AEAD en cryptography)
+    
+    Args:
+        key: Tupla (secreto compartido, versión del formato)
+    """
+    shared_secret, version = key
+    return backend_for(version).prepare(hashlib.sha256(shared_secret.encode()).digest())
+
+
+def _derive_stream_key(key):
+    """
+    Clave de un stream: HMAC del secreto compartido con el id del stream,
+    preparada para el backend (nunca coincide con la de los mensajes)
+    
+    Args:
+        key: Tupla (secreto compartido, versión del formato, id del stream)
+    """
+    shared_secret, version, stream_id = key
+    secret = hashlib.sha256(shared_secret.encode()).digest()
+    stream_key = hmac.new(secret, b'stream|' + stream_id, hashlib.sha256).digest()
+    return backend_for(version).prepare(stream_key)
+
 
 # Utilidad para generar IDs únicos
 def generate_identity_id():
@@ -0,0 +1,193 @@
+"""
+Caché de Deduplicación
+IDs de mensajes ya recibidos en memoria fija (LRU + filtros Bloom)
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class BloomFilter:
+    """Filtro Bloom de tamaño fijo con doble hashing"""
+
+    def __init__(self, expected, false_positive=1e-6):
+        """
+        Args:
+            expected: Elementos esperados (dimensiona el filtro)
+            false_positive: Probabilidad de falso positivo con `expected`
+        """
+        bits = math.ceil(-expected * math.log(false_positive) / math.log(2) ** 2)
+        self.size = max(64, bits)
+        self.hashes = max(1, round(self.size / expected * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        """Posiciones de los bits de una clave (Kirsch-Mitzenmacher)"""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, positions):
+        """Marcar las posiciones de una clave"""
+        bits = self.bits
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def contains(self, positions):
+        """Todas las posiciones de la clave están marcadas"""
+        bits = self.bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class DedupCache:
+    """
+    Detector de mensajes duplicados con memoria acotada
+
+    Los reintentos llegan casi siempre poco después del original: un LRU de
+    IDs recientes los detecta con exactitud. Para duplicados tardíos (outbox
+    que reintenta minutos después) dos filtros Bloom cubren una ventana de
+    tiempo: el actual recibe los IDs nuevos y, al cumplir la ventana (o
+    llenarse), pasa a ser el anterior y se descarta el más viejo. La memoria no crece con el
+    tráfico; a cambio, un falso positivo del filtro descarta un mensaje
+    nuevo con probabilidad ~false_positive.
+    """
+
+    def __init__(self, capacity=4096, window=3600, expected=50000,
+                 false_positive=1e-6):
+        """
+        Args:
+            capacity: IDs exactos en el LRU
+            window: Segundos que cubre cada filtro Bloom
+            expected: IDs esperados por ventana (dimensiona los filtros)
+            false_positive: Probabilidad de falso positivo por filtro
+        """
+        self.capacity = capacity
+        self.window = window
+        self.expected = expected
+        self.false_positive = false_positive
+
+        self.recent = OrderedDict()
+        self.current = BloomFilter(expected, false_positive)
+        self.previous = None
+        self.rotated_at = time.time()
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'checked': 0,
+            'duplicates': 0,
+            'lru_hits': 0,
+            'bloom_hits': 0,
+            'rotations': 0,
+        }
+
+    def seen(self, message_id):
+        """
+        Registrar ID y decir si ya había llegado
+
+        Args:
+            message_id: ID único del mensaje
+
+        Returns:
+            True si es un duplicado (el mensaje debe descartarse)
+        """
+        with self.lock:
+            if self._check(message_id):
+                return True
+            self._add(message_id)
+            return False
+
+    def contains(self, message_id):
+        """
+        Decir si un ID ya se registró, sin registrarlo
+
+        Para quien solo marca el mensaje como entregado después de
+        procesarlo (record): un paquete que falla puede reintentarse.
+
+        Returns:
+            True si es un duplicado
+        """
+        with self.lock:
+            return self._check(message_id)
+
+    def record(self, message_id):
+        """Registrar un ID ya procesado"""
+        with self.lock:
+            if message_id in self.recent:
+                self.recent.move_to_end(message_id)
+            else:
+                self._add(message_id)
+
+    def _check(self, message_id):
+        """Consulta en el LRU y los filtros (llamar con el lock tomado)"""
+        now = time.time()
+        self.stats['checked'] += 1
+
+        # Un filtro lleno supera la tasa de falsos positivos prevista
+        if (now - self.rotated_at > self.window
+                or self.current.count >= self.expected):
+            self._rotate(now)
+
+        if message_id in self.recent:
+            self.recent.move_to_end(message_id)
+            self.stats['duplicates'] += 1
+            self.stats['lru_hits'] += 1
+            return True
+
+        # Ambos filtros tienen el mismo tamaño: las posiciones sirven
+        # para los dos
+        positions = self.current.positions(message_id)
+        if self.current.contains(positions) or (
+                self.previous is not None and self.previous.contains(positions)):
+            self.stats['duplicates'] += 1
+            self.stats['bloom_hits'] += 1
+            self._remember(message_id)
+            return True
+
+        return False
+
+    def _add(self, message_id):
+        """Marcar un ID nuevo (llamar con el lock tomado)"""
+        self.current.add(self.current.positions(message_id))
+        self._remember(message_id)
+
+    def get_stats(self):
+        """Consultas, duplicados y tasa de aciertos"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['hit_rate'] = (
+                stats['duplicates'] / stats['checked'] if stats['checked'] else 0.0
+            )
+            stats['lru_size'] = len(self.recent)
+            stats['bloom_fill'] = self.current.count
+            stats['bloom_bytes'] = len(self.current.bits) + (
+                len(self.previous.bits) if self.previous is not None else 0
+            )
+            return stats
+
+    def _remember(self, message_id):
+        """Agregar al LRU expulsando el más antiguo (llamar con el lock tomado)"""
+        self.recent[message_id] = None
+        if len(self.recent) > self.capacity:
+            self.recent.popitem(last=False)
+
+    def _rotate(self, now):
+        """Empezar una ventana nueva (llamar con el lock tomado)"""
+        # Si pasaron dos ventanas sin tráfico, el filtro actual ya es viejo
+        if now - self.rotated_at > 2 * self.window:
+            self.previous = None
+        else:
+            self.previous = self.current
+
+        self.current = BloomFilter(self.expected, self.false_positive)
+        self.rotated_at = now
+        self.stats['rotations'] += 1
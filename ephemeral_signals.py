@@ -0,0 +1,215 @@
+"""
+Señales Efímeras
+Indicadores de escritura y acuses de lectura agrupados por conversación
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from config import NETWORK_CONFIG, UI_CONFIG
+from p2p_network import MessageProtocol
+
+MAX_TRACKED_PEERS = 1024  # Conversaciones con estado de escritura o lectura en memoria
+
+
+def timestamp_ms(value):
+    """
+    Normalizar un timestamp a milisegundos desde epoch (entero)
+
+    Los paquetes usan milisegundos (now_ms); versiones anteriores y la UI
+    guardan segundos (time.time()) o texto ISO 8601.
+
+    Args:
+        value: int/float en ms o segundos, o texto numérico o ISO 8601
+
+    Returns:
+        Milisegundos, o None si no es un timestamp
+    """
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            try:
+                return int(datetime.fromisoformat(value).timestamp() * 1000)
+            except ValueError:
+                return None
+
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+
+    # Antes del año 5000 en segundos, o de 1973 en milisegundos
+    if abs(value) < 1e11:
+        value *= 1000
+    return int(value)
+
+
+class EphemeralSignals:
+    """
+    Señales que solo importan en el momento: "escribiendo..." y "leído"
+
+    Cada pulsación o mensaje leído no genera un paquete:
+
+    - Escritura: por conversación se envía un 'typing' al empezar y como
+      mucho uno cada `typing_interval` mientras se siga escribiendo; el
+      receptor lo muestra durante dos intervalos. Al parar se envía un
+      único 'typing' inactivo.
+    - Lectura: los mensajes leídos en `receipt_delay` se confirman con un
+      solo acuse acumulativo ("leído hasta el mensaje X", por timestamp).
+
+    Las señales van con deadline: nunca se guardan en el outbox ni se
+    reintentan. Un acuse perdido lo cubre el siguiente.
+
+    Los timestamps se comparan en milisegundos (timestamp_ms) y el estado
+    por conversación es un LRU de MAX_TRACKED_PEERS: olvidar una solo
+    cuesta, a lo sumo, una señal repetida.
+    """
+
+    def __init__(self, p2p_network, typing_interval=None, receipt_delay=None):
+        """
+        Args:
+            p2p_network: Red P2P para enviar y recibir
+            typing_interval: Segundos entre 'typing' de una conversación
+            receipt_delay: Segundos que se acumulan acuses antes de enviar
+        """
+        self.p2p_network = p2p_network
+        self.typing_interval = typing_interval or NETWORK_CONFIG['typing_interval']
+        self.receipt_delay = (
+            receipt_delay or NETWORK_CONFIG['receipt_delay_ms'] / 1000
+        )
+
+        self.typing_state = OrderedDict()  # peer -> (activo, último envío)
+        self.pending_receipts = {}  # peer -> (timestamp ms, message_id), hasta el timer
+        self.acked = OrderedDict()  # peer -> último timestamp confirmado (ms)
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'typing_sent': 0,
+            'typing_suppressed': 0,
+            'receipts_sent': 0,
+            'receipts_merged': 0,
+        }
+
+        p2p_network.register_handler('typing', self._on_typing)
+        p2p_network.register_handler('read_receipt', self._on_read_receipt)
+
+    def typing(self, peer_onion, active=True):
+        """
+        Informar que el usuario escribe (llamar en cada pulsación)
+
+        Args:
+            peer_onion: Conversación
+            active: False al borrar el texto o enviar el mensaje
+
+        Returns:
+            True si se envió un paquete
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            was_active, sent_at = self.typing_state.get(peer_onion, (False, 0))
+
+            if active == was_active and (
+                    not active or now - sent_at < self.typing_interval):
+                self.stats['typing_suppressed'] += 1
+                return False
+
+            self._remember(self.typing_state, peer_onion, (active, now))
+            self.stats['typing_sent'] += 1
+
+        packet = MessageProtocol.create_typing_indicator(active)
+        packet['ttl'] = self.typing_interval * 2
+        self._send(peer_onion, packet, self.typing_interval)
+        return True
+
+    def mark_read(self, peer_onion, timestamp, message_id=None):
+        """
+        Marcar como leído un mensaje recibido de `peer_onion`
+
+        Args:
+            peer_onion: Remitente del mensaje
+            timestamp: 'timestamp' del mensaje (reloj del remitente; ms,
+                segundos o ISO 8601)
+            message_id: 'message_id' del mensaje, si lo trae
+        """
+        if not UI_CONFIG['show_read_receipts']:
+            return
+
+        timestamp = timestamp_ms(timestamp)
+        if timestamp is None:
+            return
+
+        with self.lock:
+            if timestamp <= self.acked.get(peer_onion, 0):
+                self.stats['receipts_merged'] += 1
+                return
+
+            pending = self.pending_receipts.get(peer_onion)
+
+            if pending is None:
+                # Primer mensaje leído: abrir la ventana de agrupación
+                timer = threading.Timer(
+                    self.receipt_delay, self._flush_receipt, args=(peer_onion,)
+                )
+                timer.daemon = True
+                timer.start()
+            else:
+                self.stats['receipts_merged'] += 1
+                if timestamp <= pending[0]:
+                    return
+
+            # Acotado: cada conversación sale al vencer su timer
+            self.pending_receipts[peer_onion] = (timestamp, message_id)
+
+    def _flush_receipt(self, peer_onion):
+        """Enviar el acuse acumulado de una conversación"""
+        with self.lock:
+            pending = self.pending_receipts.pop(peer_onion, None)
+            if pending is None:
+                return
+            up_to, message_id = pending
+            self._remember(self.acked, peer_onion, up_to)
+            self.stats['receipts_sent'] += 1
+
+        packet = MessageProtocol.create_read_receipt(message_id, up_to=up_to)
+        self._send(peer_onion, packet, NETWORK_CONFIG['message_timeout'])
+
+    @staticmethod
+    def _remember(table, peer_onion, value):
+        """Guardar estado de una conversación en un LRU (llamar con el lock tomado)"""
+        table[peer_onion] = value
+        table.move_to_end(peer_onion)
+        while len(table) > MAX_TRACKED_PEERS:
+            table.popitem(last=False)
+
+    def _send(self, peer_onion, packet, lifetime):
+        """Enviar señal sin persistir: pasado `lifetime` se descarta"""
+        self.p2p_network.send_packet(
+            peer_onion, packet, deadline=time.time() + lifetime
+        )
+
+    def _on_typing(self, packet):
+        """Handler P2P de 'typing'"""
+        return {
+            'type': 'typing',
+            'from': packet.get('from'),
+            'active': packet.get('active', True),
+            'ttl': packet.get('ttl', self.typing_interval * 2),
+        }
+
+    def _on_read_receipt(self, packet):
+        """Handler P2P de 'read_receipt': leídos todos hasta 'up_to'"""
+        return {
+            'type': 'read_receipt',
+            'from': packet.get('from'),
+            'up_to': timestamp_ms(packet.get('up_to')),
+            'message_id': packet.get('message_id'),
+        }
+
+    def get_stats(self):
+        """Paquetes enviados y eventos absorbidos"""
+        with self.lock:
+            return dict(self.stats)
@@ -4,16 +4,26 @@ Envío de archivos encriptados por chunks en paralelo
 """
 
 import os
+import re
 import hashlib
 import base64
-import json
 from pathlib import Path
-from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
 import queue
 import time
 
+from config import SECURITY_CONFIG
+from crypto_backend import CipherError
+from merkle_auth import detach_header, leaf_hash, merkle_proof, sign_root
+from p2p_network import PRIORITY_BULK
+from packet_codec import now_ms
+
+# IDs de transferencia aceptados: hex (send_file) o UUID; nunca una ruta
+TRANSFER_ID_PATTERN = re.compile(
+    r'[0-9a-f]{16,64}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+)
+
 
 class FileTransferManager:
     """Gestor de transferencia de archivos encriptados"""
@@ -35,6 +45,17 @@ class FileTransferManager:
         # Configuración
         self.chunk_size = 64 * 1024  # 64 KB por chunk
         self.max_file_size = 100 * 1024 * 1024  # 100 MB máximo
+        
+        # Límites de lo que anuncia un remitente
+        self.max_chunk_size = 1024 * 1024  # Buffer de descifrado por transferencia
+        self.max_incoming_transfers = 16  # Recepciones en curso a la vez
+        self.stall_timeout = 300  # Segundos sin chunks antes de abandonar
+        self.last_stall_check = time.monotonic()
+        
+        # Recibir los paquetes de archivos directamente de la red P2P
+        p2p_network.register_handler('file_metadata', self._on_file_metadata)
+        p2p_network.register_handler('file_chunk', self._on_file_chunk)
+        p2p_network.register_handler('transfer_complete', self._on_transfer_complete)
     
     def send_file(self, file_path, recipient_address, progress_callback=None):
         """
@@ -58,6 +79,12 @@ class FileTransferManager:
         if file_size > self.max_file_size:
             raise ValueError(f"Archivo muy grande. Máximo: {self.max_file_size / 1024 / 1024} MB")
         
+        # Los chunks se cifran con la sesión ECDH del destinatario
+        session = self.p2p_network.session_manager.stream_secret(recipient_address)
+        if session is None:
+            raise ValueError(f"Sin sesión con {recipient_address}: handshake iniciado, reintentar")
+        session_id, secret = session
+        
         # Generar ID de transferencia
         transfer_id = hashlib.sha256(
             f"{file_path}{recipient_address}{time.time()}".encode()
@@ -78,11 +105,25 @@ class FileTransferManager:
             'filename': file_path.name,
             'file_size': file_size,
             'total_chunks': total_chunks,
+            'chunk_size': self.chunk_size,
             'checksum': file_checksum,
             'sender': self.crypto_manager.load_identity()['onion_address'],
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_ms()
         }
         
+        # Un stream cifrado por transferencia (nonce = índice del chunk);
+        # el receptor lo abre con el header y la sesión de la metadata
+        cipher = self.crypto_manager.encrypt_stream(secret)
+        metadata['encryption'] = dict(cipher.header(), session_id=session_id)
+        
+        # Cifrar antes de anunciar: la firma cubre los bytes que viajan
+        self._encrypt_chunks(chunks, cipher)
+        
+        # Una firma por transferencia: la raíz de Merkle de los chunks va en
+        # la metadata y cada chunk lleva su prueba de inclusión
+        if SECURITY_CONFIG['sign_files'] and chunks:
+            self._sign_chunks(chunks, metadata)
+        
         # Guardar info de transferencia
         self.active_transfers[transfer_id] = {
             'metadata': metadata,
@@ -131,6 +172,39 @@ class FileTransferManager:
         
         return chunks
     
+    def _encrypt_chunks(self, chunks, cipher):
+        """Cifrar los chunks en paralelo (reemplaza 'data' por el cifrado)"""
+        def encrypt(chunk):
+            started = time.perf_counter()
+            chunk['data'] = self._encrypt_chunk(cipher, chunk['index'], chunk['data'])
+            self.p2p_network.monitor.observe(
+                'encrypt', time.perf_counter() - started
+            )
+        
+        list(self.executor.map(encrypt, chunks))
+    
+    def _sign_chunks(self, chunks, metadata):
+        """
+        Firmar la raíz de Merkle de los chunks cifrados
+        
+        Args:
+            chunks: Chunks ya cifrados (reciben su 'proof')
+            metadata: Metadata de la transferencia (recibe 'merkle')
+        """
+        leaves = [leaf_hash(chunk['data']) for chunk in chunks]
+        
+        try:
+            levels, header = sign_root(
+                self.crypto_manager, leaves, metadata['transfer_id']
+            )
+        except ValueError as e:
+            print(f"Transferencia sin firma: {e}")
+            return
+        
+        metadata['merkle'] = header
+        for chunk in chunks:
+            chunk['proof'] = merkle_proof(levels, chunk['index'])
+    
     def _send_chunks_parallel(self, chunks, recipient, transfer_id, progress_callback):
         """
         Enviar chunks en paralelo usando ThreadPoolExecutor
@@ -143,28 +217,26 @@ class FileTransferManager:
         """
         total_chunks = len(chunks)
         
-        # Función para enviar un chunk individual
+        # Función para enviar un chunk individual (ya cifrado)
         def send_chunk(chunk):
             chunk_index = chunk['index']
-            chunk_data = chunk['data']
             
-            # Encriptar chunk
-            encrypted_chunk = self._encrypt_chunk(chunk_data)
-            
-            # Crear paquete de chunk
+            # Crear paquete de chunk (datos binarios, sin base64)
             packet = {
                 'type': 'file_chunk',
                 'transfer_id': transfer_id,
                 'chunk_index': chunk_index,
                 'total_chunks': total_chunks,
-                'data': base64.b64encode(encrypted_chunk).decode('utf-8'),
-                'timestamp': datetime.now().isoformat()
+                'data': chunk['data']
             }
+            if 'proof' in chunk:
+                packet['proof'] = chunk['proof']
             
-            # Enviar por P2P
-            success = self.p2p_network.send_message(
+            # Enviar por P2P (tráfico masivo: no adelanta al chat)
+            success = self.p2p_network.send_packet(
                 recipient,
-                json.dumps(packet)
+                packet,
+                priority=PRIORITY_BULK
             )
             
             return success, chunk_index
@@ -209,73 +281,226 @@ class FileTransferManager:
             self.active_transfers[transfer_id]['status'] = 'failed'
             print(f"❌ Transferencia {transfer_id} falló: {chunks_sent}/{total_chunks} chunks")
     
-    def _encrypt_chunk(self, chunk_data):
+    def _encrypt_chunk(self, cipher, chunk_index, chunk_data):
         """
         Encriptar chunk de datos
         
         Args:
+            cipher: StreamCipher de la transferencia
+            chunk_index: Índice del chunk (nonce del stream)
             chunk_data: Datos a encriptar
             
         Returns:
-            Datos encriptados
+            Datos encriptados (bytes crudos, sin base64)
         """
-        from cryptography.fernet import Fernet
-        
-        # Generar clave temporal para el chunk
-        key = Fernet.generate_key()
-        fernet = Fernet(key)
-        
-        encrypted = fernet.encrypt(chunk_data)
-        
-        # Encriptar la clave con RSA
-        # TODO: Usar clave pública del destinatario
-        
-        return encrypted
+        return cipher.encrypt(chunk_index, chunk_data)
     
     def _send_file_metadata(self, recipient, metadata):
         """Enviar metadata del archivo"""
         packet = {
             'type': 'file_metadata',
-            'metadata': metadata,
-            'timestamp': datetime.now().isoformat()
+            'metadata': metadata
         }
         
-        self.p2p_network.send_message(
-            recipient,
-            json.dumps(packet)
-        )
+        self.p2p_network.send_packet(recipient, packet)
     
     def _send_transfer_complete(self, recipient, transfer_id):
         """Enviar señal de transferencia completa"""
         packet = {
             'type': 'transfer_complete',
-            'transfer_id': transfer_id,
-            'timestamp': datetime.now().isoformat()
+            'transfer_id': transfer_id
         }
         
-        self.p2p_network.send_message(
-            recipient,
-            json.dumps(packet)
-        )
+        self.p2p_network.send_packet(recipient, packet)
     
-    def receive_file_metadata(self, metadata):
+    def _on_file_metadata(self, packet):
+        """Handler P2P de 'file_metadata'"""
+        if not self.receive_file_metadata(packet['metadata'], packet.get('from')):
+            return None
+        
+        return {
+            'type': 'file_incoming',
+            'from': packet.get('from'),
+            'metadata': packet['metadata']
+        }
+    
+    def _on_file_chunk(self, packet):
+        """Handler P2P de 'file_chunk': avisa cuando el archivo terminó"""
+        self.receive_chunk(packet)
+        
+        transfer_info = self.received_chunks.get(packet['transfer_id'])
+        if not transfer_info:
+            return None
+        
+        if transfer_info['status'] == 'failed':
+            return {
+                'type': 'file_failed',
+                'from': packet.get('from'),
+                'transfer_id': packet['transfer_id'],
+                'filename': transfer_info['metadata']['filename']
+            }
+        
+        if transfer_info['status'] != 'completed':
+            return None
+        
+        return {
+            'type': 'file_received',
+            'from': packet.get('from'),
+            'transfer_id': packet['transfer_id'],
+            'filename': transfer_info['metadata']['filename'],
+            'path': transfer_info['output_path']
+        }
+    
+    def _on_transfer_complete(self, packet):
+        """Handler P2P de 'transfer_complete'"""
+        # Los chunks van en la clase BULK y pueden llegar después de esta
+        # señal: el evento 'file_received' lo emite el último chunk
+        return None
+    
+    def receive_file_metadata(self, metadata, sender=None):
         """
         Procesar metadata de archivo entrante
         
         Args:
             metadata: Diccionario con metadata del archivo
+            sender: Dirección del remitente (por defecto la de la metadata)
+            
+        Returns:
+            False si la metadata no es válida, excede los límites o la
+            transferencia firmada no es del remitente
         """
-        transfer_id = metadata['transfer_id']
+        transfer_id = metadata.get('transfer_id')
+        
+        # Los valores vienen del remitente: validar antes de reservar nada
+        error = self._validate_metadata(metadata)
+        if error is not None:
+            print(f"❌ Transferencia {transfer_id!r} rechazada: {error}")
+            return False
+        
+        self._expire_stalled(force=True)
+        receiving = sum(
+            1 for info in self.received_chunks.values() if info['status'] == 'receiving'
+        )
+        if receiving >= self.max_incoming_transfers:
+            print(f"❌ Transferencia {transfer_id} rechazada: {receiving} recepciones en curso")
+            return False
+        
+        # Raíz firmada: se verifica aquí una vez; cada chunk solo comprueba
+        # su prueba de inclusión. Sin 'merkle' solo pasa con la firma
+        # desactivada y un remitente sin clave fijada
+        sender = sender or metadata.get('sender')
+        header = metadata.get('merkle')
+        if header is None and (SECURITY_CONFIG['sign_files'] or sender in self.p2p_network.peer_keys):
+            print(f"❌ Transferencia {transfer_id} rechazada: sin firma")
+            return False
+        if header is not None:
+            if (not isinstance(header, dict)
+                    or header.get('context') != transfer_id
+                    or header.get('count') != metadata['total_chunks']
+                    or not self.p2p_network.packet_auth.verify_root(sender, header)):
+                print(f"❌ Transferencia {transfer_id} rechazada: firma inválida")
+                return False
+            metadata['merkle'] = detach_header(header)
+        
+        # Stream cifrado de la transferencia (sin 'encryption': versión
+        # anterior, los chunks se guardan tal cual llegan)
+        cipher = None
+        if metadata.get('encryption') is not None:
+            try:
+                secret = self.p2p_network.session_manager.receive_secret(
+                    sender, metadata['encryption'].get('session_id')
+                )
+                if secret is None:
+                    print(f"❌ Transferencia {transfer_id} rechazada: sin sesión con {sender}")
+                    return False
+                cipher = self.crypto_manager.decrypt_stream(metadata['encryption'], secret)
+            except (CipherError, KeyError, TypeError, AttributeError) as e:
+                print(f"❌ Transferencia {transfer_id} rechazada: {e}")
+                return False
+        
+        # Los chunks se escriben en su posición a medida que llegan: el
+        # archivo nunca se ensambla en memoria
+        part_path = self.data_dir / f"{transfer_id}.part"
         
         # Preparar para recibir chunks
         self.received_chunks[transfer_id] = {
             'metadata': metadata,
-            'chunks': {},
+            'sender': sender,
+            'cipher': cipher,
+            # Buffer de descifrado reutilizado entre chunks
+            'buffer': bytearray(metadata['chunk_size']),
+            'lock': threading.Lock(),
+            'chunks': set(),
             'received_count': 0,
-            'status': 'receiving'
+            'status': 'receiving',
+            'last_activity': time.monotonic(),
+            'part_path': part_path,
+            'part_file': open(part_path, 'wb', buffering=0)
         }
         
         print(f"📥 Recibiendo archivo: {metadata['filename']} ({metadata['file_size'] / 1024:.1f} KB)")
+        return True
+    
+    def _validate_metadata(self, metadata):
+        """
+        Comprobar los valores anunciados por el remitente
+        
+        Returns:
+            Motivo del rechazo, o None si la metadata es válida
+        """
+        transfer_id = metadata.get('transfer_id')
+        if not isinstance(transfer_id, str) or not TRANSFER_ID_PATTERN.fullmatch(transfer_id):
+            return "ID de transferencia inválido"
+        if transfer_id in self.received_chunks:
+            return "ID de transferencia repetido"
+        
+        filename = metadata.get('filename')
+        if (not isinstance(filename, str) or not filename
+                or Path(filename).name != filename or filename in ('.', '..')):
+            return "nombre de archivo inválido"
+        
+        sizes = [metadata.get(field) for field in ('chunk_size', 'file_size', 'total_chunks')]
+        if any(type(value) is not int for value in sizes):
+            return "tamaños no enteros"
+        
+        chunk_size, file_size, total_chunks = sizes
+        if not 0 < chunk_size <= self.max_chunk_size:
+            return f"chunk de {chunk_size} bytes"
+        if not 0 <= file_size <= self.max_file_size:
+            return f"archivo de {file_size} bytes"
+        if total_chunks != (file_size + chunk_size - 1) // chunk_size:
+            return f"{total_chunks} chunks no corresponden al tamaño"
+        
+        if not isinstance(metadata.get('checksum'), str):
+            return "sin checksum"
+        return None
+    
+    def _expire_stalled(self, force=False):
+        """
+        Abandonar recepciones sin chunks durante stall_timeout
+        
+        Cierra y borra su archivo parcial. Se revisa al llegar metadata o,
+        a lo sumo una vez por segundo, chunks.
+        """
+        now = time.monotonic()
+        if not force and now - self.last_stall_check < 1:
+            return
+        self.last_stall_check = now
+        
+        for transfer_id, transfer_info in list(self.received_chunks.items()):
+            if (transfer_info['status'] != 'receiving'
+                    or now - transfer_info['last_activity'] < self.stall_timeout):
+                continue
+            
+            with transfer_info['lock']:
+                if transfer_info['status'] != 'receiving':
+                    continue
+                transfer_info['status'] = 'expired'
+                transfer_info['part_file'].close()
+                transfer_info['part_path'].unlink(missing_ok=True)
+            
+            self.received_chunks.pop(transfer_id, None)
+            print(f"⌛ Transferencia {transfer_id} abandonada: sin chunks en {self.stall_timeout} s")
     
     def receive_chunk(self, packet):
         """
@@ -286,20 +511,59 @@ class FileTransferManager:
         """
         transfer_id = packet['transfer_id']
         chunk_index = packet['chunk_index']
-        total_chunks = packet['total_chunks']
-        encrypted_data = base64.b64decode(packet['data'])
+        encrypted_data = packet['data']
+        
+        # Peers en formato JSON envían los bytes en base64
+        if isinstance(encrypted_data, str):
+            encrypted_data = base64.b64decode(encrypted_data)
+        
+        self._expire_stalled()
         
-        if transfer_id not in self.received_chunks:
+        transfer_info = self.received_chunks.get(transfer_id)
+        if transfer_info is None:
             print(f"Advertencia: Chunk recibido sin metadata: {transfer_id}")
             return
         
-        # Desencriptar chunk
-        chunk_data = self._decrypt_chunk(encrypted_data)
+        # El índice decide la posición de escritura: solo dentro del archivo
+        # anunciado (y validado) en la metadata
+        total_chunks = transfer_info['metadata']['total_chunks']
+        if type(chunk_index) is not int or not 0 <= chunk_index < total_chunks:
+            print(f"❌ Chunk {chunk_index!r} de {transfer_id} descartado: fuera de rango")
+            return
         
-        # Guardar chunk
-        transfer_info = self.received_chunks[transfer_id]
-        transfer_info['chunks'][chunk_index] = chunk_data
-        transfer_info['received_count'] += 1
+        # Reintento de un chunk ya escrito
+        if chunk_index in transfer_info['chunks'] or transfer_info['status'] != 'receiving':
+            return
+        
+        # Transferencia firmada: el chunk debe estar en la raíz de la metadata
+        header = transfer_info['metadata'].get('merkle')
+        if header is not None and not self.p2p_network.packet_auth.verify_packet(
+                transfer_info['sender'], leaf_hash(encrypted_data),
+                chunk_index, packet.get('proof') or [], header):
+            print(f"❌ Chunk {chunk_index} de {transfer_id} descartado: firma inválida")
+            return
+        
+        chunk_size = transfer_info['metadata']['chunk_size']
+        
+        with transfer_info['lock']:
+            # El mismo chunk por dos conexiones (o ya abandonada): solo se
+            # escribe una vez
+            if chunk_index in transfer_info['chunks'] or transfer_info['status'] != 'receiving':
+                return
+            transfer_info['last_activity'] = time.monotonic()
+            
+            # Desencriptar chunk en el buffer de la transferencia
+            try:
+                chunk_data = self._decrypt_chunk(transfer_info, chunk_index, encrypted_data)
+            except CipherError as e:
+                print(f"❌ Chunk {chunk_index} de {transfer_id} descartado: {e}")
+                return
+            
+            # Guardar chunk en su posición (sin copia: write acepta el
+            # memoryview del buffer o del frame recibido)
+            self._write_at(transfer_info['part_file'], chunk_index * chunk_size, chunk_data)
+            transfer_info['chunks'].add(chunk_index)
+            transfer_info['received_count'] += 1
         
         received = transfer_info['received_count']
         progress = (received / total_chunks) * 100
@@ -310,50 +574,72 @@ class FileTransferManager:
         if received == total_chunks:
             self._assemble_file(transfer_id)
     
-    def _decrypt_chunk(self, encrypted_data):
-        """Desencriptar chunk"""
-        from cryptography.fernet import Fernet
+    def _decrypt_chunk(self, transfer_info, chunk_index, encrypted_data):
+        """
+        Desencriptar chunk
         
-        # TODO: Implementar desencriptación correcta con RSA
-        # Por ahora, retornar sin desencriptar
-        return encrypted_data
+        Returns:
+            Datos en claro (memoryview sobre el buffer de la transferencia)
+            
+        Raises:
+            CipherError: Chunk alterado o de otra posición
+        """
+        cipher = transfer_info['cipher']
+        if cipher is None:
+            if len(encrypted_data) > len(transfer_info['buffer']):
+                raise CipherError("Chunk mayor al tamaño anunciado")
+            return encrypted_data
+        
+        if len(encrypted_data) - cipher.overhead > len(transfer_info['buffer']):
+            raise CipherError("Chunk mayor al tamaño anunciado")
+        
+        started = time.perf_counter()
+        chunk_data = cipher.decrypt(chunk_index, encrypted_data, transfer_info['buffer'])
+        self.p2p_network.monitor.observe('decrypt', time.perf_counter() - started)
+        return chunk_data
+    
+    @staticmethod
+    def _write_at(part_file, offset, data):
+        """Escribir datos en una posición del archivo parcial"""
+        view = memoryview(data)
+        part_file.seek(offset)
+        
+        # Un archivo sin buffer puede escribir menos de lo pedido
+        while view:
+            written = part_file.write(view)
+            view = view[written:]
     
     def _assemble_file(self, transfer_id):
         """
-        Ensamblar archivo desde chunks recibidos
+        Verificar y renombrar el archivo recibido
         
         Args:
             transfer_id: ID de la transferencia
         """
         transfer_info = self.received_chunks[transfer_id]
         metadata = transfer_info['metadata']
-        chunks = transfer_info['chunks']
+        part_path = transfer_info['part_path']
         
-        # Ordenar chunks por índice
-        sorted_chunks = [chunks[i] for i in sorted(chunks.keys())]
+        transfer_info['part_file'].close()
         
-        # Ensamblar archivo
-        file_data = b''.join(sorted_chunks)
-        
-        # Verificar checksum
-        received_checksum = hashlib.sha256(file_data).hexdigest()
+        # Verificar checksum leyendo del disco por bloques
+        received_checksum = self._calculate_file_checksum(part_path)
         
         if received_checksum != metadata['checksum']:
             print(f"❌ Error: Checksum no coincide para {metadata['filename']}")
             transfer_info['status'] = 'failed'
+            part_path.unlink()
             return
         
         # Guardar archivo
         output_path = self.data_dir / metadata['filename']
-        
-        with open(output_path, 'wb') as f:
-            f.write(file_data)
+        part_path.replace(output_path)
         
         transfer_info['status'] = 'completed'
         transfer_info['output_path'] = str(output_path)
         
         print(f"✅ Archivo recibido: {output_path}")
-        print(f"   Tamaño: {len(file_data) / 1024:.1f} KB")
+        print(f"   Tamaño: {metadata['file_size'] / 1024:.1f} KB")
         print(f"   Checksum verificado: {received_checksum[:16]}...")
     
     def _calculate_file_checksum(self, file_path):
@@ -528,14 +814,14 @@ if __name__ == '__main__':
     print("=== Test de FileTransferManager ===\n")
     
     from crypto_manager import CryptoManager
-    from tor_manager import TorManager
+    from tor_manager import create_tor_manager
     from p2p_network import P2PNetwork
     
     # Setup
     crypto = CryptoManager()
     crypto.generate_keypair()
     
-    tor = TorManager()
+    tor = create_tor_manager()
     p2p = P2PNetwork(tor, crypto)
     
     # Crear manager
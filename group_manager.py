@@ -4,6 +4,7 @@ Gestión de conversaciones multipunto encriptadas
 """
 
 import json
+import base64
 import threading
 import queue
 import time
@@ -12,6 +13,8 @@ from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import uuid
 
+from packet_codec import now_ms
+
 
 class GroupManager:
     """Gestor de grupos de chat y llamadas"""
@@ -30,6 +33,9 @@ class GroupManager:
         self.executor = ThreadPoolExecutor(max_workers=10)
         
         self._load_groups()
+        
+        # Recibir los paquetes de grupo directamente de la red P2P
+        p2p_network.register_handler('group_packet', self.receive_group_packet)
     
     def create_group(self, group_name, members_onion_addresses):
         """
@@ -91,17 +97,12 @@ class GroupManager:
                 'creator': group['creator'],
                 'encryption_key': group['encryption_key'],
                 'members': group['members'],
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_ms()
             }
             
-            # Encriptar invitación
-            encrypted = self.crypto_manager.encrypt_message(
-                json.dumps(invitation),
-                None  # Usar clave pública del contacto
-            )
-            
-            # Enviar por P2P
-            self.p2p_network.send_message(member_address, encrypted)
+            # Cifrada con la sesión ECDH del miembro (sin sesión espera al
+            # handshake)
+            self.p2p_network.send_text(member_address, json.dumps(invitation))
             print(f"Invitación enviada a {member_address[:20]}...")
         
         # Enviar todas las invitaciones en paralelo
@@ -150,7 +151,7 @@ class GroupManager:
                 {
                     'type': 'member_added',
                     'member': member_address,
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': now_ms()
                 }
             )
             
@@ -181,7 +182,7 @@ class GroupManager:
                 {
                     'type': 'member_removed',
                     'member': member_address,
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': now_ms()
                 }
             )
             
@@ -209,7 +210,7 @@ class GroupManager:
             'group_name': group['name'],
             'sender': self.crypto_manager.load_identity()['onion_address'],
             'text': message_text,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': now_ms(),
             'message_id': str(uuid.uuid4())
         }
         
@@ -230,21 +231,31 @@ class GroupManager:
         group = self.groups[group_id]
         my_address = self.crypto_manager.load_identity()['onion_address']
         
+        # Encriptar una sola vez con la clave del grupo: todos los miembros
+        # reciben el mismo token (binario crudo, sin base64 en el cable)
+        from cryptography.fernet import Fernet
+        started = time.perf_counter()
+        fernet = Fernet(group['encryption_key'].encode())
+        token = fernet.encrypt(json.dumps(message_data).encode())
+        encrypted = base64.urlsafe_b64decode(token)
+        self.p2p_network.monitor.observe('encrypt', time.perf_counter() - started)
+        
+        # ID visible sin descifrar: el receptor descarta reintentos duplicados
+        message_id = message_data.get('message_id') or str(uuid.uuid4())
+        
         # Función para enviar a un miembro
         def send_to_member(member_address):
             if member_address == my_address:
                 return True  # No enviarse a sí mismo
             
             try:
-                # Encriptar con clave del grupo
-                from cryptography.fernet import Fernet
-                fernet = Fernet(group['encryption_key'].encode())
-                encrypted_text = fernet.encrypt(
-                    json.dumps(message_data).encode()
-                ).decode()
-                
                 # Enviar por P2P
-                self.p2p_network.send_message(member_address, encrypted_text)
+                self.p2p_network.send_packet(member_address, {
+                    'type': 'group_packet',
+                    'group_id': group_id,
+                    'data': encrypted,
+                    'message_id': message_id
+                })
                 return True
             except Exception as e:
                 print(f"Error enviando a {member_address[:20]}...: {e}")
@@ -271,6 +282,37 @@ class GroupManager:
         print(f"Mensaje enviado a {successful}/{len(group['members'])} miembros")
         return successful
     
+    def receive_group_packet(self, packet):
+        """
+        Procesar paquete de grupo entrante
+        
+        Args:
+            packet: Paquete 'group_packet' recibido por P2P
+            
+        Returns:
+            Diccionario con el mensaje desencriptado o None
+        """
+        group = self.groups.get(packet.get('group_id'))
+        
+        if not group:
+            print(f"Paquete de grupo desconocido: {packet.get('group_id')}")
+            return None
+        
+        encrypted = packet['data']
+        
+        # Peers en formato JSON envían los bytes en base64
+        if isinstance(encrypted, str):
+            encrypted = base64.b64decode(encrypted)
+        
+        from cryptography.fernet import Fernet
+        fernet = Fernet(group['encryption_key'].encode())
+        message = json.loads(fernet.decrypt(base64.urlsafe_b64encode(encrypted)))
+        
+        if message.get('type') == 'group_message':
+            self._save_group_message(group['id'], message)
+        
+        return message
+    
     def start_group_call(self, group_id):
         """
         Iniciar llamada grupal
@@ -303,7 +345,7 @@ class GroupManager:
             {
                 'type': 'group_call_invitation',
                 'call_id': call_id,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_ms()
             }
         )
         
@@ -328,7 +370,7 @@ class GroupManager:
                     'type': 'participant_joined',
                     'call_id': call_id,
                     'participant': my_address,
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': now_ms()
                 }
             )
             
@@ -355,7 +397,7 @@ class GroupManager:
                     'type': 'participant_left',
                     'call_id': call_id,
                     'participant': my_address,
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': now_ms()
                 }
             )
             
@@ -435,7 +477,7 @@ class GroupManager:
             group_id,
             {
                 'type': 'group_deleted',
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_ms()
             }
         )
         
@@ -468,6 +510,9 @@ class GroupCallManager:
         self.active_call = None
         self.participant_streams = {}
         
+        # Frames de los participantes llegan por la red P2P
+        p2p_network.register_handler('video_frame', self._on_video_frame)
+        
         # Thread pool para procesamiento paralelo de video
         self.executor = ThreadPoolExecutor(max_workers=5)
     
@@ -515,6 +560,18 @@ class GroupCallManager:
         # Iniciar broadcast en thread separado
         threading.Thread(target=broadcast_loop, daemon=True).start()
     
+    def _on_video_frame(self, packet):
+        """Handler P2P de 'video_frame' durante una llamada grupal"""
+        if self.active_call and packet.get('from') in self._call_members():
+            self.receive_participant_frame(packet['from'], packet['data'])
+        return None
+    
+    def _call_members(self):
+        """Miembros del grupo de la llamada activa"""
+        call = self.group_manager.active_group_calls.get(self.active_call)
+        group = call and self.group_manager.get_group(call['group_id'])
+        return group['members'] if group else []
+    
     def receive_participant_frame(self, participant_address, frame_data):
         """Recibir frame de un participante"""
         # Decodificar frame
@@ -542,14 +599,14 @@ if __name__ == '__main__':
     print("=== Test de GroupManager ===\n")
     
     from crypto_manager import CryptoManager
-    from tor_manager import TorManager
+    from tor_manager import create_tor_manager
     from p2p_network import P2PNetwork
     
     # Setup
     crypto = CryptoManager()
     crypto.generate_keypair()
     
-    tor = TorManager()
+    tor = create_tor_manager()
     if tor.start_tor():
         onion = tor.start_hidden_service()
         
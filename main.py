@@ -17,6 +17,7 @@ import os
 # Importar gestores
 sys.path.insert(0, os.path.dirname(__file__))
 
+from config import SECURITY_CONFIG
 from crypto_manager import CryptoManager, generate_identity_id
 from tor_manager import TorManager
 from p2p_network import P2PNetwork
@@ -121,6 +122,12 @@ class YascanApp(App):
             self.update_status(f'Error: {str(e)}')
             self.add_message(f'[color=ff0000]Error generando identidad: {str(e)}[/color]')
     
+    def on_pause(self):
+        """App en segundo plano: bloquear (borra sesiones y claves derivadas)"""
+        if SECURITY_CONFIG['enable_auto_lock']:
+            self.crypto.lock()
+        return True
+    
     def update_status(self, message):
         """Actualiza mensaje de estado"""
         self.status_label.text = f'Estado: {message}'
@@ -0,0 +1,508 @@
+"""
+Autenticación por Lotes
+Una firma ECDSA por ventana de paquetes: raíz de Merkle firmada y pruebas
+de inclusión por paquete
+"""
+
+import base64
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Prefijos distintos para hojas y nodos: una hoja no puede hacerse pasar
+# por un nodo interno
+_LEAF = b'\x00'
+_NODE = b'\x01'
+
+
+def leaf_hash(*parts):
+    """
+    Hoja del árbol: SHA-256 de las partes (bytes o texto) con su longitud
+
+    Args:
+        parts: Contenido autenticado del paquete
+
+    Returns:
+        32 bytes
+    """
+    digest = hashlib.sha256(_LEAF)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(len(part).to_bytes(4, 'big'))
+        digest.update(part)
+    return digest.digest()
+
+
+def packet_leaf(packet):
+    """
+    Hoja de un paquete con su contenido en 'data' (frames de media)
+
+    Cubre también remitente, hora y posición en el stream cifrado: un
+    paquete firmado no se puede reenviar como de otro peer, de otro
+    momento o con otro índice. Peers en formato JSON envían los bytes en
+    base64: se hashean decodificados.
+    """
+    data = packet.get('data') or b''
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+
+    stream = packet.get('stream') or {}
+    return leaf_hash(
+        packet.get('type', ''),
+        packet.get('from') or '',
+        str(packet.get('timestamp', '')),
+        str(stream.get('version', '')),
+        _as_bytes(stream.get('stream_id') or b''),
+        str(stream.get('index', '')),
+        data,
+    )
+
+
+def _node_hash(left, right):
+    return hashlib.sha256(_NODE + left + right).digest()
+
+
+def build_tree(leaves):
+    """
+    Niveles del árbol, de las hojas a la raíz
+
+    Un nodo sin pareja sube tal cual al nivel siguiente (no se duplica:
+    así dos listas de hojas distintas nunca dan la misma raíz).
+
+    Args:
+        leaves: Lista de hojas (leaf_hash), al menos una
+
+    Returns:
+        Lista de niveles; levels[-1][0] es la raíz
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [_node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_proof(levels, index):
+    """
+    Prueba de inclusión de una hoja: hermanos desde abajo hacia la raíz
+
+    Args:
+        levels: Resultado de build_tree
+        index: Posición de la hoja
+    """
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling])
+        index //= 2
+    return proof
+
+
+def root_from_proof(leaf, index, count, proof):
+    """
+    Raíz que resulta de una hoja y su prueba
+
+    Args:
+        leaf: Hoja del paquete recibido
+        index: Posición de la hoja en la ventana
+        count: Hojas de la ventana
+        proof: Hermanos (merkle_proof)
+
+    Returns:
+        Raíz calculada o None si la prueba no tiene la forma esperada
+    """
+    if not 0 <= index < count:
+        return None
+
+    node = leaf
+    siblings = iter(proof)
+    width = count
+
+    try:
+        while width > 1:
+            if index % 2:
+                node = _node_hash(next(siblings), node)
+            elif index + 1 < width:
+                node = _node_hash(node, next(siblings))
+            index //= 2
+            width = (width + 1) // 2
+    except StopIteration:
+        return None
+
+    # Hermanos de sobra: la prueba no es de esta posición
+    if next(siblings, None) is not None:
+        return None
+    return node
+
+
+def _statement(context, count, root):
+    """Texto firmado: ata la raíz a su contexto y a su número de hojas"""
+    return f'merkle|{context}|{count}|{root.hex()}'
+
+
+def sign_root(crypto_manager, leaves, context):
+    """
+    Construir el árbol de una ventana y firmar su raíz
+
+    Args:
+        crypto_manager: CryptoManager con la clave privada
+        leaves: Hojas de los paquetes de la ventana
+        context: Identificador de la ventana (transferencia, lote de media)
+
+    Returns:
+        Tupla (niveles del árbol, cabecera firmada)
+
+    Raises:
+        ValueError: Sin clave privada para firmar
+    """
+    levels = build_tree(leaves)
+    root = levels[-1][0]
+    header = {
+        'context': context,
+        'count': len(leaves),
+        'root': root,
+        'signature': crypto_manager.sign_message(_statement(context, len(leaves), root)),
+        'key': crypto_manager.export_public_key(),
+    }
+    return levels, header
+
+
+def _as_bytes(value):
+    """Hash recibido: bytes en binario, memoryview del buffer o base64 en JSON"""
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return bytes(value)
+
+
+def detach_header(header):
+    """Copia de una cabecera recibida para guardarla fuera del handler"""
+    return dict(header, root=_as_bytes(header['root']))
+
+
+class WindowSigner:
+    """
+    Firma de paquetes salientes por ventanas de tiempo
+
+    Los paquetes enviados durante `window` segundos (o hasta juntar
+    `max_packets`) se firman juntos: una firma ECDSA por ventana en vez
+    de una por paquete. Cada paquete sale con la cabecera firmada y su
+    prueba en 'merkle', de modo que se verifica solo aunque se pierdan
+    los demás de su ventana.
+
+    La ventana es el presupuesto de latencia: un paquete espera como
+    mucho `window` antes de salir (50 ms en media).
+    """
+
+    def __init__(self, crypto_manager, window, max_packets, send):
+        """
+        Args:
+            crypto_manager: CryptoManager con la clave privada
+            window: Segundos que se acumulan paquetes
+            max_packets: Paquetes por ventana (al llegar se firma ya)
+            send: Callable(packet, *args) que envía un paquete firmado
+        """
+        self.crypto_manager = crypto_manager
+        self.window = window
+        self.max_packets = max_packets
+        self.send = send
+
+        self.pending = []  # (hoja, paquete, args)
+        self.timer = None
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'windows': 0,
+            'packets': 0,
+            'unsigned': 0,  # Enviados sin firma (sin clave privada)
+            'sign_seconds': 0.0,
+        }
+
+    def submit(self, leaf, packet, *args):
+        """
+        Encolar un paquete para la ventana actual
+
+        Args:
+            leaf: Hoja del paquete (packet_leaf o leaf_hash)
+            packet: Paquete a enviar
+            args: Argumentos extra para `send`
+        """
+        with self.lock:
+            self.pending.append((leaf, packet, args))
+            full = len(self.pending) >= self.max_packets
+
+            if len(self.pending) == 1 and not full:
+                # Primer paquete: abrir la ventana
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Firmar y enviar la ventana actual"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if not pending:
+            return
+
+        started = time.perf_counter()
+        try:
+            levels, header = sign_root(
+                self.crypto_manager, [leaf for leaf, _, _ in pending], uuid.uuid4().hex[:16]
+            )
+        except ValueError as e:
+            print(f"Paquetes enviados sin firma: {e}")
+            levels = header = None
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            if header is None:
+                self.stats['unsigned'] += len(pending)
+            else:
+                self.stats['windows'] += 1
+                self.stats['packets'] += len(pending)
+            self.stats['sign_seconds'] += elapsed
+
+        for index, (_, packet, args) in enumerate(pending):
+            if header is not None:
+                packet['merkle'] = dict(header, index=index, proof=merkle_proof(levels, index))
+            self.send(packet, *args)
+
+    def close(self):
+        """Descartar la ventana en curso (paquetes efímeros)"""
+        with self.lock:
+            self.pending = []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def get_stats(self):
+        """Ventanas firmadas, paquetes por firma y CPU de firmado"""
+        with self.lock:
+            stats = dict(self.stats)
+        stats['packets_per_signature'] = (
+            round(stats['packets'] / stats['windows'], 1) if stats['windows'] else 0
+        )
+        stats['sign_seconds'] = round(stats['sign_seconds'], 4)
+        return stats
+
+
+class RootVerifier:
+    """
+    Verificación de paquetes firmados por ventanas
+
+    La firma de cada raíz se verifica una vez y se recuerda; los demás
+    paquetes de la ventana solo calculan su camino de hashes hasta ella,
+    y cada posición de la ventana se acepta una sola vez (un paquete
+    repetido es una reinyección).
+
+    Las posiciones aceptadas se guardan por (remitente, raíz), aparte del
+    caché de firmas y con su propio límite. Al descartar una ventana se
+    recuerda su hora firmada más nueva como horizonte del remitente: un
+    paquete con hora ('timestamp', cubierto por la hoja) igual o anterior
+    se rechaza, así que una ventana olvidada no se puede reinyectar. Los
+    chunks de archivo no llevan hora: su repetición la descarta la
+    transferencia (cada chunk se escribe una vez).
+
+    El remitente lo declara el paquete: la clave con que debe firmar es
+    la que fijó el handshake de sesión del peer (peer_keys compartido con
+    secure_session), no la que trae la cabecera. Sin clave fijada se
+    rechaza y se avisa a `on_unknown_peer` para negociar la sesión.
+    """
+
+    def __init__(self, crypto_manager, max_roots=256, peer_keys=None,
+                 on_unknown_peer=None, max_windows=4096):
+        """
+        Args:
+            crypto_manager: CryptoManager para verificar firmas
+            max_roots: Raíces verificadas en memoria (LRU)
+            max_windows: Ventanas con posiciones aceptadas en memoria
+            peer_keys: Diccionario peer -> clave a compartir con otros módulos
+            on_unknown_peer: Callable(peer) para un remitente sin clave fijada
+        """
+        self.crypto_manager = crypto_manager
+        self.max_roots = max_roots
+        self.peer_keys = peer_keys if peer_keys is not None else {}
+        self.on_unknown_peer = on_unknown_peer
+        self.max_windows = max_windows
+        self.roots = OrderedDict()  # (clave, contexto, hojas, raíz) verificadas
+        self.windows = OrderedDict()  # (peer, raíz) -> [posiciones aceptadas, hora más nueva]
+        self.horizons = {}  # peer -> hora más nueva de sus ventanas descartadas
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'roots_verified': 0,
+            'roots_cached': 0,
+            'packets_verified': 0,
+            'replayed': 0,
+            'expired': 0,  # Hora anterior al horizonte del remitente
+            'rejected': 0,
+        }
+
+    def verify_root(self, peer, header):
+        """
+        Comprobar la cabecera firmada de una ventana
+
+        Args:
+            peer: Dirección del remitente
+            header: Cabecera de sign_root (o el 'merkle' de un paquete)
+
+        Returns:
+            True si la firma es válida y de la clave del peer
+        """
+        return self._verified_root(peer, header) is not None
+
+    def _verified_root(self, peer, header):
+        """
+        Comprobar la cabecera firmada
+
+        Returns:
+            Raíz (bytes), o None si se rechaza
+        """
+        try:
+            key = header['key']
+            context = header['context']
+            count = int(header['count'])
+            root = _as_bytes(header['root'])
+            signature = header['signature']
+        except (KeyError, TypeError, ValueError):
+            self._reject(peer, "cabecera incompleta")
+            return None
+
+        known = self.peer_keys.get(peer)
+        if known is None:
+            self._reject(peer, "sin clave fijada por una sesión")
+            if self.on_unknown_peer is not None and peer:
+                self.on_unknown_peer(peer)
+            return None
+        if known != key:
+            self._reject(peer, "clave distinta a la conocida")
+            return None
+
+        cache_key = (key, context, count, root)
+        with self.lock:
+            if cache_key in self.roots:
+                self.roots.move_to_end(cache_key)
+                self.stats['roots_cached'] += 1
+                return root
+
+        if not self.crypto_manager.verify_signature(
+                _statement(context, count, root), signature, key):
+            self._reject(peer, "firma inválida")
+            return None
+
+        with self.lock:
+            self.roots[cache_key] = True
+            while len(self.roots) > self.max_roots:
+                self.roots.popitem(last=False)
+            self.stats['roots_verified'] += 1
+        return root
+
+    def _accept(self, peer, root, index, timestamp):
+        """
+        Registrar una posición de la ventana (llamar con el lock tomado)
+
+        Returns:
+            None si se acepta, o el motivo del rechazo
+        """
+        if timestamp is not None and timestamp <= self.horizons.get(peer, -1):
+            self.stats['expired'] += 1
+            return f"hora {timestamp} anterior a las ventanas olvidadas"
+
+        window = self.windows.get((peer, root))
+        if window is None:
+            window = self.windows[(peer, root)] = [set(), None]
+            while len(self.windows) > self.max_windows:
+                (old_peer, _), (_, newest) = self.windows.popitem(last=False)
+                if newest is not None and newest > self.horizons.get(old_peer, -1):
+                    self.horizons[old_peer] = newest
+        else:
+            self.windows.move_to_end((peer, root))
+
+        accepted = window[0]
+        if index in accepted:
+            self.stats['replayed'] += 1
+            return f"posición {index} repetida"
+
+        accepted.add(index)
+        if timestamp is not None and (window[1] is None or timestamp > window[1]):
+            window[1] = timestamp
+        self.stats['packets_verified'] += 1
+        return None
+
+    def verify_packet(self, peer, leaf, index, proof, header, timestamp=None):
+        """
+        Comprobar que un paquete pertenece a una ventana firmada
+
+        Args:
+            peer: Dirección del remitente
+            leaf: Hoja calculada del paquete recibido
+            index: Posición declarada del paquete
+            proof: Hermanos recibidos
+            header: Cabecera firmada de la ventana
+            timestamp: Hora del paquete cubierta por la hoja, si la tiene
+
+        Returns:
+            True si la raíz está firmada por el peer, la prueba lleva a ella
+            y la posición no se había aceptado antes
+        """
+        signed_root = self._verified_root(peer, header)
+        if signed_root is None:
+            return False
+
+        try:
+            index = int(index)
+            root = root_from_proof(
+                leaf, index, int(header['count']), [_as_bytes(h) for h in proof]
+            )
+        except (TypeError, ValueError):
+            root = None
+
+        if root is None or root != signed_root:
+            return self._reject(peer, "prueba de inclusión inválida")
+
+        with self.lock:
+            reason = self._accept(peer, root, index, timestamp)
+
+        if reason is not None:
+            return self._reject(peer, reason)
+        return True
+
+    def verify_signed_packet(self, packet):
+        """Comprobar un paquete con su cabecera y prueba en 'merkle'"""
+        auth = packet.get('merkle')
+        if not isinstance(auth, dict):
+            return self._reject(packet.get('from'), "sin cabecera")
+        timestamp = packet.get('timestamp')
+        if type(timestamp) is not int:
+            return self._reject(packet.get('from'), "sin hora")
+        return self.verify_packet(
+            packet.get('from'), packet_leaf(packet), auth.get('index', -1),
+            auth.get('proof') or [], auth, timestamp
+        )
+
+    def _reject(self, peer, reason):
+        print(f"Paquete firmado de {peer} rechazado: {reason}")
+        with self.lock:
+            self.stats['rejected'] += 1
+        return False
+
+    def get_stats(self):
+        """Firmas verificadas, raíces reutilizadas y paquetes rechazados"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['roots'] = len(self.roots)
+            stats['windows'] = len(self.windows)
+            return stats
@@ -0,0 +1,494 @@
+"""
+Mock de Tor para Desarrollo
+Proxy SOCKS5 local que resuelve direcciones .onion falsas a listeners en
+localhost, con latencia, ancho de banda y pérdida configurables
+"""
+
+import base64
+import itertools
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+
+from config import DEV_CONFIG
+from tor_manager import TorManager
+
+# Respuestas SOCKS5
+SOCKS_SUCCESS = 0
+SOCKS_GENERAL_FAILURE = 1
+SOCKS_HOST_UNREACHABLE = 4
+SOCKS_COMMAND_NOT_SUPPORTED = 7
+SOCKS_ADDRESS_NOT_SUPPORTED = 8
+
+# Puertos locales de los servicios ocultos simulados (bajo el rango efímero)
+SERVICE_PORT_FIRST = 20000
+SERVICE_PORT_LAST = 32000
+
+RELAY_CHUNK_SIZE = 64 * 1024
+RELAY_QUEUE_SIZE = 64  # Chunks en vuelo por sentido antes de frenar al emisor
+
+
+class _Relay:
+    """
+    Un sentido de una conexión
+
+    Un thread lee del origen y calcula cuándo debe llegar cada chunk
+    (ancho de banda + latencia + retransmisión si se "pierde"); otro thread
+    los escribe en el destino en orden, como haría TCP.
+    """
+
+    def __init__(self, network, source, target, on_done):
+        self.network = network
+        self.source = source
+        self.target = target
+        self.on_done = on_done
+
+        self.queue = queue.Queue(RELAY_QUEUE_SIZE)
+        self.free_at = 0.0  # Cuándo termina de "transmitirse" el último chunk
+
+    def start(self):
+        """Iniciar threads de lectura y escritura"""
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _read_loop(self):
+        """Leer del origen y programar la entrega"""
+        try:
+            while True:
+                data = self.source.recv(RELAY_CHUNK_SIZE)
+                if not data:
+                    break
+                self.queue.put((self._deliver_at(len(data)), data))
+        except OSError:
+            pass
+        finally:
+            self.queue.put(None)
+
+    def _write_loop(self):
+        """Entregar chunks al destino cuando les toca"""
+        failed = False
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if failed:
+                continue  # Vaciar la cola hasta que el lector termine
+
+            deliver_at, data = item
+            wait = deliver_at - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                self.target.sendall(data)
+            except OSError:
+                # Destino cerrado: cortar también la lectura del origen
+                failed = True
+                _shutdown(self.source, socket.SHUT_RDWR)
+                continue
+
+            self.network._count('bytes_relayed', len(data))
+
+        if not failed:
+            _shutdown(self.target, socket.SHUT_WR)
+
+        self.on_done()
+
+    def _deliver_at(self, size):
+        """Momento de entrega de un chunk según las condiciones de la red"""
+        network = self.network
+        now = time.time()
+
+        # Ancho de banda: los chunks se transmiten uno tras otro
+        start = max(now, self.free_at)
+        if network.bandwidth:
+            self.free_at = start + size / network.bandwidth
+        else:
+            self.free_at = start
+
+        deliver_at = self.free_at + network.latency
+
+        # Pérdida: el chunk llega tras una retransmisión
+        if network.loss and network.random.random() < network.loss:
+            network._count('chunks_lost')
+            deliver_at += max(0.2, 3 * network.latency)
+
+        return deliver_at
+
+
+class MockTorNetwork:
+    """
+    Red Tor simulada dentro del proceso
+
+    Varias instancias de P2PNetwork con MockTorManager comparten una red:
+    cada una registra su .onion falso y se conectan entre sí a través del
+    proxy SOCKS5 local, con el mismo código de conexión que con Tor real.
+    """
+
+    def __init__(self, latency_ms=0, bandwidth=0, loss=0.0,
+                 connect_failure=0.0, seed=None):
+        """
+        Args:
+            latency_ms: Latencia de un sentido por chunk
+            bandwidth: Bytes/s por sentido de cada conexión (0 = sin límite)
+            loss: Probabilidad de que un chunk requiera retransmisión
+            connect_failure: Probabilidad de que falle un CONNECT (circuito)
+            seed: Semilla para resultados repetibles
+        """
+        self.latency = latency_ms / 1000
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.connect_failure = connect_failure
+        self.random = random.Random(seed)
+
+        self.port = None
+        self.services = {}  # onion -> puerto local
+        self.server_socket = None
+        self.is_running = False
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'connections': 0,
+            'active_connections': 0,
+            'connect_failures': 0,
+            'unknown_onion': 0,
+            'bytes_relayed': 0,
+            'chunks_lost': 0,
+        }
+
+    def start(self, port=0):
+        """
+        Iniciar proxy SOCKS5
+
+        Args:
+            port: Puerto local (0 = elegir uno libre)
+
+        Returns:
+            Puerto del proxy
+        """
+        with self.lock:
+            if self.is_running:
+                return self.port
+
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind(('127.0.0.1', port))
+            self.server_socket.listen(128)
+
+            self.port = self.server_socket.getsockname()[1]
+            self.is_running = True
+
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        """Detener proxy (las conexiones abiertas terminan solas)"""
+        self.is_running = False
+        if self.server_socket:
+            self.server_socket.close()
+
+    def register(self, onion_address, port):
+        """Publicar servicio oculto falso"""
+        with self.lock:
+            self.services[onion_address] = port
+
+    def unregister(self, onion_address):
+        """Retirar servicio oculto (simula peer offline)"""
+        with self.lock:
+            self.services.pop(onion_address, None)
+
+    def set_conditions(self, latency_ms=None, bandwidth=None, loss=None,
+                       connect_failure=None):
+        """Cambiar condiciones de red en caliente"""
+        if latency_ms is not None:
+            self.latency = latency_ms / 1000
+        if bandwidth is not None:
+            self.bandwidth = bandwidth
+        if loss is not None:
+            self.loss = loss
+        if connect_failure is not None:
+            self.connect_failure = connect_failure
+
+    def get_stats(self):
+        """Estadísticas del proxy"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['services'] = len(self.services)
+            return stats
+
+    def _count(self, key, amount=1):
+        """Incrementar contador"""
+        with self.lock:
+            self.stats[key] += amount
+
+    def _accept_loop(self):
+        """Aceptar clientes SOCKS"""
+        while self.is_running:
+            try:
+                client_socket, address = self.server_socket.accept()
+            except OSError:
+                break
+
+            threading.Thread(
+                target=self._handle_client,
+                args=(client_socket,),
+                daemon=True
+            ).start()
+
+    def _handle_client(self, client_socket):
+        """Negociar SOCKS5 y conectar con el servicio destino"""
+        try:
+            client_socket.settimeout(10)
+            onion_address = self._handshake(client_socket)
+            if onion_address is None:
+                client_socket.close()
+                return
+
+            # El establecimiento del circuito cuesta un ida y vuelta
+            if self.latency:
+                time.sleep(2 * self.latency)
+
+            with self.lock:
+                port = self.services.get(onion_address)
+
+            if port is None:
+                self._count('unknown_onion')
+                self._reply(client_socket, SOCKS_HOST_UNREACHABLE)
+                client_socket.close()
+                return
+
+            if self.connect_failure and self.random.random() < self.connect_failure:
+                self._count('connect_failures')
+                self._reply(client_socket, SOCKS_GENERAL_FAILURE)
+                client_socket.close()
+                return
+
+            try:
+                service_socket = socket.create_connection(('127.0.0.1', port), 10)
+            except OSError:
+                self._count('unknown_onion')
+                self._reply(client_socket, SOCKS_HOST_UNREACHABLE)
+                client_socket.close()
+                return
+
+            self._reply(client_socket, SOCKS_SUCCESS)
+
+        except (OSError, IndexError, struct.error):
+            client_socket.close()
+            return
+
+        client_socket.settimeout(None)
+        service_socket.settimeout(None)
+
+        # Reenviar cada escritura sin esperar ACKs (Nagle): el tráfico de
+        # control que vuelve por la conexión no debe sumar 40 ms de retraso
+        for sock in (client_socket, service_socket):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._count('connections')
+        self._count('active_connections')
+
+        remaining = [2]
+
+        def relay_done():
+            # Cerrar cuando terminen ambos sentidos
+            with self.lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+                if finished:
+                    self.stats['active_connections'] -= 1
+            if finished:
+                client_socket.close()
+                service_socket.close()
+
+        _Relay(self, client_socket, service_socket, relay_done).start()
+        _Relay(self, service_socket, client_socket, relay_done).start()
+
+    def _handshake(self, client_socket):
+        """
+        Negociación SOCKS5 (sin autenticación, CONNECT por dominio)
+
+        Returns:
+            Dirección .onion solicitada o None si la solicitud no es válida
+        """
+        version, method_count = _recv_exact(client_socket, 2)
+        _recv_exact(client_socket, method_count)
+
+        if version != 5:
+            return None
+        client_socket.sendall(b'\x05\x00')
+
+        version, command, _, address_type = _recv_exact(client_socket, 4)
+
+        if command != 1:
+            self._reply(client_socket, SOCKS_COMMAND_NOT_SUPPORTED)
+            return None
+
+        if address_type != 3:
+            # Tor solo acepta .onion por nombre
+            self._reply(client_socket, SOCKS_ADDRESS_NOT_SUPPORTED)
+            return None
+
+        length = _recv_exact(client_socket, 1)[0]
+        host = _recv_exact(client_socket, length).decode('idna')
+        _recv_exact(client_socket, 2)  # Puerto virtual (se ignora)
+
+        return host
+
+    @staticmethod
+    def _reply(client_socket, code):
+        """Respuesta SOCKS5 con dirección enlazada vacía"""
+        client_socket.sendall(
+            struct.pack('!BBBB', 5, code, 0, 1) + bytes(4) + b'\x00\x00'
+        )
+
+
+class MockTorManager(TorManager):
+    """
+    TorManager sobre MockTorNetwork
+
+    Sin binario tor ni red: start_tor() arranca el proxy local y
+    start_hidden_service() registra un .onion falso. La conexión a peers
+    usa el mismo código SOCKS5 que TorManager.
+    """
+
+    def __init__(self, network=None):
+        super().__init__()
+        self.network = network or get_mock_network()
+        self.hidden_service_port = _free_port()
+
+    def start_tor(self):
+        """Iniciar proxy SOCKS simulado"""
+        self.tor_port = self.network.start()
+        self.is_running = True
+        return True
+
+    def start_hidden_service(self):
+        """Registrar servicio oculto falso"""
+        if not self.is_running:
+            self.start_tor()
+
+        if self.onion_address is None:
+            self.onion_address = generate_onion_address()
+
+        self.network.register(self.onion_address, self.hidden_service_port)
+        print(f"Servicio oculto (mock): {self.onion_address}")
+        return self.onion_address
+
+    def get_tor_ip(self):
+        """Sin IP pública en el mock"""
+        return None
+
+    def renew_circuit(self):
+        """No hay circuitos que renovar"""
+        return True
+
+    def stop(self):
+        """Retirar servicio oculto"""
+        if self.onion_address:
+            self.network.unregister(self.onion_address)
+        self.is_running = False
+
+    def get_bandwidth_stats(self):
+        """Bytes retransmitidos por el proxy (todos los peers)"""
+        stats = self.network.get_stats()
+        return {
+            'read': stats['bytes_relayed'],
+            'written': stats['bytes_relayed']
+        }
+
+
+_default_network = None
+_default_network_lock = threading.Lock()
+_service_ports = itertools.cycle(range(SERVICE_PORT_FIRST, SERVICE_PORT_LAST))
+
+
+def get_mock_network():
+    """Red simulada compartida, configurada con DEV_CONFIG"""
+    global _default_network
+
+    with _default_network_lock:
+        if _default_network is None:
+            _default_network = MockTorNetwork(
+                latency_ms=DEV_CONFIG['mock_tor_latency_ms'],
+                bandwidth=DEV_CONFIG['mock_tor_bandwidth'],
+                loss=DEV_CONFIG['mock_tor_loss'],
+                connect_failure=DEV_CONFIG['mock_tor_connect_failure'],
+                seed=DEV_CONFIG['mock_tor_seed']
+            )
+        return _default_network
+
+
+def generate_onion_address():
+    """Dirección con formato v3 (56 caracteres base32), sin clave detrás"""
+    raw = base64.b32encode(os.urandom(35)).decode('ascii').lower()
+    return f"{raw}.onion"
+
+
+def _free_port():
+    """
+    Puerto TCP libre en localhost para un servicio oculto
+
+    Se elige fuera del rango efímero: un puerto efímero liberado aquí
+    podría tomarlo una conexión saliente antes de que el peer lo abra.
+    """
+    for _ in range(SERVICE_PORT_LAST - SERVICE_PORT_FIRST):
+        port = next(_service_ports)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind(('127.0.0.1', port))
+            return port
+        except OSError:
+            continue
+        finally:
+            sock.close()
+
+    raise OSError("No hay puertos libres para servicios simulados")
+
+
+def _shutdown(sock, how):
+    """shutdown() ignorando sockets ya cerrados"""
+    try:
+        sock.shutdown(how)
+    except OSError:
+        pass
+
+
+def _recv_exact(sock, size):
+    """Leer exactamente size bytes"""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError("Conexión cerrada durante el handshake")
+        data += chunk
+    return data
+
+
+if __name__ == '__main__':
+    # Proxy independiente para varios procesos en la misma máquina:
+    #   python mock_tor.py 9050 peer1.onion=10001 peer2.onion=10002
+    import sys
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9050
+    network = get_mock_network()
+
+    for mapping in sys.argv[2:]:
+        onion, service_port = mapping.split('=')
+        network.register(onion, int(service_port))
+
+    network.start(port)
+    print(f"Proxy SOCKS5 simulado en puerto {network.port}")
+    print(f"Servicios: {network.services}")
+
+    try:
+        while True:
+            time.sleep(5)
+            print(network.get_stats())
+    except KeyboardInterrupt:
+        network.stop()
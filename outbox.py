@@ -0,0 +1,468 @@
+"""
+Outbox Persistente
+Paquetes salientes guardados en disco hasta que el peer los recibe
+"""
+
+import itertools
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+from packet_codec import CodecError, decode_packet, encode_packet
+
+
+class OutboxEntry:
+    """Paquete guardado en el outbox"""
+
+    __slots__ = ('onion_address', 'path', 'priority', 'created_at', 'size',
+                 'attempts', 'failures', 'queued', 'ack_id', 'sent_at')
+
+    def __init__(self, onion_address, path, priority, created_at, size, ack_id=None):
+        self.onion_address = onion_address
+        self.path = path
+        self.priority = priority
+        self.created_at = created_at
+        self.size = size
+        self.attempts = 0
+        self.failures = 0  # Envíos en los que iba el paquete y fallaron
+
+        # En la cola de envío (no volver a cargarlo desde disco)
+        self.queued = False
+
+        # ID que el receptor confirma con un 'ack' (None: se borra al
+        # escribirlo en la conexión) y hora del envío que espera el acuse
+        self.ack_id = ack_id
+        self.sent_at = None
+
+
+class Outbox:
+    """
+    Outbox en disco con reintentos por peer
+
+    Cada paquete se guarda en un archivo (con fsync del archivo y del
+    directorio) antes de enviarse. Los que tienen ack_id se borran cuando
+    el receptor confirma haberlos procesado; si el acuse no llega en
+    ack_timeout se reenvían (el receptor descarta el duplicado y vuelve a
+    confirmar). El resto se borra cuando el frame que lo contiene se
+    escribió en la conexión. Si el envío falla,
+    el peer entra en backoff exponencial con jitter: los paquetes nuevos solo
+    se guardan y, al vencer el backoff (o al recibir tráfico del peer), se
+    cargan todos juntos en la cola de envío.
+
+    Un paquete se descarta al expirar (max_age) o tras max_retries
+    reintentos fallidos (o sin acuse); los intentos se cuentan en memoria,
+    por sesión.
+
+    Estructura: <directorio>/<onion>/<timestamp ms>-<secuencia>.pkt
+    """
+
+    def __init__(self, directory=None, max_bytes=64 * 1024 * 1024,
+                 max_age=7 * 24 * 3600, retry_delay=5, max_backoff=600,
+                 max_retries=None, ack_timeout=30):
+        """
+        Args:
+            directory: Directorio del outbox (por defecto ~/.deepchat/outbox)
+            max_bytes: Tamaño máximo total; si se supera no se persiste más
+            max_age: Segundos tras los cuales un paquete no enviado expira
+            retry_delay: Espera base tras el primer fallo
+            max_backoff: Espera máxima entre reintentos
+            max_retries: Reintentos fallidos por paquete (None: sin límite)
+            ack_timeout: Segundos de espera del acuse antes de reenviar
+        """
+        if directory is None:
+            directory = Path.home() / '.deepchat' / 'outbox'
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.ack_timeout = ack_timeout
+
+        self.entries = {}  # onion -> {nombre de archivo: OutboxEntry}
+        self.unacked = {}  # (onion, ack_id) -> OutboxEntry enviada sin acuse
+        self.backoff = {}  # onion -> {'failures', 'next_attempt'}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self._sequence = itertools.count()
+
+        self.stats = {
+            'stored': 0,
+            'delivered': 0,
+            'retries': 0,
+            'ack_timeouts': 0,
+            'expired': 0,
+            'abandoned': 0,  # Descartados tras max_retries
+            'rejected': 0,
+        }
+
+        self._load()
+
+    def store(self, onion_address, packet, priority, ack_id=None):
+        """
+        Guardar paquete antes de enviarlo
+
+        Args:
+            onion_address: Dirección .onion del destinatario
+            packet: Paquete a enviar
+            priority: Clase de tráfico (se conserva para el reintento)
+            ack_id: ID que confirmará el receptor (None: sin acuse)
+
+        Returns:
+            OutboxEntry o None si el outbox está lleno. Si el peer está en
+            backoff, la entrada queda en disco sin encolar (queued=False).
+        """
+        if not self._valid_peer(onion_address):
+            return None
+
+        data = bytes((priority,)) + encode_packet(packet)
+
+        with self.lock:
+            if self.total_bytes + len(data) > self.max_bytes:
+                self.stats['rejected'] += 1
+                print(f"Outbox lleno: paquete a {onion_address} sin persistir")
+                return None
+            self.total_bytes += len(data)
+
+        created_at = time.time()
+        name = f"{int(created_at * 1000):013d}-{next(self._sequence):06d}.pkt"
+        peer_dir = self.directory / onion_address
+        path = peer_dir / name
+
+        try:
+            if not peer_dir.is_dir():
+                peer_dir.mkdir(exist_ok=True)
+                self._fsync_dir(self.directory)
+
+            # Escritura atómica y durable: ni un reinicio ni un corte de
+            # luz dejan un archivo a medias o un rename perdido
+            tmp_path = peer_dir / (name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self._fsync_dir(peer_dir)
+
+        except OSError as e:
+            print(f"Error guardando en outbox: {e}")
+            with self.lock:
+                self.total_bytes -= len(data)
+            return None
+
+        entry = OutboxEntry(onion_address, path, priority, created_at, len(data), ack_id)
+
+        with self.lock:
+            self.entries.setdefault(onion_address, {})[name] = entry
+            entry.queued = not self._backing_off(onion_address, time.time())
+            self.stats['stored'] += 1
+
+        return entry
+
+    def sent(self, entry):
+        """
+        El paquete se escribió en la conexión
+
+        Sin ack_id se borra; con ack_id queda en disco hasta acknowledged()
+        o hasta que venza ack_timeout.
+        """
+        if entry.ack_id is None:
+            self.delivered(entry)
+            return
+
+        with self.lock:
+            if entry.path.name not in self.entries.get(entry.onion_address, ()):
+                return
+            entry.sent_at = time.time()
+            self.unacked[(entry.onion_address, entry.ack_id)] = entry
+
+    def acknowledged(self, onion_address, ack_id):
+        """
+        El receptor confirmó el paquete: borrarlo
+
+        Returns:
+            True si había un paquete esperando ese acuse
+        """
+        with self.lock:
+            entry = self.unacked.pop((onion_address, ack_id), None)
+        if entry is None:
+            return False
+
+        self.delivered(entry)
+        return True
+
+    def delivered(self, entry):
+        """Borrar paquete entregado"""
+        with self.lock:
+            peer_entries = self.entries.get(entry.onion_address)
+            if not peer_entries or peer_entries.pop(entry.path.name, None) is None:
+                return
+
+            if not peer_entries:
+                del self.entries[entry.onion_address]
+            if entry.ack_id is not None:
+                self.unacked.pop((entry.onion_address, entry.ack_id), None)
+
+            self.total_bytes -= entry.size
+            self.stats['delivered'] += 1
+
+        self._unlink(entry.path)
+
+    def release(self, entry, failed=False):
+        """
+        El paquete no salió: queda en disco para el próximo intento
+
+        Args:
+            entry: Entrada devuelta por store o due
+            failed: Iba en un envío que falló (cuenta para max_retries);
+                False si se devolvió a disco sin intentarlo
+        """
+        with self.lock:
+            entry.queued = False
+            if failed:
+                entry.failures += 1
+
+    def release_all(self):
+        """
+        Al detener la red: todo lo no entregado vuelve a estar pendiente
+
+        Returns:
+            Paquetes que quedan en disco para la próxima sesión
+        """
+        with self.lock:
+            count = 0
+            for peer_entries in self.entries.values():
+                for entry in peer_entries.values():
+                    entry.queued = False
+                    entry.sent_at = None
+                    count += 1
+            self.unacked.clear()
+            return count
+
+    def peer_failed(self, onion_address):
+        """
+        Registrar fallo de conexión y programar el próximo intento
+
+        Returns:
+            Segundos hasta el próximo intento
+        """
+        with self.lock:
+            state = self.backoff.setdefault(
+                onion_address, {'failures': 0, 'next_attempt': 0}
+            )
+            state['failures'] += 1
+
+            delay = min(
+                self.max_backoff,
+                self.retry_delay * 2 ** (state['failures'] - 1)
+            )
+            # Jitter: peers que cayeron juntos no reintentan a la vez
+            delay = random.uniform(delay / 2, delay)
+
+            state['next_attempt'] = time.time() + delay
+            return delay
+
+    def peer_reachable(self, onion_address):
+        """
+        Registrar que el peer respondió (envío exitoso o tráfico entrante)
+
+        Returns:
+            True si el peer estaba en backoff
+        """
+        if onion_address not in self.backoff:
+            return False
+
+        with self.lock:
+            return self.backoff.pop(onion_address, None) is not None
+
+    def is_backing_off(self, onion_address):
+        """El peer falló hace poco y aún no toca reintentar"""
+        with self.lock:
+            return self._backing_off(onion_address, time.time())
+
+    def due(self):
+        """
+        Cargar los paquetes pendientes de peers a los que toca reintentar
+
+        Los paquetes expirados se borran sin enviarse. Los enviados cuyo
+        acuse no llegó en ack_timeout vuelven a enviarse (cuenta como fallo).
+
+        Returns:
+            Lista de tuplas (OutboxEntry, paquete) en orden de creación
+        """
+        now = time.time()
+        ready = []
+        expired = []
+
+        with self.lock:
+            for onion, peer_entries in self.entries.items():
+                if self._backing_off(onion, now):
+                    continue
+
+                for name in sorted(peer_entries):
+                    entry = peer_entries[name]
+                    if entry.queued:
+                        if entry.sent_at is None or now - entry.sent_at < self.ack_timeout:
+                            continue
+                        # Enviado pero sin acuse: el peer no lo procesó
+                        self.unacked.pop((onion, entry.ack_id), None)
+                        entry.sent_at = None
+                        entry.failures += 1
+                        self.stats['ack_timeouts'] += 1
+
+                    if now - entry.created_at > self.max_age:
+                        expired.append(entry)
+                        self.stats['expired'] += 1
+                        continue
+
+                    # El primer envío no es un reintento
+                    if (self.max_retries is not None
+                            and entry.failures > self.max_retries):
+                        expired.append(entry)
+                        self.stats['abandoned'] += 1
+                        continue
+
+                    entry.queued = True
+                    entry.attempts += 1
+                    ready.append(entry)
+
+            for entry in expired:
+                self._forget(entry)
+
+            self.stats['retries'] += len(ready)
+
+        for entry in expired:
+            self._unlink(entry.path)
+
+        items = []
+        for entry in ready:
+            packet = self._read(entry)
+            if packet is None:
+                with self.lock:
+                    self._forget(entry)
+                continue
+            items.append((entry, packet))
+
+        return items
+
+    def get_stats(self):
+        """Tamaño, antigüedad y reintentos del outbox"""
+        now = time.time()
+
+        with self.lock:
+            all_entries = [
+                entry
+                for peer_entries in self.entries.values()
+                for entry in peer_entries.values()
+            ]
+            oldest = min((entry.created_at for entry in all_entries), default=now)
+
+            stats = dict(self.stats)
+            stats.update({
+                'entries': len(all_entries),
+                'awaiting_ack': len(self.unacked),
+                'bytes': self.total_bytes,
+                'oldest_age': round(now - oldest, 1),
+                'peers': {
+                    onion: {
+                        'pending': len(self.entries.get(onion, ())),
+                        'failures': state['failures'],
+                        'next_attempt_in': round(
+                            max(0.0, state['next_attempt'] - now), 1
+                        ),
+                    }
+                    for onion, state in self.backoff.items()
+                },
+            })
+            return stats
+
+    def _backing_off(self, onion_address, now):
+        """Versión sin lock de is_backing_off"""
+        state = self.backoff.get(onion_address)
+        return state is not None and state['next_attempt'] > now
+
+    def _forget(self, entry):
+        """Quitar entrada del índice (llamar con el lock tomado)"""
+        peer_entries = self.entries.get(entry.onion_address)
+        if peer_entries and peer_entries.pop(entry.path.name, None) is not None:
+            self.total_bytes -= entry.size
+            if not peer_entries:
+                del self.entries[entry.onion_address]
+            if entry.ack_id is not None:
+                self.unacked.pop((entry.onion_address, entry.ack_id), None)
+
+    def _read(self, entry):
+        """Leer paquete desde disco"""
+        try:
+            data = entry.path.read_bytes()
+            return decode_packet(data[1:])
+        except (OSError, CodecError) as e:
+            print(f"Paquete del outbox ilegible, descartado: {e}")
+            self._unlink(entry.path)
+            return None
+
+    def _load(self):
+        """Reconstruir el índice con los paquetes que quedaron de la sesión anterior"""
+        for peer_dir in self.directory.iterdir():
+            if not peer_dir.is_dir():
+                continue
+
+            for path in peer_dir.iterdir():
+                if path.suffix == '.tmp':
+                    self._unlink(path)
+                    continue
+
+                try:
+                    created_ms = int(path.name.split('-')[0])
+                    size = path.stat().st_size
+                    with open(path, 'rb') as f:
+                        priority = f.read(1)[0]
+                except (OSError, ValueError, IndexError):
+                    continue
+
+                entry = OutboxEntry(
+                    peer_dir.name, path, priority, created_ms / 1000, size
+                )
+                self.entries.setdefault(peer_dir.name, {})[path.name] = entry
+                self.total_bytes += size
+
+        if self.entries:
+            count = sum(len(peer_entries) for peer_entries in self.entries.values())
+            print(f"Outbox: {count} paquetes pendientes de la sesión anterior")
+
+    @staticmethod
+    def _valid_peer(onion_address):
+        """La dirección sirve como nombre de directorio"""
+        return (
+            bool(onion_address)
+            and not onion_address.startswith('.')
+            and os.sep not in onion_address
+            and '/' not in onion_address
+        )
+
+    @staticmethod
+    def _fsync_dir(path):
+        """Persistir las entradas de un directorio (creaciones y renames)"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return  # Sistemas sin fsync de directorios (Windows)
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _unlink(path):
+        """Borrar archivo ignorando si ya no existe"""
+        try:
+            path.unlink()
+        except OSError:
+            pass
@@ -3,36 +3,217 @@ Módulo de Red P2P
 Comunicación peer-to-peer a través de Tor
 """
 
+import base64
 import socket
 import json
 import threading
 import queue
 import time
-from datetime import datetime
+
+from admission import AdmissionControl
+from compression import (
+    METHODS as COMPRESSION_METHODS, CompressionError, PayloadCompressor,
+    choose_method
+)
+from config import NETWORK_CONFIG, SECURITY_CONFIG
+from connection_pool import ConnectionPool
+from dedup_cache import DedupCache
+from merkle_auth import RootVerifier, WindowSigner, packet_leaf
+from outbox import Outbox
+from secure_session import SessionManager
+from send_scheduler import (
+    SendScheduler, PRIORITY_CONTROL, PRIORITY_CHAT, PRIORITY_BULK, PRIORITY_MEDIA
+)
+from stream_mux import (
+    ReceiveWindows, SendWindows, decode_hello, encode_hello, priority_for,
+    stream_for
+)
+from wire_protocol import (
+    FrameReader, FrameError, FRAME_PACKET, FRAME_BINARY, FRAME_HELLO,
+    FRAME_WINDOW_UPDATE, FLAG_COMPRESSED, HEADER_SIZE, decode_window_update, encode_frame,
+    encode_stream_frame, encode_window_update, split_stream
+)
+from packet_codec import (
+    CodecError, decode_packet, encode_batch, encode_packet, json_default, now_ms
+)
+from utils import NetworkMonitor
+
+
+# Clase de tráfico por defecto según el tipo de paquete
+PACKET_PRIORITIES = {
+    'key_request': PRIORITY_CONTROL,
+    'ack': PRIORITY_CONTROL,
+    'key_response': PRIORITY_CONTROL,
+    'session_init': PRIORITY_CONTROL,
+    'session_accept': PRIORITY_CONTROL,
+    'call_request': PRIORITY_CONTROL,
+    'call_accept': PRIORITY_CONTROL,
+    'call_reject': PRIORITY_CONTROL,
+    'typing': PRIORITY_CONTROL,
+    'read_receipt': PRIORITY_CONTROL,
+    'message': PRIORITY_CHAT,
+    'session_message': PRIORITY_CHAT,
+    'video_frame': PRIORITY_MEDIA,
+}
+
+# Tipos cuyo 'message_id' identifica al propio paquete (en otros, como los
+# acuses de lectura, se refiere a otro mensaje)
+DEDUP_TYPES = ('message', 'group_packet', 'session_message')
+
+# Tipos que el emisor firma por ventanas (WindowSigner)
+SIGNED_TYPES = ('video_frame',)
+
+# Tipos desconocidos con contador propio en las estadísticas (el resto, 'other')
+MAX_UNKNOWN_TYPES = 32
 
 
 class P2PNetwork:
     """Gestor de red peer-to-peer"""
     
-    def __init__(self, tor_manager, crypto_manager):
+    def __init__(self, tor_manager, crypto_manager, outbox_dir=None):
         self.tor_manager = tor_manager
         self.crypto_manager = crypto_manager
         
         self.incoming_queue = queue.Queue()
-        self.outgoing_queue = queue.Queue()
+        
+        # Una cola saliente por destinatario: un peer lento solo se
+        # retrasa a sí mismo
+        self.scheduler = SendScheduler(burst=NETWORK_CONFIG['sender_burst'])
         
         self.listener_thread = None
-        self.sender_thread = None
+        self.listener_socket = None
+        self.sender_threads = []
+        self.outbox_thread = None
         
         self.is_running = False
+        self.accepting = False
+        self.stopped = threading.Event()  # Despierta los loops con espera
         self.connections = {}
+        
+        # Conexiones entrantes (socket -> FrameReader), para drenarlas al
+        # detener, y peers activos al detener, para reconectar al reiniciar
+        self._inbound_readers = {}
+        self._recent_peers = []
+        
+        # Formato de serialización saliente ('binary' o 'json' para peers
+        # antiguos); al recibir se aceptan ambos
+        self.wire_format = NETWORK_CONFIG['wire_format']
+        
+        self.stats = {
+            'batches_sent': 0,
+            'packets_coalesced': 0,
+            'unknown_packets': 0,
+            'events_dropped': 0,
+            'dropped_offline': 0,
+            'drain_dropped': 0,  # Efímeros sin enviar al detener
+            'drain_persisted': 0,  # Pendientes en el outbox tras el último stop
+        }
+        self.unknown_types = {}
+        self.stats_lock = threading.Lock()
+        
+        # Contadores por tipo, histogramas de latencia y errores por causa
+        self.monitor = NetworkMonitor()
+        
+        # Límite de conexiones entrantes y tasa por remitente
+        self.admission = AdmissionControl(
+            max_inbound=NETWORK_CONFIG['max_inbound_connections'],
+            packet_rate=NETWORK_CONFIG['rate_limit_packets'],
+            packet_burst=NETWORK_CONFIG['rate_limit_packets_burst'],
+            byte_rate=NETWORK_CONFIG['rate_limit_bytes'],
+            byte_burst=NETWORK_CONFIG['rate_limit_bytes_burst']
+        )
+        
+        # IDs ya recibidos: los reintentos del outbox o de una reconexión
+        # se descartan antes de descifrar
+        self.dedup = DedupCache(
+            capacity=NETWORK_CONFIG['dedup_capacity'],
+            window=NETWORK_CONFIG['dedup_window'],
+            expected=NETWORK_CONFIG['dedup_expected']
+        )
+        
+        # Compresión de frames de datos, si el peer la acepta en el HELLO
+        self.compressor = PayloadCompressor(
+            level=NETWORK_CONFIG['compression_level'],
+            threshold=NETWORK_CONFIG['compression_threshold']
+        )
+        
+        # Frames de media firmados por ventanas (una firma ECDSA por ventana)
+        # y verificación de paquetes firmados, compartida con los gestores
+        self.media_signer = None
+        if SECURITY_CONFIG['sign_media']:
+            self.media_signer = WindowSigner(
+                crypto_manager,
+                window=SECURITY_CONFIG['media_sign_window_ms'] / 1000,
+                max_packets=SECURITY_CONFIG['media_sign_max_packets'],
+                send=self._send_signed_media
+            )
+        # Claves de identidad de los peers, fijadas solo por el usuario
+        # (trust_peer_key); con ellas se autentican los handshakes de sesión
+        # y se verifican los paquetes firmados
+        self.peer_keys = {}
+        self.packet_auth = RootVerifier(
+            crypto_manager, peer_keys=self.peer_keys,
+            on_unknown_peer=self._request_session
+        )
+        
+        # Stream cifrado de media por peer, con clave de la sesión ECDH:
+        # [StreamCipher, próximo índice, session_id]
+        self.media_streams = {}
+        self.media_lock = threading.Lock()
+        
+        # Tabla de despacho por tipo de paquete y suscriptores de eventos;
+        # otros módulos (archivos, grupos, llamadas) registran sus handlers
+        self.handlers = {}
+        self.subscribers = ()
+        self.queue_callbacks = {}
+        self.handlers_lock = threading.Lock()
+        self._register_default_handlers()
+        
+        # Sesiones ECDH por peer ('session_init', 'session_accept',
+        # 'session_message'); comparten las claves fijadas
+        self.session_manager = SessionManager(
+            self, crypto_manager, peer_keys=self.peer_keys,
+            on_key_offered=self._on_key_offered
+        )
+        crypto_manager.add_lock_listener(self._forget_media_streams)
+        
+        # Sockets persistentes por peer (se registran en self.connections);
+        # todas las clases de tráfico comparten la conexión como streams
+        self.pool = ConnectionPool(
+            tor_manager,
+            max_connections=NETWORK_CONFIG['pool_max_connections'],
+            idle_timeout=NETWORK_CONFIG['pool_idle_timeout'],
+            connections=self.connections,
+            on_connect=self._on_connect
+        )
+        
+        # Paquetes persistidos hasta que el peer los recibe
+        self.outbox = Outbox(
+            outbox_dir,
+            max_bytes=NETWORK_CONFIG['outbox_max_bytes'],
+            max_age=NETWORK_CONFIG['outbox_max_age'],
+            retry_delay=NETWORK_CONFIG['retry_delay'],
+            max_backoff=NETWORK_CONFIG['outbox_max_backoff'],
+            max_retries=NETWORK_CONFIG['max_retries'],
+            ack_timeout=NETWORK_CONFIG['outbox_ack_timeout']
+        )
     
     def start(self):
         """Iniciar red P2P"""
         if self.is_running:
             return
         
+        # El puerto se abre aquí y no en el thread: al volver de start()
+        # ya se aceptan conexiones
+        try:
+            self.listener_socket = self._bind_listener()
+        except OSError as e:
+            print(f"Error en listener: {e}")
+            return
+        
         self.is_running = True
+        self.accepting = True
+        self.stopped.clear()
         
         # Iniciar listener para mensajes entrantes
         self.listener_thread = threading.Thread(
@@ -41,64 +222,291 @@ class P2PNetwork:
         )
         self.listener_thread.start()
         
-        # Iniciar sender para mensajes salientes
-        self.sender_thread = threading.Thread(
-            target=self._sender_loop,
-            daemon=True
-        )
-        self.sender_thread.start()
+        # Iniciar pool acotado de senders para mensajes salientes
+        self.sender_threads = []
+        for _ in range(NETWORK_CONFIG['sender_workers']):
+            sender = threading.Thread(target=self._sender_loop, daemon=True)
+            sender.start()
+            self.sender_threads.append(sender)
+        
+        # Reintentos del outbox (incluye lo pendiente de la sesión anterior)
+        self.outbox_thread = threading.Thread(target=self._outbox_loop, daemon=True)
+        self.outbox_thread.start()
+        
+        self._reconnect_recent()
         
         print("Red P2P iniciada")
     
-    def stop(self):
-        """Detener red P2P"""
+    def stop(self, drain_timeout=None):
+        """
+        Detener red P2P ordenadamente
+        
+        Deja de aceptar conexiones en el acto, envía lo que ya estaba en
+        cola y termina de leer los frames a medio recibir, todo dentro de
+        `drain_timeout`. Lo que no salió queda en el outbox para el próximo
+        start (las señales efímeras y los frames de media se descartan).
+        
+        Args:
+            drain_timeout: Segundos máximos de drenado (por defecto
+                NETWORK_CONFIG['drain_timeout']; 0 = detener ya)
+        """
+        if not self.is_running:
+            return
+        
+        if drain_timeout is None:
+            drain_timeout = NETWORK_CONFIG['drain_timeout']
+        deadline = time.time() + drain_timeout
+        
+        # No aceptar más conexiones (el listener despierta sin esperar)
+        self._close_listener()
+        
+        # Frames esperando firma: a la cola, con su deadline
+        if self.media_signer is not None:
+            self.media_signer.flush()
+        
+        # Enviar lo encolado y terminar los frames entrantes en curso
+        while not self.scheduler.idle() and time.time() < deadline:
+            time.sleep(0.01)
+        self._drain_inbound(deadline)
+        
+        self._recent_peers = list(self.connections)
+        
         self.is_running = False
+        self.stopped.set()
+        self.scheduler.wake_all()
+        
+        # Cerrar todas las conexiones del pool
+        self.pool.close_all()
+        
+        for thread in [self.listener_thread, self.outbox_thread] + self.sender_threads:
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(timeout=1.0)
+        
+        self._requeue_pending()
+        self._close_crypto_workers()
+        print("Red P2P detenida")
+    
+    def _close_crypto_workers(self):
+        """Terminar los procesos de verificación de firmas, si se crearon"""
+        close = getattr(self.crypto_manager, 'close_verify_pool', None)
+        if close is not None:
+            close()
+    
+    def _bind_listener(self):
+        """Abrir el socket del servicio oculto"""
+        listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener_socket.bind(('127.0.0.1', self.tor_manager.hidden_service_port))
+        listener_socket.listen(10)
+        return listener_socket
+    
+    def _close_listener(self):
+        """Cerrar el listener despertando al thread bloqueado en accept"""
+        self.accepting = False
+        listener_socket = self.listener_socket
+        if listener_socket is None:
+            return
         
-        # Cerrar todas las conexiones
-        for conn in self.connections.values():
+        try:
+            listener_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Donde shutdown no despierta a accept: conectarse a sí mismo
             try:
-                conn.close()
-            except:
+                socket.create_connection(listener_socket.getsockname(), timeout=0.5).close()
+            except OSError:
                 pass
         
-        self.connections.clear()
-        print("Red P2P detenida")
+        listener_socket.close()
     
-    def send_message(self, recipient_onion, encrypted_data):
+    def _drain_inbound(self, deadline):
         """
-        Enviar mensaje encriptado a un peer
+        Dejar terminar los frames entrantes recibidos a medias y cerrar
+        las conexiones entrantes
+        """
+        while time.time() < deadline:
+            if not any(reader.mid_frame for reader in list(self._inbound_readers.values())):
+                break
+            time.sleep(0.01)
+        
+        # Despertar a los threads bloqueados en recv
+        for client_socket in list(self._inbound_readers):
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def _requeue_pending(self):
+        """
+        Vaciar las colas al detener: lo persistido vuelve a quedar pendiente
+        en el outbox y lo efímero se descarta
+        """
+        dropped = 0
+        for onion in list(self.scheduler.peers):
+            peer = self.scheduler.get_peer(onion)
+            dropped += sum(1 for _, entry in self.scheduler.drain(peer) if entry is None)
+        
+        persisted = self.outbox.release_all()
+        
+        with self.stats_lock:
+            self.stats['drain_dropped'] += dropped
+            self.stats['drain_persisted'] = persisted
+    
+    def _reconnect_recent(self):
+        """Reabrir en segundo plano las conexiones activas antes del stop"""
+        peers, self._recent_peers = self._recent_peers, []
+        
+        def reconnect():
+            for onion in peers:
+                if not self.is_running:
+                    return
+                conn = self.pool.acquire(onion)
+                if conn is not None:
+                    self.pool.release(conn)
+        
+        if peers:
+            threading.Thread(target=reconnect, daemon=True).start()
+    
+    def send_text(self, recipient_onion, text):
+        """
+        Enviar mensaje de chat a un peer
+        
+        Se cifra con la sesión ECDH del peer ('session_message'); sin
+        sesión el texto espera al handshake.
         
         Args:
             recipient_onion: Dirección .onion del destinatario
-            encrypted_data: Datos ya encriptados (string JSON)
+            text: Mensaje en claro
+            
+        Returns:
+            True si el mensaje quedó encolado o en espera de la sesión
         """
-        message_packet = {
-            'type': 'message',
-            'from': self.tor_manager.onion_address,
-            'to': recipient_onion,
-            'timestamp': datetime.now().isoformat(),
-            'data': encrypted_data
-        }
+        self.session_manager.send_text(recipient_onion, text)
+        return True
+    
+    def send_packet(self, recipient_onion, packet, priority=None, deadline=None):
+        """
+        Enviar paquete de otro módulo (archivos, grupos...) a un peer
+        
+        Los campos bytes viajan en binario crudo, sin base64.
         
-        # Agregar a cola de salida
-        self.outgoing_queue.put((recipient_onion, message_packet))
+        Args:
+            recipient_onion: Dirección .onion del destinatario
+            packet: Diccionario con al menos 'type'
+            priority: Clase de tráfico; por defecto según el tipo de paquete
+            deadline: time.time() tras el cual se descarta sin enviar
+            
+        Returns:
+            True si el paquete quedó encolado
+        """
+        packet.setdefault('from', self.tor_manager.onion_address)
+        packet.setdefault('timestamp', now_ms())
+        
+        self._enqueue(recipient_onion, packet, priority, deadline)
+        return True
     
     def send_video_frame(self, recipient_onion, frame_data):
         """
         Enviar frame de video
         
+        El frame se cifra con el stream de media del peer (clave derivada de
+        la sesión ECDH): un nonce por número de frame y bytes crudos, sin
+        base64. Sin sesión el frame se descarta mientras se negocia.
+        
         Args:
             recipient_onion: Dirección .onion del destinatario
-            frame_data: Frame de video encriptado
+            frame_data: Frame de video codificado (bytes)
         """
+        cipher, index, session_id = self._media_stream(recipient_onion)
+        if cipher is None:
+            return
+        
+        started = time.perf_counter()
+        encrypted = cipher.encrypt(index, frame_data)
+        self.monitor.observe('encrypt', time.perf_counter() - started)
+        
         packet = {
             'type': 'video_frame',
             'from': self.tor_manager.onion_address,
-            'timestamp': datetime.now().isoformat(),
-            'data': frame_data
+            'timestamp': now_ms(),
+            'data': encrypted,
+            'stream': dict(cipher.header(), index=index, session_id=session_id)
         }
         
-        self.outgoing_queue.put((recipient_onion, packet))
+        # Un frame que no sale a tiempo ya no sirve: se descarta en cola
+        # (la espera de la ventana de firma cuenta dentro del deadline)
+        deadline = time.time() + NETWORK_CONFIG['media_deadline_ms'] / 1000
+        
+        if self.media_signer is not None:
+            self.media_signer.submit(packet_leaf(packet), packet, recipient_onion, deadline)
+        else:
+            self._enqueue(recipient_onion, packet, PRIORITY_MEDIA, deadline)
+    
+    def _media_stream(self, recipient_onion):
+        """
+        Stream de media del peer y el índice del próximo frame
+        
+        Una sesión nueva (renovación o handshake) abre un stream nuevo.
+        
+        Returns:
+            Tupla (StreamCipher, índice, session_id), o (None, None, None)
+            sin sesión con el peer (el handshake queda iniciado)
+        """
+        session = self.session_manager.stream_secret(recipient_onion)
+        if session is None:
+            return None, None, None
+        session_id, secret = session
+        
+        with self.media_lock:
+            stream = self.media_streams.get(recipient_onion)
+            if stream is None or stream[2] != session_id:
+                stream = [self.crypto_manager.encrypt_stream(secret), 0, session_id]
+                self.media_streams[recipient_onion] = stream
+            
+            index = stream[1]
+            stream[1] += 1
+            return stream[0], index, session_id
+    
+    def _open_stream_payload(self, message):
+        """
+        Descifrar 'data' de un paquete cifrado por stream (frames de media)
+        
+        Se hace una vez antes de los handlers: todos reciben el frame en claro.
+        
+        Returns:
+            False si no se pudo descifrar
+        """
+        header = message.pop('stream')
+        data = message.get('data') or b''
+        
+        secret = self.session_manager.receive_secret(message.get('from'), header.get('session_id'))
+        if secret is None:
+            print(f"{message.get('type')} de {message.get('from')} sin sesión conocida")
+            self._request_session(message.get('from'))
+            return False
+        
+        # Peers en formato JSON envían los bytes en base64
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        
+        started = time.perf_counter()
+        try:
+            cipher = self.crypto_manager.decrypt_stream(header, secret)
+            message['data'] = cipher.decrypt(int(header['index']), data)
+        except Exception as e:
+            print(f"Error descifrando {message.get('type')} de {message.get('from')}: {e}")
+            return False
+        
+        self.monitor.observe('decrypt', time.perf_counter() - started)
+        return True
+    
+    def _forget_media_streams(self):
+        """Bloqueo de la app: olvidar los streams de media"""
+        with self.media_lock:
+            self.media_streams.clear()
+    
+    def _send_signed_media(self, packet, recipient_onion, deadline):
+        """Encolar un frame de una ventana ya firmada"""
+        self._enqueue(recipient_onion, packet, PRIORITY_MEDIA, deadline)
     
     def request_public_key(self, peer_onion):
         """
@@ -110,10 +518,10 @@ class P2PNetwork:
         request = {
             'type': 'key_request',
             'from': self.tor_manager.onion_address,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_ms()
         }
         
-        self.outgoing_queue.put((peer_onion, request))
+        self._enqueue(peer_onion, request)
     
     def send_public_key(self, peer_onion):
         """
@@ -125,27 +533,77 @@ class P2PNetwork:
         response = {
             'type': 'key_response',
             'from': self.tor_manager.onion_address,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': now_ms(),
             'public_key': self.crypto_manager.export_public_key()
         }
         
-        self.outgoing_queue.put((peer_onion, response))
+        self._enqueue(peer_onion, response)
+    
+    def trust_peer_key(self, peer_onion, public_key):
+        """
+        Fijar la clave de identidad de un peer, confirmada por el usuario
+        
+        Reemplaza la anterior: las sesiones y el stream de media negociados
+        con ella se descartan.
+        
+        Args:
+            peer_onion: Dirección .onion del peer
+            public_key: Clave pública (hex) de un evento 'public_key' o
+                'peer_key_offered'
+        """
+        self.peer_keys[peer_onion] = public_key
+        with self.media_lock:
+            self.media_streams.pop(peer_onion, None)
+        self.session_manager.forget_peer(peer_onion)
+    
+    def _enqueue(self, recipient_onion, packet, priority=None, deadline=None):
+        """
+        Encolar paquete para envío (punto único para todos los envíos)
+        
+        Args:
+            recipient_onion: Dirección .onion del destinatario
+            packet: Diccionario con datos a enviar
+            priority: Clase de tráfico; por defecto según el tipo de paquete
+            deadline: time.time() tras el cual se descarta sin enviar
+        """
+        if priority is None:
+            priority = PACKET_PRIORITIES.get(packet.get('type'), PRIORITY_CHAT)
+        
+        entry = None
+        
+        if deadline is None and priority != PRIORITY_BULK:
+            # Persistir antes de enviar: sobrevive a reinicios y peers offline.
+            # Los chunks de archivos no: la transferencia entera ocuparía el
+            # outbox y se escribiría dos veces a disco
+            entry = self.outbox.store(recipient_onion, packet, priority, _ack_id(packet))
+            
+            if entry is not None and not entry.queued:
+                # Peer en backoff: sale con el próximo reintento
+                return
+        
+        if entry is None and self.outbox.is_backing_off(recipient_onion):
+            # Sin copia en disco no tiene sentido esperar al peer
+            with self.stats_lock:
+                self.stats['dropped_offline'] += 1
+            return
+        
+        self.scheduler.put(recipient_onion, packet, priority, deadline, entry)
     
     def _listener_loop(self):
         """Loop para recibir mensajes entrantes"""
-        # Crear listener en el puerto del servicio oculto
-        listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listener_socket.bind(('127.0.0.1', self.tor_manager.hidden_service_port))
-        listener_socket.listen(10)
-        listener_socket.settimeout(1.0)
+        listener_socket = self.listener_socket
         
         print(f"Escuchando en puerto {self.tor_manager.hidden_service_port}")
         
-        while self.is_running:
+        while self.accepting:
             try:
                 client_socket, address = listener_socket.accept()
                 
+                # Sin lugar: cerrar antes de gastar un thread en ella
+                if not self.accepting or not self.admission.open_connection():
+                    client_socket.close()
+                    continue
+                
                 # Manejar conexión en thread separado
                 threading.Thread(
                     target=self._handle_incoming_connection,
@@ -153,173 +611,840 @@ class P2PNetwork:
                     daemon=True
                 ).start()
                 
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.is_running:
+            except OSError as e:
+                # stop() cerró el socket para despertar a accept
+                if self.accepting:
                     print(f"Error en listener: {e}")
-        
-        listener_socket.close()
+                    time.sleep(0.1)
     
     def _handle_incoming_connection(self, client_socket):
-        """Manejar conexión entrante"""
+        """Manejar conexión entrante (puede traer varios mensajes)"""
+        # El emisor mantiene la conexión abierta entre paquetes
+        client_socket.settimeout(NETWORK_CONFIG['pool_idle_timeout'])
+        _set_nodelay(client_socket)
+        
+        reader = FrameReader(
+            client_socket,
+            max_frame_size=NETWORK_CONFIG['max_frame_size']
+        )
+        receive_windows = ReceiveWindows(NETWORK_CONFIG['stream_window'])
+        self._inbound_readers[client_socket] = reader
+        
         try:
-            # Recibir datos
-            data = b""
-            
-            while True:
-                chunk = client_socket.recv(4096)
-                if not chunk:
+            while self.is_running:
+                frame = reader.read_frame()
+                if frame is None:
                     break
-                data += chunk
                 
-                # Buscar delimitador de fin de mensaje
-                if b"\n\n" in data:
-                    break
-            
-            if data:
-                # Parsear mensaje
-                message = json.loads(data.decode('utf-8').strip())
+                frame_type, flags, payload = frame
+                
+                # Conexión por encima de su tasa de bytes: dejar de leer
+                # la conexión frena al emisor
+                delay = self._admit(frame_type, payload, receive_windows)
+                if delay:
+                    time.sleep(delay)
                 
-                # Procesar según tipo
-                self._process_incoming_message(message)
+                reply = self._receive_frame(
+                    frame_type, flags, payload, receive_windows,
+                    process=delay is not None
+                )
+                if reply:
+                    client_socket.sendall(reply)
             
-        except json.JSONDecodeError as e:
-            print(f"Error parseando mensaje: {e}")
+        except socket.timeout:
+            pass
+        except FrameError as e:
+            print(f"Frame inválido, cerrando conexión: {e}")
+            self.monitor.record_error('frame_invalid')
         except Exception as e:
             print(f"Error manejando conexión entrante: {e}")
         finally:
+            self._inbound_readers.pop(client_socket, None)
             client_socket.close()
+            self.admission.close_connection()
     
-    def _process_incoming_message(self, message):
-        """Procesar mensaje entrante según su tipo"""
-        msg_type = message.get('type')
-        sender = message.get('from')
+    def _admit(self, frame_type, payload, receive_windows):
+        """
+        Aplicar la tasa de la conexión a un frame entrante (HELLO incluido)
+        
+        Los baldes son de la conexión: la dirección del HELLO la elige el
+        peer y no identifica a nadie.
         
-        print(f"Mensaje recibido de {sender}: tipo={msg_type}")
+        Returns:
+            Segundos a esperar antes de procesarlo, o None si se descarta
+        """
+        if receive_windows.buckets is None:
+            receive_windows.buckets = self.admission.connection_buckets()
+        return self.admission.admit(receive_windows.buckets, HEADER_SIZE + len(payload))
+    
+    def _receive_frame(self, frame_type, flags, payload, receive_windows, process=True):
+        """
+        Procesar un frame de una conexión entrante
         
-        if msg_type == 'message':
-            # Mensaje de chat encriptado
-            encrypted_data = message.get('data')
+        Args:
+            receive_windows: ReceiveWindows de la conexión
+            process: False si la admisión lo descartó (solo cuenta crédito)
             
-            # Intentar desencriptar
+        Returns:
+            Frame a devolver al emisor (HELLO, WINDOW_UPDATE) o None
+        """
+        if frame_type == FRAME_HELLO:
+            # Uno por conexión; los siguientes (o los que la tasa descartó)
+            # no se responden
+            if not process or receive_windows.peer is not None:
+                self.monitor.record_error('hello_rejected')
+                return None
+            hello = decode_hello(payload)
+            receive_windows.peer = hello.get('from')
+            if NETWORK_CONFIG['compression']:
+                receive_windows.compression = choose_method(hello.get('compression'))
+            print(f"Conexión multiplexada desde {hello.get('from')}")
+            return encode_hello(
+                self.tor_manager.onion_address, receive_windows.window,
+                compression=receive_windows.compression
+            )
+        
+        stream_id, data = split_stream(flags, payload)
+        
+        # Un frame descartado devuelve crédito igual: el stream no debe
+        # quedar frenado
+        if process:
+            if flags & FLAG_COMPRESSED:
+                data = self._decompress(data, receive_windows.compression)
+            self._process_frame(frame_type, data)
+        
+        if stream_id is None:
+            return None
+        
+        # Crédito devuelto tras procesar: si los handlers van lentos, el
+        # emisor frena en vez de acumular frames en Tor
+        increment = receive_windows.consume(stream_id, HEADER_SIZE + len(payload))
+        if increment:
+            return encode_window_update(stream_id, increment)
+        return None
+    
+    def _decompress(self, data, method):
+        """Descomprimir el paquete de un frame (error: cerrar la conexión)"""
+        try:
+            return self.compressor.decompress(
+                data, method, NETWORK_CONFIG['max_frame_size']
+            )
+        except CompressionError as e:
+            raise FrameError(str(e))
+    
+    def _process_frame(self, frame_type, payload):
+        """
+        Deserializar y procesar el paquete de un frame recibido
+        
+        Args:
+            frame_type: FRAME_BINARY o FRAME_PACKET
+            payload: memoryview del frame, válido solo durante la llamada
+        """
+        started = time.perf_counter()
+        
+        try:
+            if frame_type == FRAME_BINARY:
+                # Campos binarios como vistas del frame: los chunks llegan
+                # a disco y los tokens al descifrado sin copias intermedias
+                message = decode_packet(payload, copy=False)
+            elif frame_type == FRAME_PACKET:
+                # Formato JSON: peers en la ventana de compatibilidad
+                message = json.loads(str(payload, 'utf-8'))
+            else:
+                print(f"Tipo de frame desconocido: {frame_type}")
+                self.monitor.record_error('frame_unknown')
+                return
+        except (CodecError, json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"Error parseando mensaje: {e}")
+            self.monitor.record_error('decode_failed')
+            return
+        
+        self.monitor.observe('deserialize', time.perf_counter() - started)
+        
+        # Un mensaje defectuoso no debe cerrar la conexión compartida
+        try:
+            self._process_incoming_message(message, len(payload))
+        except Exception as e:
+            print(f"Error procesando mensaje: {e}")
+            self.monitor.record_error('handler_error')
+    
+    def _process_incoming_message(self, message, size=0):
+        """
+        Despachar mensaje entrante a los handlers de su tipo
+        
+        Args:
+            message: Paquete deserializado
+            size: Bytes que ocupó en el cable (para las métricas)
+        """
+        msg_type = message.get('type')
+        
+        if msg_type == 'batch':
+            # Varios paquetes agrupados por el emisor en un solo frame;
+            # los bytes se reparten a partes iguales entre ellos
+            packets = message.get('packets', [])
+            share = size // len(packets) if packets else 0
+            
+            for packet in packets:
+                try:
+                    self._process_incoming_message(packet, share)
+                except Exception as e:
+                    print(f"Error procesando paquete del lote: {e}")
+                    self.monitor.record_error('handler_error')
+            return
+        
+        # Solo los tipos con handler tienen contador propio: el resto lo
+        # elige el peer y se agrupa en 'other'
+        handlers = self.handlers.get(msg_type)
+        self.monitor.record_message_received(size, msg_type if handlers else 'other')
+        
+        # Reintento de un paquete ya entregado: descartarlo sin descifrar.
+        # Los IDs los elige cada emisor: la clave incluye el remitente
+        dedup_key = None
+        message_id = message.get('message_id')
+        if msg_type in DEDUP_TYPES and message_id:
+            dedup_key = f"{message.get('from')}|{message_id}"
+            if self.dedup.contains(dedup_key):
+                # El acuse anterior se perdió: confirmar de nuevo
+                self._send_ack(message.get('from'), message_id)
+                return
+        
+        # Paquete firmado por ventanas: descartarlo si no es del remitente.
+        # Sin 'merkle' es una firma que falta, salvo con la firma desactivada
+        # y un remitente sin clave fijada
+        if (('merkle' in message or self._signature_required(msg_type, message.get('from')))
+                and not self.packet_auth.verify_signed_packet(message)):
+            self.monitor.record_error('bad_signature')
+            return
+        
+        if 'stream' in message and not self._open_stream_payload(message):
+            self.monitor.record_error('decrypt_failed')
+            return
+        
+        # Tráfico del peer: si estaba en backoff, reintentar ya
+        if self.outbox.peer_reachable(message.get('from')):
+            self._flush_outbox()
+        
+        if not handlers:
+            # Tipos de versiones más nuevas o de módulos no cargados
+            with self.stats_lock:
+                self.stats['unknown_packets'] += 1
+                if msg_type not in self.unknown_types and len(self.unknown_types) >= MAX_UNKNOWN_TYPES:
+                    msg_type = 'other'
+                self.unknown_types[msg_type] = self.unknown_types.get(msg_type, 0) + 1
+            self.monitor.record_error('unknown_type')
+            return
+        
+        failed = False
+        handled = False
+        for handler in handlers:
+            started = time.perf_counter()
             try:
-                decrypted = self.crypto_manager.decrypt_message(encrypted_data)
-                
-                # Agregar a cola de mensajes entrantes
-                self.incoming_queue.put({
-                    'type': 'chat_message',
-                    'from': sender,
-                    'timestamp': message.get('timestamp'),
-                    'text': decrypted
-                })
-                
+                event = handler(message)
             except Exception as e:
-                print(f"Error desencriptando mensaje: {e}")
+                print(f"Error en handler de '{msg_type}': {e}")
+                self.monitor.record_error('handler_error')
+                failed = True
+                continue
+            finally:
+                self.monitor.observe('handler', time.perf_counter() - started)
+            
+            # Lo que devuelve un handler se entrega a la aplicación
+            if event is not None:
+                handled = True
+                self._deliver(event)
+        
+        # Entregado: desde ahora los reintentos son duplicados. Solo cuenta
+        # si un handler lo confirmó con su evento: uno que no pudo descifrar
+        # (o que falló) devuelve None, y un reintento vuelve a procesarlo
+        if dedup_key is not None and handled and not failed:
+            self.dedup.record(dedup_key)
+            self._send_ack(message.get('from'), message_id)
+    
+    def _send_ack(self, sender, message_id):
+        """Confirmar al emisor un paquete procesado (borra su copia del outbox)"""
+        if not sender:
+            return
+        # Efímero: si se pierde, el emisor reenvía y se vuelve a confirmar
+        deadline = time.time() + NETWORK_CONFIG['outbox_ack_timeout']
+        self.send_packet(sender, {'type': 'ack', 'message_id': message_id}, deadline=deadline)
+    
+    def _signature_required(self, msg_type, sender):
+        """Un paquete de este tipo y remitente debe venir firmado"""
+        if msg_type not in SIGNED_TYPES:
+            return False
+        return SECURITY_CONFIG['sign_media'] or sender in self.peer_keys
+    
+    def register_handler(self, packet_type, handler):
+        """
+        Registrar handler para un tipo de paquete entrante
+        
+        El handler recibe el paquete en el thread de recepción; si devuelve
+        un diccionario, se entrega como evento a los suscriptores. Los campos
+        binarios llegan como memoryview sobre el buffer de recepción: para
+        conservarlos después de la llamada hay que copiarlos con bytes().
         
-        elif msg_type == 'video_frame':
-            # Frame de video
-            frame_data = message.get('data')
+        En los tipos deduplicados (DEDUP_TYPES) el evento es además la
+        confirmación de que el paquete se procesó: solo entonces se marca
+        como visto y se envía el acuse. Devolver None (p. ej. no se pudo
+        descifrar) deja que un reintento del emisor vuelva a procesarlo.
+        
+        Args:
+            packet_type: Valor de 'type' del paquete
+            handler: Callable(packet) -> evento o None
+        """
+        with self.handlers_lock:
+            # Copia al escribir: el despacho lee sin tomar el lock
+            handlers = dict(self.handlers)
+            handlers[packet_type] = handlers.get(packet_type, ()) + (handler,)
+            self.handlers = handlers
+    
+    def unregister_handler(self, packet_type, handler):
+        """Quitar handler registrado con register_handler"""
+        with self.handlers_lock:
+            handlers = dict(self.handlers)
+            remaining = tuple(h for h in handlers.get(packet_type, ()) if h != handler)
             
-            self.incoming_queue.put({
-                'type': 'video_frame',
-                'from': sender,
-                'frame': frame_data
-            })
+            if remaining:
+                handlers[packet_type] = remaining
+            else:
+                handlers.pop(packet_type, None)
+            
+            self.handlers = handlers
+    
+    def subscribe(self, callback):
+        """
+        Suscribirse a los eventos entrantes (mensajes, llamadas, claves...)
         
-        elif msg_type == 'key_request':
-            # Solicitud de clave pública
-            # Responder con nuestra clave pública
-            self.send_public_key(sender)
+        Reemplaza el polling de get_incoming_message: el callback se invoca
+        en el thread de recepción en cuanto llega el evento, por lo que debe
+        ser rápido o pasar el trabajo a otro thread.
         
-        elif msg_type == 'key_response':
-            # Respuesta con clave pública
-            public_key = message.get('public_key')
+        Args:
+            callback: Callable(evento)
             
-            # Actualizar clave pública del contacto
-            # TODO: Guardar en base de datos de contactos
+        Returns:
+            El mismo callback (para unsubscribe)
+        """
+        with self.handlers_lock:
+            self.subscribers = self.subscribers + (callback,)
+        return callback
+    
+    def subscribe_queue(self, loop=None, maxsize=0):
+        """
+        Suscribirse con una asyncio.Queue alimentada desde cualquier thread
+        
+        Args:
+            loop: Event loop consumidor (por defecto el que está corriendo)
+            maxsize: Tamaño máximo; si se llena, los eventos se descartan
             
-            self.incoming_queue.put({
-                'type': 'public_key',
-                'from': sender,
-                'public_key': public_key
-            })
+        Returns:
+            asyncio.Queue con los eventos
+        """
+        import asyncio
         
-        elif msg_type == 'call_request':
-            # Solicitud de videollamada
-            self.incoming_queue.put({
-                'type': 'call_request',
-                'from': sender,
-                'timestamp': message.get('timestamp')
-            })
+        if loop is None:
+            loop = asyncio.get_running_loop()
         
-        elif msg_type == 'call_accept':
-            # Aceptación de videollamada
-            self.incoming_queue.put({
-                'type': 'call_accept',
-                'from': sender
-            })
+        event_queue = asyncio.Queue(maxsize)
         
-        elif msg_type == 'call_reject':
-            # Rechazo de videollamada
-            self.incoming_queue.put({
-                'type': 'call_reject',
-                'from': sender
-            })
+        def put_event(event):
+            if event_queue.full():
+                with self.stats_lock:
+                    self.stats['events_dropped'] += 1
+                return
+            event_queue.put_nowait(event)
         
-        else:
-            print(f"Tipo de mensaje desconocido: {msg_type}")
+        def callback(event):
+            loop.call_soon_threadsafe(put_event, event)
+        
+        self.queue_callbacks[event_queue] = callback
+        self.subscribe(callback)
+        return event_queue
+    
+    def unsubscribe(self, subscriber):
+        """
+        Cancelar suscripción
+        
+        Args:
+            subscriber: Callback de subscribe o cola de subscribe_queue
+        """
+        callback = self.queue_callbacks.pop(subscriber, subscriber)
+        
+        with self.handlers_lock:
+            self.subscribers = tuple(s for s in self.subscribers if s != callback)
+    
+    def _deliver(self, event):
+        """Entregar evento a los suscriptores (o a la cola si no hay)"""
+        subscribers = self.subscribers
+        
+        if not subscribers:
+            # Compatibilidad con consumidores de get_incoming_message
+            self.incoming_queue.put(event)
+            return
+        
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"Error en suscriptor de eventos: {e}")
+    
+    def _register_default_handlers(self):
+        """Handlers de los paquetes propios de la red P2P"""
+        self.register_handler('message', self._on_chat_message)
+        self.register_handler('video_frame', self._on_video_frame)
+        self.register_handler('key_request', self._on_key_request)
+        self.register_handler('key_response', self._on_key_response)
+        self.register_handler('ack', self._on_ack)
+        self.register_handler('call_request', self._on_call_signal)
+        self.register_handler('call_accept', self._on_call_signal)
+        self.register_handler('call_reject', self._on_call_signal)
+    
+    def _request_session(self, peer_onion):
+        """Remitente sin clave fijada: negociar sesión (con límite de tasa)"""
+        self.monitor.record_error('unknown_peer_key')
+        if peer_onion:
+            self.session_manager.request_session(peer_onion)
+    
+    def _on_chat_message(self, message):
+        """
+        Mensaje de chat del formato anterior: se descarta
+        
+        Venía cifrado con un hash de las dos claves públicas, que cualquiera
+        puede calcular. Se negocia una sesión para que el remitente pase a
+        'session_message'.
+        """
+        sender = message.get('from')
+        print(f"Mensaje de {sender} sin sesión (formato anterior) descartado")
+        self.monitor.record_error('legacy_message')
+        if sender:
+            self.session_manager.request_session(sender)
+        return None
+    
+    def _on_video_frame(self, message):
+        """Frame de video"""
+        return {
+            'type': 'video_frame',
+            'from': message.get('from'),
+            'frame': _detach(message.get('data'))
+        }
+    
+    def _on_key_request(self, message):
+        """Solicitud de clave pública: responder con la nuestra"""
+        self.send_public_key(message.get('from'))
+        return None
+    
+    def _on_key_response(self, message):
+        """Respuesta con clave pública (el usuario la fija con trust_peer_key)"""
+        # TODO: Guardar en base de datos de contactos
+        return {
+            'type': 'public_key',
+            'from': message.get('from'),
+            'public_key': _detach(message.get('public_key'))
+        }
+    
+    def _on_ack(self, message):
+        """Acuse del receptor: el paquete ya no hace falta en el outbox"""
+        self.outbox.acknowledged(message.get('from'), message.get('message_id'))
+        return None
+    
+    def _on_key_offered(self, peer_onion, public_key, replaces):
+        """Handshake con una clave no fijada: consultar al usuario"""
+        self.monitor.record_error('untrusted_peer_key')
+        self._deliver({
+            'type': 'peer_key_offered',
+            'from': peer_onion,
+            'public_key': public_key,
+            'replaces': replaces
+        })
+    
+    def _on_call_signal(self, message):
+        """Solicitud, aceptación o rechazo de videollamada"""
+        return {
+            'type': message.get('type'),
+            'from': message.get('from'),
+            'timestamp': message.get('timestamp')
+        }
     
     def _sender_loop(self):
-        """Loop para enviar mensajes salientes"""
+        """Loop de un sender: atiende un peer con tráfico pendiente a la vez"""
+        idle_timeout = NETWORK_CONFIG['pool_idle_timeout']
+        
         while self.is_running:
-            try:
-                # Esperar mensaje en cola
-                recipient, packet = self.outgoing_queue.get(timeout=1.0)
-                
-                # Enviar mensaje
-                self._send_packet(recipient, packet)
-                
-            except queue.Empty:
+            peer = self.scheduler.acquire(timeout=1.0)
+            
+            if peer is None:
+                # Aprovechar la inactividad para cerrar sockets ociosos
+                self.pool.prune_idle()
+                self.scheduler.prune(idle_timeout)
                 continue
+            
+            try:
+                # Enviar una ráfaga y ceder el sender a otros peers
+                for _ in range(self.scheduler.burst):
+                    batch = self._collect_batch(peer)
+                    if not batch:
+                        break
+                    
+                    success = self._send_frame(peer.onion_address, batch)
+                    
+                    self._batch_sent(peer, batch, success)
+                    if not success:
+                        break
+                    
             except Exception as e:
                 print(f"Error en sender loop: {e}")
+            finally:
+                self.scheduler.release(peer)
     
-    def _send_packet(self, recipient_onion, packet):
+    def _batch_sent(self, peer, batch, success):
         """
-        Enviar paquete a un peer
+        Registrar el resultado del envío de un lote
+        
+        Si falló, el peer entra en backoff y el resto de su cola espera en
+        el outbox al próximo reintento.
+        """
+        for enqueued_at, payload, entry, packet_type, _ in batch:
+            peer.record(enqueued_at, success)
+            
+            if success:
+                self.monitor.record_message_sent(len(payload), packet_type)
+            
+            if entry is not None:
+                if success:
+                    # Con ack_id queda en disco hasta el acuse del receptor
+                    self.outbox.sent(entry)
+                else:
+                    self.outbox.release(entry, failed=self.is_running)
+        
+        if success:
+            self.outbox.peer_reachable(peer.onion_address)
+            return
+        
+        # Falló por el stop (pool cerrado): no es culpa del peer, lo
+        # pendiente queda en el outbox sin backoff
+        if not self.is_running:
+            return
+        
+        for enqueued_at, entry in self.scheduler.drain(peer):
+            peer.record(enqueued_at, False)
+            if entry is not None:
+                self.outbox.release(entry)
+        
+        delay = self.outbox.peer_failed(peer.onion_address)
+        print(f"{peer.onion_address} inalcanzable, reintento en {delay:.0f}s")
+    
+    def _outbox_loop(self):
+        """Loop de reintentos del outbox"""
+        while self.is_running:
+            try:
+                self._flush_outbox()
+            except Exception as e:
+                print(f"Error en outbox: {e}")
+            
+            self.stopped.wait(1.0)
+    
+    def _flush_outbox(self):
+        """Encolar en bloque lo pendiente de los peers a los que toca reintentar"""
+        for entry, packet in self.outbox.due():
+            # Cargado de una sesión anterior: el ID del acuse está en el paquete
+            if entry.ack_id is None:
+                entry.ack_id = _ack_id(packet)
+            self.scheduler.put(
+                entry.onion_address, packet, entry.priority, entry=entry
+            )
+    
+    def _collect_batch(self, peer):
+        """
+        Sacar de la cola del peer los paquetes que se enviarán juntos
+        
+        Tras el primer paquete espera hasta coalesce_linger_ms por más
+        paquetes de la misma clase al mismo destino (indicadores de
+        escritura, recibos, chunks...), sin superar los máximos de paquetes
+        y bytes ni el crédito del stream.
+        
+        Returns:
+            Lista de tuplas devuelta por _batch_item
+        """
+        item = self.scheduler.pop(peer)
+        if item is None:
+            return []
+        
+        priority = item[3]
+        max_packets = NETWORK_CONFIG['coalesce_max_packets']
+        max_bytes = self._batch_budget(
+            self._send_windows(peer.onion_address), priority
+        )
+        deadline = time.time() + NETWORK_CONFIG['coalesce_linger_ms'] / 1000
+        
+        batch = [self._batch_item(item)]
+        size = len(batch[0][1])
+        
+        while len(batch) < max_packets and size < max_bytes:
+            item = self.scheduler.pop(
+                peer, timeout=deadline - time.time(), priority=priority
+            )
+            if item is None:
+                break
+            
+            batch.append(self._batch_item(item))
+            size += len(batch[-1][1])
+        
+        return batch
+    
+    def _batch_item(self, item):
+        """
+        Serializar un paquete sacado de la cola para incluirlo en un lote
         
         Args:
-            recipient_onion: Dirección .onion del destinatario
-            packet: Diccionario con datos a enviar
+            item: Tupla (enqueued_at, paquete, entrada del outbox, clase) de
+                  la cola
+            
+        Returns:
+            Tupla (enqueued_at, payload serializado, entrada del outbox, tipo,
+            clase)
+        """
+        enqueued_at, packet, entry, priority = item
+        self.monitor.observe('queue_wait', time.time() - enqueued_at)
+        
+        started = time.perf_counter()
+        payload = self._serialize_packet(packet)
+        self.monitor.observe('serialize', time.perf_counter() - started)
+        
+        return enqueued_at, payload, entry, packet.get('type'), priority
+    
+    def _batch_budget(self, windows, priority):
+        """Bytes máximos de un lote según el crédito del stream de su clase"""
+        max_bytes = NETWORK_CONFIG['coalesce_max_bytes']
+        
+        if windows is None:
+            return max_bytes
+        
+        budget = windows.budget(stream_for(priority))
+        if budget is None:
+            return max_bytes
+        
+        # Lotes de un cuarto de ventana: varios frames en vuelo mientras el
+        # receptor devuelve crédito. Sin crédito (carrera con el bloqueo)
+        # sale solo el primer paquete.
+        return min(max_bytes, budget, windows.window // 4)
+    
+    def _send_windows(self, recipient_onion):
+        """Control de flujo de la conexión actual hacia el peer (o None)"""
+        conn = self.connections.get(recipient_onion)
+        return conn.windows if conn is not None else None
+    
+    def _serialize_packet(self, packet):
+        """Serializar paquete para el cable"""
+        if self.wire_format == 'binary':
+            return encode_packet(packet)
+        
+        return json.dumps(packet, default=json_default).encode('utf-8')
+    
+    def _encode_batch(self, batch, stream_id=None, compression=None):
         """
+        Construir un único frame con los paquetes de un lote
+        
+        Args:
+            batch: Lista de tuplas devuelta por _collect_batch
+            stream_id: Stream del frame (None = peer sin multiplexación)
+            compression: Método negociado con el peer (None = sin comprimir)
+            
+        Returns:
+            Frame listo para enviar
+        """
+        frame_type = FRAME_BINARY if self.wire_format == 'binary' else FRAME_PACKET
+        
+        if len(batch) == 1:
+            return self._encode_data_frame(
+                frame_type, stream_id, batch[0][1], compression
+            )
+        
+        # Lote: los paquetes ya serializados se insertan sin re-serializar
+        if frame_type == FRAME_BINARY:
+            payload = encode_batch([item[1] for item in batch])
+        else:
+            payload = b''.join((
+                b'{"type": "batch", "packets": [',
+                b', '.join(item[1] for item in batch),
+                b']}'
+            ))
+        
+        with self.stats_lock:
+            self.stats['batches_sent'] += 1
+            self.stats['packets_coalesced'] += len(batch)
+        
+        return self._encode_data_frame(frame_type, stream_id, payload, compression)
+    
+    def _encode_data_frame(self, frame_type, stream_id, payload, compression=None):
+        """
+        Frame de datos, con id de stream si la conexión está multiplexada y
+        comprimido si se negoció y conviene
+        """
+        if stream_id is None:
+            return encode_frame(frame_type, payload)
+        
+        flags = 0
+        if compression:
+            compressed = self.compressor.compress(payload, compression)
+            if compressed is not None:
+                payload = compressed
+                flags = FLAG_COMPRESSED
+        
+        return encode_stream_frame(frame_type, stream_id, payload, flags)
+    
+    def _encode_for(self, windows, batch):
+        """
+        Codificar un lote para una conexión concreta
+        
+        Returns:
+            Tupla (frame, stream_id o None si va sin multiplexar)
+        """
+        stream_id = stream_for(batch[0][4])
+        multiplexed = windows is not None and windows.multiplexed
+        
+        if not multiplexed:
+            return self._encode_batch(batch), None
+        return self._encode_batch(batch, stream_id, windows.compression), stream_id
+    
+    def _consume_window(self, recipient_onion, windows, batch, stream_id, size):
+        """Descontar un frame enviado y frenar su clase si agotó el crédito"""
+        if windows is None:
+            return
+        
+        priority = batch[0][4]
+        if windows.consume(stream_for(priority), size, stream_id is not None):
+            self.scheduler.block(recipient_onion, priority)
+    
+    def _on_connect(self, conn):
+        """Conexión saliente nueva: saludo y lector de frames de control"""
+        conn.windows = SendWindows(NETWORK_CONFIG['stream_window'])
+        conn.has_reader = True
+        _set_nodelay(conn.sock)
+        conn.sock.sendall(self._encode_hello())
+        
+        # Ventanas nuevas: las clases frenadas en la conexión anterior siguen
+        self.scheduler.unblock(conn.onion_address)
+        
+        threading.Thread(
+            target=self._connection_reader, args=(conn,), daemon=True
+        ).start()
+    
+    def _encode_hello(self):
+        """HELLO de una conexión saliente: ventana y compresión aceptada"""
+        return encode_hello(
+            self.tor_manager.onion_address, NETWORK_CONFIG['stream_window'],
+            compression=list(COMPRESSION_METHODS) if NETWORK_CONFIG['compression'] else None
+        )
+    
+    def _connection_reader(self, conn):
+        """Leer HELLO y WINDOW_UPDATE que el peer devuelve por una conexión saliente"""
+        reader = FrameReader(conn.sock, buffer_size=4096)
+        hello_timeout = NETWORK_CONFIG['connection_timeout']
+        
         try:
-            # Conectar al peer vía Tor
-            sock = self.tor_manager.connect_to_onion(recipient_onion, 80)
+            while self.is_running and not conn.closed:
+                try:
+                    frame = reader.read_frame()
+                except socket.timeout:
+                    if conn.windows.hello_expired(hello_timeout):
+                        # Peer de una versión anterior: sin control de flujo
+                        conn.windows.fallback()
+                        self.scheduler.unblock(conn.onion_address)
+                    continue
+                
+                if frame is None:
+                    break
+                
+                frame_type, flags, payload = frame
+                self._on_control_frame(conn.onion_address, conn.windows, frame_type, payload)
+                
+        except (OSError, FrameError) as e:
+            if not conn.closed:
+                print(f"Conexión con {conn.onion_address} cerrada: {e}")
+        finally:
+            conn.closed = True
             
-            if not sock:
+            # Si no la reemplazó otra conexión, no dejar clases frenadas
+            # esperando crédito que ya no llegará
+            current = self.connections.get(conn.onion_address)
+            if current is None or current is conn:
+                self.scheduler.unblock(conn.onion_address)
+    
+    def _on_control_frame(self, recipient_onion, windows, frame_type, payload):
+        """Procesar un frame de control recibido por una conexión saliente"""
+        if frame_type == FRAME_HELLO:
+            hello = decode_hello(payload)
+            # Solo un método que se ofreció (el peer podría no elegir ninguno)
+            compression = hello.get('compression')
+            windows.open(
+                hello['window'],
+                compression if compression in COMPRESSION_METHODS else None
+            )
+            self.scheduler.unblock(recipient_onion)
+        
+        elif frame_type == FRAME_WINDOW_UPDATE:
+            stream_id, increment = decode_window_update(payload)
+            if windows.grant(stream_id, increment):
+                self.scheduler.unblock(recipient_onion, priority_for(stream_id))
+        
+        else:
+            print(f"Frame inesperado por conexión saliente: {frame_type}")
+    
+    def _send_frame(self, recipient_onion, batch):
+        """
+        Escribir un lote por la conexión persistente del peer
+        
+        Returns:
+            True si se envió
+        """
+        # Un socket reutilizado puede haber sido cerrado por el peer sin que
+        # lo detecte el chequeo de salud: reintentar una vez con uno nuevo
+        for attempt in range(2):
+            started = time.perf_counter()
+            conn = self.pool.acquire(recipient_onion, 80)
+            
+            if not conn:
+                self.monitor.record_connection_attempt(
+                    False, time.perf_counter() - started
+                )
                 print(f"No se pudo conectar a {recipient_onion}")
                 return False
             
-            # Serializar paquete
-            data = json.dumps(packet).encode('utf-8')
+            reused = conn.uses > 0
+            if not reused:
+                self.monitor.record_connection_attempt(
+                    True, time.perf_counter() - started
+                )
             
-            # Enviar con delimitador
-            sock.sendall(data + b"\n\n")
+            data, stream_id = self._encode_for(conn.windows, batch)
             
-            sock.close()
+            started = time.perf_counter()
+            try:
+                conn.sock.sendall(data)
+            except Exception as e:
+                self.pool.discard(conn)
+                if reused and attempt == 0:
+                    self.monitor.record_error('stale_connection')
+                    continue
+                print(f"Error enviando paquete: {e}")
+                self.monitor.record_error('send_failed')
+                return False
             
+            self.monitor.observe('send', time.perf_counter() - started)
+            self._consume_window(recipient_onion, conn.windows, batch, stream_id, len(data))
+            self.pool.release(conn)
             print(f"Paquete enviado a {recipient_onion}")
             return True
-            
-        except Exception as e:
-            print(f"Error enviando paquete: {e}")
-            return False
+        
+        return False
     
     def get_incoming_message(self, timeout=0.1):
         """
         Obtener siguiente mensaje de la cola de entrada
         
+        Solo recibe eventos mientras no haya suscriptores; preferir
+        subscribe() o subscribe_queue() para evitar el polling.
+        
         Returns:
             Diccionario con mensaje o None si no hay mensajes
         """
@@ -338,10 +1463,14 @@ class P2PNetwork:
         request = {
             'type': 'call_request',
             'from': self.tor_manager.onion_address,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_ms()
         }
         
-        self.outgoing_queue.put((recipient_onion, request))
+        # Cada llamada cifra sus frames con un stream nuevo
+        with self.media_lock:
+            self.media_streams.pop(recipient_onion, None)
+        
+        self._enqueue(recipient_onion, request, deadline=self._call_deadline())
     
     def accept_call(self, peer_onion):
         """
@@ -353,10 +1482,13 @@ class P2PNetwork:
         response = {
             'type': 'call_accept',
             'from': self.tor_manager.onion_address,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_ms()
         }
         
-        self.outgoing_queue.put((peer_onion, response))
+        with self.media_lock:
+            self.media_streams.pop(peer_onion, None)
+        
+        self._enqueue(peer_onion, response, deadline=self._call_deadline())
     
     def reject_call(self, peer_onion):
         """
@@ -368,18 +1500,146 @@ class P2PNetwork:
         response = {
             'type': 'call_reject',
             'from': self.tor_manager.onion_address,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_ms()
         }
         
-        self.outgoing_queue.put((peer_onion, response))
+        self._enqueue(peer_onion, response, deadline=self._call_deadline())
+    
+    def _call_deadline(self):
+        """Señales de llamada: no persisten ni sirven pasado call_timeout"""
+        return time.time() + NETWORK_CONFIG['call_timeout']
     
     def get_connection_stats(self):
         """Obtener estadísticas de conexiones"""
+        pool_stats = self._pool_stats()
+        peer_queues = self.scheduler.get_stats()
+        
         return {
             'active_connections': len(self.connections),
-            'messages_queued': self.outgoing_queue.qsize(),
-            'messages_pending': self.incoming_queue.qsize()
+            'messages_queued': self.scheduler.qsize(),
+            'messages_pending': self.incoming_queue.qsize(),
+            'pool_hits': pool_stats['hits'],
+            'pool_misses': pool_stats['misses'],
+            'pool_hit_rate': pool_stats['hit_rate'],
+            'pool_evictions': pool_stats['evictions'],
+            'pool_stale_closed': pool_stats['stale_closed'],
+            'batches_sent': self.stats['batches_sent'],
+            'packets_coalesced': self.stats['packets_coalesced'],
+            'unknown_packets': self.stats['unknown_packets'],
+            'unknown_types': dict(self.unknown_types),
+            'events_dropped': self.stats['events_dropped'],
+            'dropped_stale': sum(q['dropped_stale'] for q in peer_queues.values()),
+            'dropped_offline': self.stats['dropped_offline'],
+            'outbox': self.outbox.get_stats(),
+            'peer_queues': peer_queues,
+            'streams': self._stream_stats(),
+            'dedup': self.dedup.get_stats(),
+            'admission': self.admission.get_stats(),
+            'compression': self.compressor.get_stats(),
+            'media_signing': (
+                self.media_signer.get_stats() if self.media_signer is not None else None
+            ),
+            'packet_auth': self.packet_auth.get_stats(),
+            'sessions': self.session_manager.get_stats(),
+            'metrics': self.monitor.snapshot()
         }
+    
+    def _stream_stats(self):
+        """Modo y crédito de los streams de cada conexión saliente"""
+        streams = {}
+        for onion in list(self.connections):
+            windows = self._send_windows(onion)
+            if windows is not None:
+                streams[onion] = windows.get_stats()
+        return streams
+    
+    def export_metrics(self, fmt='json'):
+        """
+        Exportar métricas de red
+        
+        Args:
+            fmt: 'json' (snapshot completo) o 'prometheus' (formato de texto)
+            
+        Returns:
+            String con las métricas
+        """
+        if fmt == 'prometheus':
+            pool_stats = self._pool_stats()
+            outbox_stats = self.outbox.get_stats()
+            admission_stats = self.admission.get_stats()
+            compression_stats = self.compressor.get_stats()
+            
+            return self.monitor.to_prometheus(gauges={
+                'active_connections': len(self.connections),
+                'messages_queued': self.scheduler.qsize(),
+                'messages_pending': self.incoming_queue.qsize(),
+                'pool_hit_rate': round(pool_stats['hit_rate'], 4),
+                'outbox_entries': outbox_stats['entries'],
+                'outbox_bytes': outbox_stats['bytes'],
+                'dedup_hit_rate': round(self.dedup.get_stats()['hit_rate'], 4),
+                'inbound_connections': admission_stats['inbound_connections'],
+                'rejected_connections': admission_stats['rejected_connections'],
+                'rejected_packets': admission_stats['rejected_packets'],
+                'throttle_seconds': admission_stats['throttle_seconds'],
+                'compression_bytes_saved': compression_stats['bytes_saved'],
+                'compression_seconds': (
+                    compression_stats['compress_seconds']
+                    + compression_stats['decompress_seconds']
+                ),
+            })
+        
+        return self.monitor.to_json(extra={
+            'connections': {
+                key: value
+                for key, value in self.get_connection_stats().items()
+                if key != 'metrics'
+            }
+        })
+    
+    def _pool_stats(self):
+        """Estadísticas de reutilización de conexiones"""
+        return self.pool.get_stats()
+
+
+
+def _set_nodelay(sock):
+    """
+    Desactivar Nagle: los frames ya se agrupan en lotes, y los frames de
+    control que vuelven por la misma conexión (HELLO, WINDOW_UPDATE) no
+    deben esperar al ACK retardado del otro extremo
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+def _ack_id(packet):
+    """ID con que el receptor confirma el paquete (tipos deduplicados)"""
+    if packet.get('type') in DEDUP_TYPES:
+        return packet.get('message_id')
+    return None
+
+
+def _detach(value):
+    """Copiar un campo binario recibido para usarlo fuera del handler"""
+    if isinstance(value, memoryview):
+        return bytes(value)
+    return value
+
+
+def create_p2p_network(tor_manager, crypto_manager, outbox_dir=None):
+    """
+    Crear la red P2P con el motor configurado en NETWORK_CONFIG['engine']
+    
+    Returns:
+        P2PNetwork (threads) o AsyncP2PNetwork (asyncio)
+    """
+    if NETWORK_CONFIG['engine'] == 'asyncio':
+        from async_network import AsyncP2PNetwork
+        return AsyncP2PNetwork(tor_manager, crypto_manager, outbox_dir)
+    
+    return P2PNetwork(tor_manager, crypto_manager, outbox_dir)
 
 
 class MessageProtocol:
@@ -405,30 +1665,41 @@ class MessageProtocol:
         }
     
     @staticmethod
-    def create_typing_indicator():
-        """Crear indicador de "escribiendo..." """
+    def create_typing_indicator(active=True):
+        """Crear indicador de "escribiendo..." (ver EphemeralSignals)"""
         return {
-            'type': 'typing'
+            'type': 'typing',
+            'active': active
         }
     
     @staticmethod
-    def create_read_receipt(message_id):
-        """Crear recibo de lectura"""
-        return {
+    def create_read_receipt(message_id, up_to=None):
+        """
+        Crear recibo de lectura
+        
+        Args:
+            message_id: Último mensaje leído
+            up_to: Timestamp de ese mensaje: confirma también todos los
+                anteriores de la conversación
+        """
+        receipt = {
             'type': 'read_receipt',
             'message_id': message_id
         }
+        if up_to is not None:
+            receipt['up_to'] = up_to
+        return receipt
 
 
 if __name__ == '__main__':
     # Test básico de P2P
     print("=== Test de P2PNetwork ===\n")
     
-    from tor_manager import TorManager
+    from tor_manager import create_tor_manager
     from crypto_manager import CryptoManager
     
     # Crear instancias
-    tor = TorManager()
+    tor = create_tor_manager()
     crypto = CryptoManager()
     crypto.generate_keypair()
     
@@ -444,13 +1715,12 @@ if __name__ == '__main__':
             print(f"Dirección .onion: {onion_addr}")
             print("Red P2P activa. Escuchando mensajes...")
             
-            # Simular recepción de mensajes
+            # Los eventos llegan por callback, sin polling
+            p2p.subscribe(lambda msg: print(f"Mensaje recibido: {msg}"))
+            
             try:
                 while True:
-                    msg = p2p.get_incoming_message()
-                    if msg:
-                        print(f"Mensaje recibido: {msg}")
-                    time.sleep(0.1)
+                    time.sleep(1)
                     
             except KeyboardInterrupt:
                 print("\nDeteniendo...")
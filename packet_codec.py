@@ -0,0 +1,416 @@
+"""
+Codec Binario de Paquetes
+Serialización compacta de paquetes P2P (reemplaza JSON + base64)
+"""
+
+import base64
+import struct
+import time
+
+# Primer byte del payload
+FORMAT_SCHEMA = 1  # Tipo conocido con campos en orden fijo
+FORMAT_GENERIC = 2  # Valor arbitrario (estilo msgpack)
+
+# Tags del formato genérico
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_BYTES = 6
+TAG_LIST = 7
+TAG_DICT = 8
+
+# Claves frecuentes: se codifican con un solo byte
+INTERNED_KEYS = [
+    'type', 'from', 'to', 'timestamp', 'data', 'public_key', 'packets',
+    'transfer_id', 'chunk_index', 'total_chunks', 'metadata', 'filename',
+    'file_size', 'checksum', 'sender', 'group_id', 'group_name', 'message_id',
+    'text', 'members', 'creator', 'encryption_key', 'call_id', 'member',
+    'participant',
+]
+KEY_IDS = {key: index for index, key in enumerate(INTERNED_KEYS)}
+KEY_LITERAL = 0xFF
+
+# Esquemas de los paquetes frecuentes: id de tipo y campos (sin 'type')
+#   str: texto UTF-8 | bytes: binario crudo | ms: entero sin signo 64 bits
+#   u32: entero sin signo 32 bits | any: valor genérico
+SCHEMAS = {
+    'message': (1, [('from', 'str'), ('to', 'str'), ('timestamp', 'ms'),
+                    ('data', 'any')]),
+    'video_frame': (2, [('from', 'str'), ('timestamp', 'ms'), ('data', 'any')]),
+    'key_request': (3, [('from', 'str'), ('timestamp', 'ms')]),
+    'key_response': (4, [('from', 'str'), ('timestamp', 'ms'),
+                         ('public_key', 'any')]),
+    'call_request': (5, [('from', 'str'), ('timestamp', 'ms')]),
+    'call_accept': (6, [('from', 'str'), ('timestamp', 'ms')]),
+    'call_reject': (7, [('from', 'str'), ('timestamp', 'ms')]),
+    'file_chunk': (8, [('from', 'str'), ('timestamp', 'ms'),
+                       ('transfer_id', 'str'), ('chunk_index', 'u32'),
+                       ('total_chunks', 'u32'), ('data', 'bytes')]),
+    'group_packet': (9, [('from', 'str'), ('timestamp', 'ms'),
+                         ('group_id', 'str'), ('data', 'bytes')]),
+}
+
+# Variantes con ID de mensaje (deduplicación en el receptor)
+SCHEMAS_WITH_ID = {
+    'message': (10, SCHEMAS['message'][1] + [('message_id', 'str')]),
+    'group_packet': (11, SCHEMAS['group_packet'][1] + [('message_id', 'str')]),
+    # Solo existe con ID
+    'session_message': (12, [('from', 'str'), ('to', 'str'), ('timestamp', 'ms'),
+                             ('session_id', 'str'), ('data', 'any'),
+                             ('message_id', 'str')]),
+}
+SCHEMAS_BY_ID = {
+    type_id: (packet_type, fields)
+    for schemas in (SCHEMAS, SCHEMAS_WITH_ID)
+    for packet_type, (type_id, fields) in schemas.items()
+}
+
+_U8 = struct.Struct('!B')
+_U32 = struct.Struct('!I')
+_U64 = struct.Struct('!Q')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+_HEAD = struct.Struct('!BB')
+
+# Anidamiento máximo de listas y diccionarios: un payload hostil no debe
+# agotar la pila del decodificador
+MAX_DEPTH = 32
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+class CodecError(Exception):
+    """Payload binario malformado"""
+
+
+def now_ms():
+    """Timestamp actual en milisegundos desde epoch"""
+    return int(time.time() * 1000)
+
+
+def json_default(value):
+    """
+    Hook `default` de json.dumps para paquetes con campos bytes
+
+    Solo para el formato JSON de compatibilidad: los bytes viajan en base64.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+
+def encode_packet(packet):
+    """
+    Serializar paquete a bytes
+
+    Los tipos con esquema usan campos en orden fijo; el resto (o paquetes
+    con campos inesperados) usa el formato genérico.
+
+    Args:
+        packet: Diccionario con al menos 'type'
+
+    Returns:
+        Bytes del paquete
+
+    Raises:
+        CodecError: Entero fuera de 64 bits o anidamiento mayor a MAX_DEPTH
+    """
+    if 'message_id' in packet:
+        schema = SCHEMAS_WITH_ID.get(packet.get('type'))
+    else:
+        schema = SCHEMAS.get(packet.get('type'))
+
+    if schema is not None and len(packet) == len(schema[1]) + 1:
+        try:
+            return _encode_schema(packet, *schema)
+        except (KeyError, TypeError, AttributeError, struct.error):
+            pass
+
+    out = [_U8.pack(FORMAT_GENERIC)]
+    _encode_value(packet, out)
+    return b''.join(out)
+
+
+def encode_batch(encoded_packets):
+    """
+    Construir paquete 'batch' a partir de paquetes ya serializados
+
+    Equivale a encode_packet({'type': 'batch', 'packets': [...]}) sin volver
+    a codificar cada paquete.
+
+    Args:
+        encoded_packets: Lista de bytes devueltos por encode_packet
+
+    Returns:
+        Bytes del lote
+    """
+    out = [
+        _U8.pack(FORMAT_GENERIC),
+        _U8.pack(TAG_DICT) + _U32.pack(2),
+        _U8.pack(KEY_IDS['type']),
+    ]
+    _encode_value('batch', out)
+    out.append(_U8.pack(KEY_IDS['packets']))
+    out.append(_U8.pack(TAG_LIST) + _U32.pack(len(encoded_packets)))
+
+    for encoded in encoded_packets:
+        # Cada paquete se inserta como bytes y se decodifica al leer el lote
+        out.append(_U8.pack(TAG_BYTES) + _U32.pack(len(encoded)))
+        out.append(encoded)
+
+    return b''.join(out)
+
+
+def decode_packet(data, copy=True):
+    """
+    Deserializar paquete
+
+    Args:
+        data: bytes, bytearray o memoryview
+        copy: Si es False, los campos binarios son memoryview sobre `data`
+            (sin copia); solo valen mientras `data` no se reutilice
+
+    Returns:
+        Diccionario del paquete
+
+    Raises:
+        CodecError: Payload truncado, corrupto, con bytes sobrantes o
+            anidado más de MAX_DEPTH niveles
+    """
+    packet = _decode_packet(data, copy)
+
+    if packet.get('type') == 'batch':
+        items = packet.get('packets')
+        if not isinstance(items, list):
+            raise CodecError("Lote sin lista de paquetes")
+        packet['packets'] = []
+        for item in items:
+            if not isinstance(item, (bytes, memoryview)):
+                raise CodecError("Paquete del lote no es binario")
+            inner = _decode_packet(item, copy)
+            # El emisor nunca anida lotes: cada nivel sería otra recursión
+            if inner.get('type') == 'batch':
+                raise CodecError("Lote dentro de un lote")
+            packet['packets'].append(inner)
+
+    return packet
+
+
+def _decode_packet(data, copy):
+    """Deserializar un paquete sin expandir los lotes"""
+    view = memoryview(data)
+
+    try:
+        fmt = view[0]
+
+        if fmt == FORMAT_SCHEMA:
+            packet, offset = _decode_schema(view, copy)
+        elif fmt == FORMAT_GENERIC:
+            packet, offset = _decode_value(view, 1, copy)
+        else:
+            raise CodecError(f"Formato desconocido: {fmt}")
+
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise CodecError(f"Paquete truncado o corrupto: {e}")
+
+    if offset != len(view):
+        raise CodecError(f"{len(view) - offset} bytes sobrantes tras el paquete")
+
+    if not isinstance(packet, dict):
+        raise CodecError("El paquete no es un diccionario")
+
+    return packet
+
+
+def _encode_schema(packet, type_id, fields):
+    """Serializar paquete con esquema fijo"""
+    out = [_HEAD.pack(FORMAT_SCHEMA, type_id)]
+
+    for name, kind in fields:
+        value = packet[name]
+
+        if kind == 'str':
+            raw = value.encode('utf-8')
+            out.append(_U32.pack(len(raw)))
+            out.append(raw)
+        elif kind == 'bytes':
+            if not isinstance(value, (bytes, bytearray, memoryview)):
+                raise TypeError(name)
+            out.append(_U32.pack(len(value)))
+            out.append(value)
+        elif kind == 'ms':
+            out.append(_U64.pack(value))
+        elif kind == 'u32':
+            out.append(_U32.pack(value))
+        else:
+            _encode_value(value, out)
+
+    return b''.join(out)
+
+
+def _decode_schema(view, copy=True):
+    """
+    Deserializar paquete con esquema fijo
+
+    Returns:
+        Tupla (paquete, offset tras el último campo)
+    """
+    type_id = view[1]
+
+    if type_id not in SCHEMAS_BY_ID:
+        raise CodecError(f"Tipo de paquete desconocido: {type_id}")
+
+    packet_type, fields = SCHEMAS_BY_ID[type_id]
+    packet = {'type': packet_type}
+    offset = 2
+
+    for name, kind in fields:
+        if kind == 'str':
+            start, offset = _read_length(view, offset)
+            packet[name] = str(view[start:offset], 'utf-8')
+        elif kind == 'bytes':
+            start, offset = _read_length(view, offset)
+            packet[name] = bytes(view[start:offset]) if copy else view[start:offset]
+        elif kind == 'ms':
+            packet[name] = _U64.unpack_from(view, offset)[0]
+            offset += 8
+        elif kind == 'u32':
+            packet[name] = _U32.unpack_from(view, offset)[0]
+            offset += 4
+        else:
+            packet[name], offset = _decode_value(view, offset, copy)
+
+    return packet, offset
+
+
+def _encode_value(value, out, depth=0):
+    """Serializar valor genérico agregando partes a `out`"""
+    if depth > MAX_DEPTH:
+        raise CodecError(f"Anidamiento mayor a {MAX_DEPTH} niveles")
+
+    if value is None:
+        out.append(_U8.pack(TAG_NONE))
+    elif value is True:
+        out.append(_U8.pack(TAG_TRUE))
+    elif value is False:
+        out.append(_U8.pack(TAG_FALSE))
+    elif isinstance(value, int):
+        if not INT64_MIN <= value <= INT64_MAX:
+            raise CodecError(f"Entero fuera de 64 bits: {value}")
+        out.append(_U8.pack(TAG_INT) + _I64.pack(value))
+    elif isinstance(value, float):
+        out.append(_U8.pack(TAG_FLOAT) + _F64.pack(value))
+    elif isinstance(value, str):
+        raw = value.encode('utf-8')
+        out.append(_U8.pack(TAG_STR) + _U32.pack(len(raw)))
+        out.append(raw)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(_U8.pack(TAG_BYTES) + _U32.pack(len(value)))
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(_U8.pack(TAG_LIST) + _U32.pack(len(value)))
+        for item in value:
+            _encode_value(item, out, depth + 1)
+    elif isinstance(value, dict):
+        out.append(_U8.pack(TAG_DICT) + _U32.pack(len(value)))
+        for key, item in value.items():
+            key_id = KEY_IDS.get(key)
+            if key_id is not None:
+                out.append(_U8.pack(key_id))
+            else:
+                raw = str(key).encode('utf-8')
+                out.append(_U8.pack(KEY_LITERAL) + _U32.pack(len(raw)))
+                out.append(raw)
+            _encode_value(item, out, depth + 1)
+    else:
+        raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+
+def _decode_value(view, offset, copy=True, depth=0):
+    """
+    Deserializar valor genérico
+
+    Returns:
+        Tupla (valor, nuevo offset)
+
+    Raises:
+        CodecError: Anidamiento mayor a MAX_DEPTH o tag desconocido
+    """
+    if depth > MAX_DEPTH:
+        raise CodecError(f"Anidamiento mayor a {MAX_DEPTH} niveles")
+
+    tag = view[offset]
+    offset += 1
+
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag == TAG_INT:
+        return _I64.unpack_from(view, offset)[0], offset + 8
+    if tag == TAG_FLOAT:
+        return _F64.unpack_from(view, offset)[0], offset + 8
+
+    if tag in (TAG_STR, TAG_BYTES):
+        start, end = _read_length(view, offset)
+        if tag == TAG_STR:
+            return str(view[start:end], 'utf-8'), end
+        return (bytes(view[start:end]) if copy else view[start:end]), end
+
+    if tag == TAG_LIST:
+        count = _read_count(view, offset)
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(view, offset, copy, depth + 1)
+            items.append(item)
+        return items, offset
+
+    if tag == TAG_DICT:
+        count = _read_count(view, offset)
+        offset += 4
+        result = {}
+        for _ in range(count):
+            key_id = view[offset]
+            offset += 1
+            if key_id == KEY_LITERAL:
+                start, offset = _read_length(view, offset)
+                key = str(view[start:offset], 'utf-8')
+            elif key_id < len(INTERNED_KEYS):
+                key = INTERNED_KEYS[key_id]
+            else:
+                raise CodecError(f"Clave desconocida: {key_id}")
+            result[key], offset = _decode_value(view, offset, copy, depth + 1)
+        return result, offset
+
+    raise CodecError(f"Tag desconocido: {tag}")
+
+
+def _read_count(view, offset):
+    """Leer cantidad de elementos (cada uno ocupa al menos un byte)"""
+    count = _U32.unpack_from(view, offset)[0]
+    if count > len(view) - offset - 4:
+        raise CodecError("Cantidad de elementos fuera del payload")
+    return count
+
+
+def _read_length(view, offset):
+    """
+    Leer prefijo de longitud y validar que el contenido esté completo
+
+    Returns:
+        Tupla (inicio, fin) del contenido
+    """
+    length = _U32.unpack_from(view, offset)[0]
+    start = offset + 4
+    end = start + length
+
+    if end > len(view):
+        raise CodecError("Longitud fuera del payload")
+
+    return start, end
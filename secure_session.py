@@ -0,0 +1,541 @@
+"""
+Sesiones Seguras
+Handshake ECDH por peer y claves simétricas de sesión en memoria
+"""
+
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from ecdsa import ECDH, SECP256k1
+
+from admission import TokenBucket
+from config import NETWORK_CONFIG, SECURITY_CONFIG
+from packet_codec import now_ms
+
+SESSION_INFO = b'yascan-session-v1'
+MAX_HANDSHAKES = 4  # Handshakes sin respuesta recordados por peer
+MAX_HANDSHAKE_PEERS = 256  # Peers con handshakes o textos en espera
+MAX_PENDING_TEXTS = 4096  # Textos esperando sesión por peer
+
+
+def hkdf_sha256(ikm, salt, info, length):
+    """
+    HKDF (RFC 5869) con SHA-256
+
+    Args:
+        ikm: Material de entrada (secreto ECDH)
+        salt: Sal pública
+        info: Contexto de la derivación
+        length: Bytes a derivar
+
+    Returns:
+        Bytes derivados
+    """
+    prk = hmac.new(salt, ikm, hashlib.sha256).digest()
+    okm = b''
+    block = b''
+    counter = 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        okm += block
+        counter += 1
+    return okm[:length]
+
+
+class _Session:
+    """Claves de una sesión establecida con un peer"""
+
+    def __init__(self, session_id, send_secret, receive_secret):
+        self.session_id = session_id
+        self.send_secret = send_secret
+        self.receive_secret = receive_secret
+        self.created = time.monotonic()
+        self.sent = 0
+
+
+class _Handshake:
+    """Handshake iniciado y aún sin respuesta"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.ecdh = ECDH(curve=SECP256k1)
+        self.public_key = self.ecdh.generate_private_key().to_string('compressed').hex()
+        self.started = time.monotonic()
+
+
+class SessionManager:
+    """
+    Sesiones cifradas por peer
+
+    La primera vez que se escribe a un peer se hace un handshake ECDH
+    (SECP256k1) con claves efímeras firmadas con la identidad de cada uno.
+    Del secreto se derivan con HKDF dos claves, una por sentido, que
+    quedan en memoria: los mensajes siguientes solo usan AES con la clave
+    ya expandida (ver CryptoManager.session_keys). Las operaciones de curva
+    elíptica se hacen una vez por sesión.
+
+    Tras `rekey_messages` mensajes o `rekey_seconds` se negocia una sesión
+    nueva sin dejar de enviar con la actual. Solo se aceptan handshakes
+    firmados con la clave de identidad ya fijada para el peer: uno de un
+    peer sin clave, o firmado con otra, se rechaza y se ofrece la clave al
+    usuario (`on_key_offered`), que la fija con P2PNetwork.trust_peer_key.
+    El campo 'from' lo declara el remitente: fijar la primera clave que
+    llega dejaría a cualquiera adueñarse de un .onion.
+
+    El remitente de un paquete lo declara el propio paquete: los
+    handshakes en curso y los textos en espera están acotados por peer y
+    en total, los handshakes sin respuesta caducan, y los que provoca un
+    mensaje de sesión desconocida (trabajo de curva y firma a pedido de
+    cualquiera) pasan por un balde de tokens común.
+    """
+
+    def __init__(self, p2p_network, crypto_manager, rekey_messages=None,
+                 rekey_seconds=None, peer_keys=None, on_key_offered=None):
+        """
+        Args:
+            p2p_network: Red P2P para enviar y recibir
+            crypto_manager: CryptoManager con la identidad propia
+            rekey_messages: Mensajes enviados antes de renovar la sesión
+            rekey_seconds: Segundos antes de renovar la sesión
+            peer_keys: Diccionario peer -> clave a compartir con otros módulos
+            on_key_offered: Llamada (peer, clave, reemplaza) con la clave de
+                un handshake firmado con una clave no fijada
+        """
+        self.p2p_network = p2p_network
+        self.crypto_manager = crypto_manager
+        self.rekey_messages = rekey_messages or SECURITY_CONFIG['session_rekey_messages']
+        self.rekey_seconds = rekey_seconds or SECURITY_CONFIG['session_rekey_seconds']
+        self.handshake_ttl = SECURITY_CONFIG['session_handshake_ttl']
+
+        self.sessions = {}  # peer -> _Session para enviar
+        self.receiving = {}  # session_id -> (peer, _Session)
+        self.handshakes = OrderedDict()  # peer -> [_Handshake] sin respuesta, del más viejo al más nuevo
+        self.pending = OrderedDict()  # peer -> textos esperando al handshake
+        self.peer_keys = peer_keys if peer_keys is not None else {}  # peer -> clave de identidad (hex)
+        self.on_key_offered = on_key_offered
+        self.unsolicited = TokenBucket(
+            SECURITY_CONFIG['session_unsolicited_rate'],
+            SECURITY_CONFIG['session_unsolicited_burst']
+        )
+        self.lock = threading.Lock()
+        crypto_manager.add_lock_listener(self.lock_sessions)
+
+        self.stats = {
+            'handshakes': 0,
+            'rekeys': 0,
+            'rejected': 0,
+            'encrypted': 0,
+            'decrypted': 0,
+            'decrypt_failed': 0,
+            'handshakes_expired': 0,
+            'handshakes_limited': 0,  # Iniciados por terceros y frenados
+            'pending_dropped': 0,
+        }
+
+        p2p_network.register_handler('session_init', self._on_session_init)
+        p2p_network.register_handler('session_accept', self._on_session_accept)
+        p2p_network.register_handler('session_message', self._on_session_message)
+
+    def send_text(self, peer_onion, text):
+        """
+        Enviar texto cifrado con la sesión del peer
+
+        Sin sesión se inicia el handshake y el texto sale al completarse;
+        sin clave fijada para el peer el texto espera a trust_peer_key.
+
+        Args:
+            peer_onion: Dirección .onion del destinatario
+            text: Mensaje en claro
+        """
+        ask_key = False
+        with self.lock:
+            session = self.sessions.get(peer_onion)
+
+            if session is None:
+                self._queue_text(peer_onion, text)
+                init = self._start_handshake(peer_onion)
+                # Primer texto a un peer sin clave: pedírsela para que el
+                # usuario la confirme
+                ask_key = (peer_onion not in self.peer_keys
+                           and len(self.pending[peer_onion]) == 1)
+            else:
+                session.sent += 1
+                init = None
+                if (session.sent >= self.rekey_messages
+                        or time.monotonic() - session.created >= self.rekey_seconds):
+                    init = self._start_handshake(peer_onion)
+                    if init is not None:
+                        self.stats['rekeys'] += 1
+
+        if ask_key:
+            self.p2p_network.request_public_key(peer_onion)
+        if init is not None:
+            self.p2p_network.send_packet(peer_onion, init)
+        if session is not None:
+            self._send_encrypted(peer_onion, session, text)
+
+    def lock_sessions(self):
+        """Bloqueo de la app: olvidar sesiones y handshakes"""
+        with self.lock:
+            self.sessions.clear()
+            self.receiving.clear()
+            self.handshakes.clear()
+
+    def forget_peer(self, peer_onion):
+        """
+        Clave del peer fijada o reemplazada: olvidar sus sesiones
+
+        Las sesiones y handshakes con la clave anterior ya no valen; los
+        textos en espera salen con un handshake nuevo.
+        """
+        with self.lock:
+            self.sessions.pop(peer_onion, None)
+            for session_id, (peer, _) in list(self.receiving.items()):
+                if peer == peer_onion:
+                    del self.receiving[session_id]
+            self.handshakes.pop(peer_onion, None)
+            init = self._start_handshake(peer_onion) if self.pending.get(peer_onion) else None
+
+        if init is not None:
+            self.p2p_network.send_packet(peer_onion, init)
+
+    def stream_secret(self, peer_onion):
+        """
+        Secreto de envío de la sesión con el peer para un stream cifrado
+
+        Archivos y media derivan de él la clave de su stream; el receptor
+        la encuentra por el session_id (receive_secret). Sin sesión se
+        inicia el handshake.
+
+        Returns:
+            Tupla (session_id, secreto), o None si aún no hay sesión
+        """
+        with self.lock:
+            session = self.sessions.get(peer_onion)
+            init = self._start_handshake(peer_onion) if session is None else None
+
+        if init is not None:
+            self.p2p_network.send_packet(peer_onion, init)
+        if session is None:
+            return None
+        return session.session_id, session.send_secret
+
+    def receive_secret(self, peer_onion, session_id):
+        """
+        Secreto de recepción de una sesión del peer (streams entrantes)
+
+        Returns:
+            Secreto, o None si la sesión no existe o es de otro peer
+        """
+        with self.lock:
+            peer, session = self.receiving.get(session_id, (None, None))
+        if session is None or peer != peer_onion:
+            return None
+        return session.receive_secret
+
+    def has_session(self, peer_onion):
+        """Hay una sesión establecida con el peer"""
+        with self.lock:
+            return peer_onion in self.sessions
+
+    def request_session(self, peer_onion):
+        """
+        Negociar sesión con un peer que nos escribió sin una válida
+
+        El pedido viene de un paquete recibido: limitado por el balde común
+        y a un handshake reciente por peer. Sin clave fijada no se negocia.
+        """
+        with self.lock:
+            if peer_onion not in self.peer_keys:
+                return
+            if not self.unsolicited.consume():
+                self.stats['handshakes_limited'] += 1
+                return
+            init = self._start_handshake(peer_onion)
+
+        if init is not None:
+            self.p2p_network.send_packet(peer_onion, init)
+
+    def get_stats(self):
+        """Handshakes, renovaciones y mensajes cifrados"""
+        with self.lock:
+            self._expire_handshakes(time.monotonic())
+            stats = dict(self.stats)
+            stats['sessions'] = len(self.sessions)
+            stats['pending'] = sum(len(texts) for texts in self.pending.values())
+            stats['handshakes_in_flight'] = sum(len(started) for started in self.handshakes.values())
+            return stats
+
+    def _queue_text(self, peer_onion, text):
+        """Guardar texto hasta que haya sesión (llamar con el lock tomado)"""
+        texts = self.pending.get(peer_onion)
+        if texts is None:
+            texts = self.pending[peer_onion] = []
+            while len(self.pending) > MAX_HANDSHAKE_PEERS:
+                _, dropped = self.pending.popitem(last=False)
+                self.stats['pending_dropped'] += len(dropped)
+        else:
+            self.pending.move_to_end(peer_onion)
+
+        texts.append(text)
+        if len(texts) > MAX_PENDING_TEXTS:
+            del texts[0]
+            self.stats['pending_dropped'] += 1
+
+    def _expire_handshakes(self, now):
+        """Olvidar handshakes sin respuesta tras handshake_ttl (llamar con el lock tomado)"""
+        for peer_onion in list(self.handshakes):
+            started = self.handshakes[peer_onion]
+            alive = [h for h in started if now - h.started < self.handshake_ttl]
+            self.stats['handshakes_expired'] += len(started) - len(alive)
+            if alive:
+                self.handshakes[peer_onion] = alive
+                continue
+
+            del self.handshakes[peer_onion]
+            # Sin handshake en curso los textos no saldrían nunca
+            dropped = self.pending.pop(peer_onion, None)
+            if dropped:
+                self.stats['pending_dropped'] += len(dropped)
+                print(f"{len(dropped)} mensajes a {peer_onion} descartados: sin sesión")
+
+    def _fresh_handshake(self, peer_onion, now):
+        """Nuestro último handshake con el peer aún espera respuesta"""
+        started = self.handshakes.get(peer_onion)
+        return bool(started) and now - started[-1].started < NETWORK_CONFIG['connection_timeout']
+
+    def _start_handshake(self, peer_onion):
+        """
+        Preparar 'session_init' (llamar con el lock tomado)
+
+        El paquete pasa por el outbox: si el peer está offline le llega al
+        volver. Los handshakes anteriores sin respuesta se conservan (unos
+        pocos) por si su respuesta llega después.
+
+        Returns:
+            Paquete a enviar, o None si ya hay un handshake reciente en curso
+            o el peer no tiene clave fijada (su respuesta se rechazaría)
+        """
+        if peer_onion not in self.peer_keys:
+            return None
+
+        now = time.monotonic()
+        self._expire_handshakes(now)
+        if self._fresh_handshake(peer_onion, now):
+            return None
+
+        started = self.handshakes.get(peer_onion)
+        if started is None:
+            started = self.handshakes[peer_onion] = []
+            while len(self.handshakes) > MAX_HANDSHAKE_PEERS:
+                oldest, _ = self.handshakes.popitem(last=False)
+                self.pending.pop(oldest, None)
+        else:
+            self.handshakes.move_to_end(peer_onion)
+
+        handshake = _Handshake(str(uuid.uuid4()))
+        started.append(handshake)
+        del started[:-MAX_HANDSHAKES]
+        return self._handshake_packet('session_init', peer_onion, handshake)
+
+    def _handshake_packet(self, packet_type, peer_onion, handshake):
+        """Paquete de handshake con la clave efímera firmada"""
+        my_onion = self.p2p_network.tor_manager.onion_address
+        return {
+            'type': packet_type,
+            'to': peer_onion,
+            'session_id': handshake.session_id,
+            'ephemeral_key': handshake.public_key,
+            'identity_key': self.crypto_manager.export_public_key(),
+            'signature': self.crypto_manager.sign_message(
+                self._transcript(handshake.session_id, handshake.public_key,
+                                 my_onion, peer_onion)
+            ),
+        }
+
+    @staticmethod
+    def _transcript(session_id, ephemeral_key, sender, recipient):
+        """Texto firmado: ata la clave efímera a la sesión y a ambos peers"""
+        return f'{session_id}|{ephemeral_key}|{sender}|{recipient}'
+
+    def _verify(self, packet):
+        """
+        Comprobar firma e identidad de un paquete de handshake
+
+        La firma solo prueba que el remitente tiene la clave que adjunta, no
+        que sea dueño del .onion: la clave tiene que ser la ya fijada.
+
+        Returns:
+            Dirección del peer o None si se rechaza
+        """
+        peer_onion = packet.get('from')
+        my_onion = self.p2p_network.tor_manager.onion_address
+        identity_key = packet.get('identity_key')
+
+        if packet.get('to') != my_onion or not peer_onion or not identity_key:
+            return self._reject(peer_onion, "handshake mal dirigido")
+
+        transcript = self._transcript(
+            packet.get('session_id'), packet.get('ephemeral_key'), peer_onion, my_onion
+        )
+        if not self.crypto_manager.verify_signature(
+                transcript, packet.get('signature', ''), identity_key):
+            return self._reject(peer_onion, "firma inválida")
+
+        known = self.peer_keys.get(peer_onion)
+        if known != identity_key:
+            # Solo el usuario puede fijar o reemplazar la clave
+            if self.on_key_offered is not None:
+                self.on_key_offered(peer_onion, identity_key, known is not None)
+            if known is None:
+                return self._reject(peer_onion, "clave de identidad no fijada")
+            return self._reject(peer_onion, "clave de identidad distinta a la conocida")
+
+        return peer_onion
+
+    def _reject(self, peer_onion, reason):
+        print(f"Handshake de {peer_onion} rechazado: {reason}")
+        with self.lock:
+            self.stats['rejected'] += 1
+        return None
+
+    def _derive(self, handshake, peer_ephemeral_key, initiator):
+        """
+        Secretos de envío y recepción de la sesión
+
+        Args:
+            handshake: Nuestro _Handshake (clave efímera privada)
+            peer_ephemeral_key: Clave efímera del peer (hex)
+            initiator: True si enviamos el 'session_init'
+        """
+        handshake.ecdh.load_received_public_key_bytes(bytes.fromhex(peer_ephemeral_key))
+        shared = handshake.ecdh.generate_sharedsecret_bytes()
+
+        keys = hkdf_sha256(
+            shared, handshake.session_id.encode('utf-8'), SESSION_INFO, 64
+        )
+        initiator_key, responder_key = keys[:32].hex(), keys[32:].hex()
+
+        if initiator:
+            return _Session(handshake.session_id, initiator_key, responder_key)
+        return _Session(handshake.session_id, responder_key, initiator_key)
+
+    def _install(self, peer_onion, session):
+        """Activar sesión y soltar los textos en espera (llamar con el lock tomado)"""
+        previous = self.sessions.get(peer_onion)
+        self.sessions[peer_onion] = session
+        self.receiving[session.session_id] = (peer_onion, session)
+
+        # La sesión anterior sigue descifrando lo que ya estaba en camino;
+        # la de antes se olvida
+        for session_id, (peer, old) in list(self.receiving.items()):
+            if peer == peer_onion and old is not session and old is not previous:
+                del self.receiving[session_id]
+
+        self.stats['handshakes'] += 1
+        return self.pending.pop(peer_onion, [])
+
+    def _on_session_init(self, packet):
+        """Handler P2P de 'session_init': responder y activar la sesión"""
+        peer_onion = self._verify(packet)
+        if peer_onion is None:
+            return None
+
+        my_onion = self.p2p_network.tor_manager.onion_address
+
+        with self.lock:
+            # Ambos iniciaron a la vez: sigue el handshake del de dirección
+            # menor. Uno nuestro ya viejo (perdido, o el peer lo descartó)
+            # no frena el del peer
+            if my_onion < peer_onion and self._fresh_handshake(peer_onion, time.monotonic()):
+                return None
+            self.handshakes.pop(peer_onion, None)
+
+            handshake = _Handshake(packet['session_id'])
+            session = self._derive(handshake, packet['ephemeral_key'], initiator=False)
+            accept = self._handshake_packet('session_accept', peer_onion, handshake)
+            pending = self._install(peer_onion, session)
+
+        self.p2p_network.send_packet(peer_onion, accept)
+        self._flush(peer_onion, session, pending)
+        return None
+
+    def _on_session_accept(self, packet):
+        """Handler P2P de 'session_accept': completar nuestro handshake"""
+        peer_onion = self._verify(packet)
+        if peer_onion is None:
+            return None
+
+        with self.lock:
+            started = self.handshakes.get(peer_onion, [])
+            handshake = next(
+                (h for h in started if h.session_id == packet.get('session_id')), None
+            )
+            if handshake is None:
+                return None  # Respuesta a un handshake ya olvidado
+            started.remove(handshake)
+
+            session = self._derive(handshake, packet['ephemeral_key'], initiator=True)
+            pending = self._install(peer_onion, session)
+
+        self._flush(peer_onion, session, pending)
+        return None
+
+    def _flush(self, peer_onion, session, texts):
+        """Enviar los textos que esperaban la sesión"""
+        for text in texts:
+            session.sent += 1
+            self._send_encrypted(peer_onion, session, text)
+
+    def _send_encrypted(self, peer_onion, session, text):
+        """Cifrar con la clave de envío (solo AES) y encolar"""
+        data = self.crypto_manager.encrypt_message(text, session.send_secret)
+
+        with self.lock:
+            self.stats['encrypted'] += 1
+
+        self.p2p_network.send_packet(peer_onion, {
+            'type': 'session_message',
+            'to': peer_onion,
+            'session_id': session.session_id,
+            'data': data,
+            'message_id': str(uuid.uuid4()),
+        })
+
+    def _on_session_message(self, packet):
+        """Handler P2P de 'session_message': descifrar con la sesión"""
+        with self.lock:
+            peer_onion, session = self.receiving.get(packet.get('session_id'), (None, None))
+
+        if session is None or peer_onion != packet.get('from'):
+            # Sesión perdida (p. ej. reiniciamos): negociar una nueva para
+            # los próximos mensajes; este no se puede descifrar
+            print(f"Mensaje de sesión desconocida de {packet.get('from')}")
+            with self.lock:
+                self.stats['decrypt_failed'] += 1
+            if packet.get('from'):
+                self.request_session(packet.get('from'))
+            return None
+
+        try:
+            text = self.crypto_manager.decrypt_message(packet['data'], session.receive_secret)
+        except Exception as e:
+            print(f"Error desencriptando mensaje: {e}")
+            with self.lock:
+                self.stats['decrypt_failed'] += 1
+            return None
+
+        with self.lock:
+            self.stats['decrypted'] += 1
+
+        return {
+            'type': 'chat_message',
+            'from': peer_onion,
+            'timestamp': packet.get('timestamp', now_ms()),
+            'message_id': packet.get('message_id'),
+            'text': text,
+        }
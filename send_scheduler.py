@@ -0,0 +1,345 @@
+"""
+Planificador de Envíos
+Colas salientes por destinatario atendidas por varios senders
+"""
+
+import threading
+import time
+from collections import deque
+
+# Clases de tráfico, de mayor a menor prioridad
+PRIORITY_CONTROL = 0  # Señalización: claves, llamadas
+PRIORITY_CHAT = 1  # Mensajes de chat
+PRIORITY_BULK = 2  # Chunks de archivos
+PRIORITY_MEDIA = 3  # Tiempo real: frames de video (con deadline)
+PRIORITY_CLASSES = 4
+
+
+class PeerQueue:
+    """Cola de paquetes pendientes hacia un peer"""
+
+    def __init__(self, onion_address, lock):
+        self.onion_address = onion_address
+        self.packets = [deque() for _ in range(PRIORITY_CLASSES)]
+        self.pending = 0
+
+        # Avisa al sender que espera más paquetes para agruparlos
+        self.arrival = threading.Condition(lock)
+
+        # Un solo sender atiende al peer a la vez (mantiene el orden)
+        self.busy = False
+        self.scheduled = None  # Clase con la que está en la lista de listos
+
+        # Clases sin crédito de control de flujo: esperan aunque tengan
+        # paquetes, sin adelantar ni retrasar al resto
+        self.blocked = set()
+        self.last_activity = time.time()
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped_stale = 0
+        self.max_depth = 0
+        self.avg_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, enqueued_at, success):
+        """Registrar resultado de un envío y su latencia en cola"""
+        latency = time.time() - enqueued_at
+
+        if success:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+        # Media móvil exponencial para no guardar historial
+        if self.sent + self.failed == 1:
+            self.avg_latency = latency
+        else:
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_activity = time.time()
+
+    def head_priority(self):
+        """Clase más prioritaria con paquetes enviables (o None)"""
+        for priority, packets in enumerate(self.packets):
+            if packets and priority not in self.blocked:
+                return priority
+        return None
+
+    def get_stats(self):
+        """Estadísticas de la cola"""
+        return {
+            'depth': self.pending,
+            'depth_by_class': [len(packets) for packets in self.packets],
+            'blocked_classes': sorted(self.blocked),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped_stale': self.dropped_stale,
+            'avg_latency_ms': round(self.avg_latency * 1000, 1),
+            'max_latency_ms': round(self.max_latency * 1000, 1),
+        }
+
+
+class SendScheduler:
+    """
+    Colas salientes independientes por destinatario
+
+    Un peer lento o desconectado solo retrasa su propia cola: los senders
+    toman peers con tráfico pendiente de una lista de listos y cada peer
+    es atendido por un único sender a la vez.
+
+    Dentro de cada peer los paquetes salen por clase de tráfico (control,
+    chat, archivos, media) y los paquetes con deadline vencido se descartan
+    en vez de enviarse.
+    """
+
+    def __init__(self, burst=16, on_ready=None):
+        """
+        Args:
+            burst: Máximo de frames enviados a un peer antes de ceder
+                   el sender a otros peers
+            on_ready: Callback(onion) para motores que no usan acquire()
+                      (asyncio); si se define, no se usa la lista de listos
+        """
+        self.burst = burst
+        self.on_ready = on_ready
+
+        self.peers = {}
+        self.ready = [deque() for _ in range(PRIORITY_CLASSES)]
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    def put(self, onion_address, packet, priority=PRIORITY_CHAT, deadline=None,
+            entry=None):
+        """
+        Agregar paquete a la cola del destinatario
+
+        Args:
+            onion_address: Dirección .onion del destinatario
+            packet: Paquete a enviar
+            priority: Clase de tráfico (PRIORITY_*)
+            deadline: time.time() a partir del cual el paquete ya no sirve
+            entry: Entrada del outbox (se devuelve junto al paquete en pop)
+        """
+        now = time.time()
+
+        with self.condition:
+            peer = self.peers.get(onion_address)
+            if peer is None:
+                peer = PeerQueue(onion_address, self.lock)
+                self.peers[onion_address] = peer
+
+            peer.packets[priority].append((now, packet, deadline, entry))
+            peer.pending += 1
+            peer.max_depth = max(peer.max_depth, peer.pending)
+            peer.last_activity = now
+
+            # Sin crédito: se enviará cuando se desbloquee la clase
+            notify = priority not in peer.blocked and self._wake(peer, priority)
+
+        if notify:
+            self.on_ready(onion_address)
+
+    def acquire(self, timeout=1.0):
+        """
+        Esperar un peer con paquetes pendientes y reservarlo
+
+        Returns:
+            PeerQueue reservado o None si venció el timeout
+        """
+        with self.condition:
+            peer = self._next_ready()
+            if peer is None:
+                self.condition.wait(timeout)
+                peer = self._next_ready()
+                if peer is None:
+                    return None
+
+            peer.scheduled = None
+            peer.busy = True
+            return peer
+
+    def release(self, peer):
+        """Liberar peer reservado; vuelve a la lista si quedan paquetes"""
+        with self.condition:
+            peer.busy = False
+
+            priority = peer.head_priority()
+            if priority is not None and peer.scheduled is None:
+                self._schedule(peer, priority)
+
+    def pop(self, peer, timeout=0, priority=None):
+        """
+        Sacar el paquete más prioritario de un peer
+
+        Las clases bloqueadas por control de flujo se saltan.
+
+        Args:
+            peer: PeerQueue reservado con acquire()
+            timeout: Segundos a esperar si la cola está vacía
+            priority: Sacar solo de esta clase (lotes de un único stream)
+
+        Returns:
+            Tupla (enqueued_at, packet, entry, priority) o None si no hay
+            paquetes enviables
+        """
+        with self.condition:
+            if timeout > 0:
+                empty = (
+                    not peer.pending if priority is None
+                    else not peer.packets[priority]
+                )
+                if empty:
+                    peer.arrival.wait(timeout)
+
+            now = time.time()
+
+            for current, packets in enumerate(peer.packets):
+                if current in peer.blocked:
+                    continue
+                if priority is not None and current != priority:
+                    continue
+
+                while packets:
+                    enqueued_at, packet, deadline, entry = packets.popleft()
+                    peer.pending -= 1
+
+                    if deadline is not None and deadline < now:
+                        peer.dropped_stale += 1
+                        continue
+
+                    return enqueued_at, packet, entry, current
+
+            return None
+
+    def block(self, onion_address, priority):
+        """Detener una clase de un peer hasta que recupere crédito"""
+        with self.condition:
+            peer = self.peers.get(onion_address)
+            if peer is not None:
+                peer.blocked.add(priority)
+
+    def unblock(self, onion_address, priority=None):
+        """
+        Reanudar clases bloqueadas de un peer
+
+        Args:
+            priority: Clase a reanudar (None = todas, p. ej. conexión nueva)
+        """
+        with self.condition:
+            peer = self.peers.get(onion_address)
+            if peer is None or not peer.blocked:
+                return
+
+            if priority is None:
+                peer.blocked.clear()
+            else:
+                peer.blocked.discard(priority)
+
+            head = peer.head_priority()
+            notify = head is not None and self._wake(peer, head)
+
+        if notify:
+            self.on_ready(onion_address)
+
+    def drain(self, peer):
+        """
+        Vaciar la cola de un peer inalcanzable
+
+        Returns:
+            Lista de tuplas (enqueued_at, entry) de los paquetes quitados
+        """
+        with self.condition:
+            drained = []
+
+            for packets in peer.packets:
+                drained.extend((item[0], item[3]) for item in packets)
+                packets.clear()
+
+            peer.pending = 0
+            return drained
+
+    def get_peer(self, onion_address):
+        """Obtener (o crear) la cola de un peer"""
+        with self.condition:
+            peer = self.peers.get(onion_address)
+            if peer is None:
+                peer = PeerQueue(onion_address, self.lock)
+                self.peers[onion_address] = peer
+            return peer
+
+    def wake_all(self):
+        """Despertar a los senders que esperan (para detenerlos)"""
+        with self.condition:
+            self.condition.notify_all()
+
+    def prune(self, idle_timeout):
+        """Olvidar colas vacías sin actividad reciente"""
+        now = time.time()
+
+        with self.condition:
+            for onion, peer in list(self.peers.items()):
+                idle = now - peer.last_activity > idle_timeout
+                if (idle and not peer.pending and not peer.busy
+                        and peer.scheduled is None):
+                    del self.peers[onion]
+
+    def idle(self):
+        """Sin paquetes pendientes ni senders escribiendo (para drenar al detener)"""
+        with self.condition:
+            return not any(
+                peer.pending or peer.busy for peer in self.peers.values()
+            )
+
+    def qsize(self):
+        """Total de paquetes pendientes"""
+        with self.condition:
+            return sum(peer.pending for peer in self.peers.values())
+
+    def _wake(self, peer, priority):
+        """
+        Avisar que el peer tiene paquetes de `priority` (llamar con el lock
+        tomado)
+
+        Returns:
+            True si hay que llamar a on_ready (fuera del lock)
+        """
+        if self.on_ready is not None:
+            return True
+
+        if peer.busy:
+            peer.arrival.notify()
+        elif peer.scheduled is None or priority < peer.scheduled:
+            # Un paquete más urgente adelanta al peer en la lista
+            self._schedule(peer, priority)
+
+        return False
+
+    def _schedule(self, peer, priority):
+        """Poner peer en la lista de listos (llamar con el lock tomado)"""
+        peer.scheduled = priority
+        self.ready[priority].append(peer)
+        self.condition.notify()
+
+    def _next_ready(self):
+        """
+        Sacar el peer listo más prioritario (llamar con el lock tomado)
+
+        Un peer puede quedar repetido en varias listas si recibió tráfico
+        más urgente; las entradas que ya no corresponden se descartan.
+        """
+        for priority, ready in enumerate(self.ready):
+            while ready:
+                peer = ready.popleft()
+                if peer.scheduled == priority and not peer.busy:
+                    return peer
+        return None
+
+    def get_stats(self):
+        """Estadísticas por peer (profundidad y latencia en cola)"""
+        with self.condition:
+            return {
+                onion: peer.get_stats()
+                for onion, peer in self.peers.items()
+            }
@@ -0,0 +1,216 @@
+"""
+Multiplexación de Streams
+Streams lógicos con control de flujo sobre la conexión de cada peer
+"""
+
+import threading
+import time
+
+from packet_codec import CodecError, decode_packet, encode_packet
+from wire_protocol import FRAME_HELLO, FrameError, encode_frame
+
+MUX_VERSION = 1
+
+# Stream 0: frames de la propia conexión (HELLO, WINDOW_UPDATE). Cada clase
+# de tráfico del planificador viaja en su propio stream a partir del 1.
+STREAM_CONNECTION = 0
+
+
+def stream_for(priority):
+    """Stream de una clase de tráfico (PRIORITY_*)"""
+    return priority + 1
+
+
+def priority_for(stream_id):
+    """Clase de tráfico de un stream"""
+    return stream_id - 1
+
+
+def encode_hello(onion_address, window, compression=None):
+    """
+    Frame HELLO: identifica al peer y anuncia su ventana de recepción
+
+    Args:
+        onion_address: Dirección .onion propia
+        window: Bytes que el peer puede enviar por stream sin esperar crédito
+        compression: Al abrir, lista de métodos de compresión aceptados; al
+            responder, el método elegido (None = sin compresión)
+    """
+    hello = {
+        'type': 'hello',
+        'from': onion_address,
+        'version': MUX_VERSION,
+        'window': window,
+    }
+    if compression:
+        hello['compression'] = compression
+    return encode_frame(FRAME_HELLO, encode_packet(hello))
+
+
+def decode_hello(payload):
+    """
+    Interpretar frame HELLO
+
+    Returns:
+        Diccionario con 'from', 'version' y 'window'
+    """
+    try:
+        hello = decode_packet(payload)
+    except CodecError as e:
+        raise FrameError(f"HELLO inválido: {e}")
+
+    window = hello.get('window') if isinstance(hello, dict) else None
+    if not isinstance(window, int) or window <= 0:
+        raise FrameError(f"HELLO sin ventana válida: {hello!r}")
+
+    return hello
+
+
+class SendWindows:
+    """
+    Créditos de envío por stream de una conexión saliente
+
+    Cada frame enviado por un stream consume crédito; al agotarse, la clase
+    de tráfico espera hasta que el receptor devuelva crédito con
+    WINDOW_UPDATE a medida que procesa los frames. Así un archivo grande
+    solo ocupa una ventana de la conexión y el chat no queda detrás de
+    megabytes encolados en Tor.
+
+    Hasta que el receptor responde al HELLO los frames van sin stream
+    (formato compatible) con una ventana por clase como presupuesto. Si no
+    responde a tiempo es una versión anterior: se deja de limitar.
+    """
+
+    PENDING = 'pending'
+    MUX = 'mux'
+    LEGACY = 'legacy'
+
+    def __init__(self, window):
+        self.window = window
+        self.state = self.PENDING
+        self.opened_at = time.time()
+        self.credit = {}  # stream -> bytes disponibles (puede ser negativo)
+        self.compression = None  # Método aceptado por el receptor
+        self.stalls = 0
+        self.lock = threading.Lock()
+
+    @property
+    def multiplexed(self):
+        """El peer respondió al HELLO: los frames llevan id de stream"""
+        return self.state == self.MUX
+
+    def budget(self, stream_id):
+        """
+        Bytes que se pueden enviar ahora por el stream
+
+        Returns:
+            Bytes disponibles (0 si está agotado) o None si no hay límite
+        """
+        with self.lock:
+            if self.state == self.LEGACY:
+                return None
+            return max(0, self.credit.get(stream_id, self.window))
+
+    def consume(self, stream_id, size, multiplexed):
+        """
+        Descontar un frame enviado
+
+        Un lote puede pasarse del crédito restante: el exceso se descuenta
+        del siguiente crédito en vez de partir el lote.
+
+        Args:
+            multiplexed: El frame se envió con id de stream
+
+        Returns:
+            True si el stream quedó sin crédito
+        """
+        with self.lock:
+            # Frame codificado antes de un cambio de modo: el receptor no
+            # lo contará, tampoco se descuenta aquí
+            if self.state == self.LEGACY or multiplexed != (self.state == self.MUX):
+                return False
+
+            credit = self.credit.get(stream_id, self.window) - size
+            self.credit[stream_id] = credit
+
+            if credit <= 0:
+                self.stalls += 1
+                return True
+            return False
+
+    def grant(self, stream_id, increment):
+        """
+        Sumar crédito devuelto por el receptor
+
+        Returns:
+            True si el stream estaba agotado y vuelve a tener crédito
+        """
+        with self.lock:
+            if self.state != self.MUX:
+                return False
+
+            previous = self.credit.get(stream_id, self.window)
+            self.credit[stream_id] = previous + increment
+            return previous <= 0 < previous + increment
+
+    def open(self, window, compression=None):
+        """El receptor respondió al HELLO con su ventana (y compresión)"""
+        with self.lock:
+            self.state = self.MUX
+            self.window = window
+            self.compression = compression
+            self.credit = {}
+
+    def fallback(self):
+        """El peer no habla el protocolo de streams: enviar sin límite"""
+        with self.lock:
+            self.state = self.LEGACY
+            self.credit = {}
+
+    def hello_expired(self, timeout):
+        """Venció la espera de respuesta al HELLO"""
+        return self.state == self.PENDING and time.time() - self.opened_at > timeout
+
+    def get_stats(self):
+        """Modo y crédito por stream"""
+        with self.lock:
+            return {
+                'state': self.state,
+                'window': self.window,
+                'compression': self.compression,
+                'credit': dict(self.credit),
+                'stalls': self.stalls,
+            }
+
+
+class ReceiveWindows:
+    """
+    Bytes procesados por stream en una conexión entrante
+
+    El crédito se devuelve en bloques de un cuarto de ventana para no
+    responder con un WINDOW_UPDATE a cada frame.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.threshold = max(1, window // 4)
+        self.consumed = {}
+        self.peer = None  # Dirección anunciada en el HELLO
+        self.compression = None  # Método elegido al responder el HELLO
+        self.buckets = None  # Baldes de admisión de la conexión
+
+    def consume(self, stream_id, size):
+        """
+        Registrar un frame procesado
+
+        Returns:
+            Crédito a devolver al emisor (0 si aún no toca)
+        """
+        consumed = self.consumed.get(stream_id, 0) + size
+
+        if consumed < self.threshold:
+            self.consumed[stream_id] = consumed
+            return 0
+
+        self.consumed[stream_id] = 0
+        return consumed
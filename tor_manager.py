@@ -3,7 +3,10 @@ Módulo de Gestión de Tor
 Manejo de servicios ocultos y enrutamiento anónimo
 """
 
+import asyncio
+import json
 import socket
+import struct
 import subprocess
 import time
 import os
@@ -11,6 +14,9 @@ import signal
 from pathlib import Path
 import threading
 
+from wire_protocol import FrameReader, FrameError, FRAME_PACKET, FRAME_BINARY
+from packet_codec import CodecError, decode_packet, json_default
+
 
 class TorManager:
     """Gestor de conexión Tor y servicios ocultos"""
@@ -157,6 +163,66 @@ StrictNodes 1
             print(f"Error conectando a {onion_address}: {e}")
             return None
     
+    async def connect_to_onion_async(self, onion_address, port=80, timeout=30):
+        """
+        Conectar a un servicio .onion desde asyncio (SOCKS5 sin bloquear)
+        
+        Args:
+            onion_address: Dirección .onion del destino
+            port: Puerto virtual del servicio oculto
+            timeout: Segundos máximos para conexión + handshake
+            
+        Returns:
+            Tupla (StreamReader, StreamWriter) o None si falla
+        """
+        writer = None
+        
+        try:
+            async def handshake():
+                nonlocal writer
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', self.tor_port
+                )
+                
+                # Saludo: versión 5, un método, sin autenticación
+                writer.write(b'\x05\x01\x00')
+                await writer.drain()
+                
+                if await reader.readexactly(2) != b'\x05\x00':
+                    raise ConnectionError("Proxy SOCKS rechazó el saludo")
+                
+                # CONNECT por nombre de dominio (Tor resuelve el .onion)
+                host = onion_address.encode('idna')
+                writer.write(
+                    b'\x05\x01\x00\x03' + bytes([len(host)]) + host +
+                    struct.pack('!H', port)
+                )
+                await writer.drain()
+                
+                reply = await reader.readexactly(4)
+                if reply[1] != 0:
+                    raise ConnectionError(f"SOCKS CONNECT falló (código {reply[1]})")
+                
+                # Descartar dirección enlazada según su tipo
+                atyp = reply[3]
+                if atyp == 1:
+                    await reader.readexactly(4 + 2)
+                elif atyp == 4:
+                    await reader.readexactly(16 + 2)
+                else:
+                    length = (await reader.readexactly(1))[0]
+                    await reader.readexactly(length + 2)
+                
+                return reader, writer
+            
+            return await asyncio.wait_for(handshake(), timeout)
+            
+        except Exception as e:
+            if writer:
+                writer.close()
+            print(f"Error conectando a {onion_address}: {e}")
+            return None
+    
     def get_tor_ip(self):
         """Obtener IP pública a través de Tor (para verificar)"""
         try:
@@ -273,23 +339,29 @@ class TorListener(threading.Thread):
     
     def _handle_connection(self, client_socket):
         """Manejar conexión entrante"""
+        reader = FrameReader(client_socket)
+        
         try:
-            # Recibir datos
-            data = b""
-            while True:
-                chunk = client_socket.recv(4096)
-                if not chunk:
+            # Recibir frames (los emisores reutilizan la conexión)
+            while self.running:
+                frame = reader.read_frame()
+                if frame is None:
                     break
-                data += chunk
                 
-                # Si recibimos mensaje completo (terminado en \n\n)
-                if b"\n\n" in data:
-                    break
-            
-            if data:
-                # Llamar callback con los datos
-                self.callback(data.decode('utf-8'))
+                frame_type, flags, payload = frame
+                if frame_type == FRAME_PACKET:
+                    self.callback(str(payload, 'utf-8'))
+                elif frame_type == FRAME_BINARY:
+                    # Entregar como JSON para mantener la firma del callback
+                    try:
+                        packet = decode_packet(payload)
+                    except CodecError as e:
+                        print(f"Paquete inválido: {e}")
+                        continue
+                    self.callback(json.dumps(packet, default=json_default))
             
+        except FrameError as e:
+            print(f"Frame inválido: {e}")
         except Exception as e:
             print(f"Error manejando conexión: {e}")
         finally:
@@ -302,6 +374,22 @@ class TorListener(threading.Thread):
             self.server_socket.close()
 
 
+def create_tor_manager():
+    """
+    Crear gestor de Tor según DEV_CONFIG['mock_tor']
+    
+    Returns:
+        TorManager o MockTorManager (red simulada local, sin binario tor)
+    """
+    from config import DEV_CONFIG
+    
+    if DEV_CONFIG['mock_tor']:
+        from mock_tor import MockTorManager
+        return MockTorManager()
+    
+    return TorManager()
+
+
 # Configuración para Android con Orbot
 class OrbotManager:
     """
@@ -354,7 +442,7 @@ if __name__ == '__main__':
     # Test de TorManager
     print("=== Test de TorManager ===\n")
     
-    tor = TorManager()
+    tor = create_tor_manager()
     
     if tor.start_tor():
         # Obtener dirección .onion
@@ -5,11 +5,11 @@ Funciones auxiliares y helpers
 
 import hashlib
 import base64
-import qrcode
 from io import BytesIO
 import json
 import os
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 import re
 
 
@@ -28,6 +28,9 @@ class Utils:
         Returns:
             Imagen PIL del QR code
         """
+        # Import local: qrcode solo hace falta en la UI
+        import qrcode
+        
         qr = qrcode.QRCode(
             version=1,
             error_correction=qrcode.constants.ERROR_CORRECT_H,
@@ -112,12 +115,14 @@ class Utils:
         Formatear timestamp para mostrar
         
         Args:
-            timestamp: ISO timestamp o datetime
+            timestamp: Milisegundos desde epoch, ISO timestamp o datetime
             
         Returns:
             String formateado (ej: "14:30" o "Ayer 14:30")
         """
-        if isinstance(timestamp, str):
+        if isinstance(timestamp, (int, float)):
+            dt = datetime.fromtimestamp(timestamp / 1000)
+        elif isinstance(timestamp, str):
             dt = datetime.fromisoformat(timestamp)
         else:
             dt = timestamp
@@ -323,54 +328,291 @@ class ContactVerifier:
         return f"{code[:3]}-{code[3:]}"
 
 
+# Límites de los histogramas de duración (segundos)
+DURATION_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+class Histogram:
+    """Histograma de duraciones con buckets fijos (estilo Prometheus)"""
+    
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Último: +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, value):
+        """Registrar una duración en segundos"""
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def percentile(self, fraction):
+        """
+        Estimar percentil interpolando dentro del bucket
+        
+        Returns:
+            Segundos (o None si no hay muestras)
+        """
+        if not self.count:
+            return None
+        
+        rank = fraction * self.count
+        seen = 0
+        lower = 0.0
+        
+        for index, count in enumerate(self.counts):
+            upper = self.buckets[index] if index < len(self.buckets) else self.max
+            if count and seen + count >= rank:
+                position = (rank - seen) / count
+                return min(self.max, lower + (upper - lower) * position)
+            seen += count
+            lower = upper
+        
+        return self.max
+    
+    def snapshot(self):
+        """Resumen en milisegundos"""
+        def ms(value):
+            return None if value is None else round(value * 1000, 3)
+        
+        return {
+            'count': self.count,
+            'sum_ms': ms(self.total),
+            'mean_ms': ms(self.total / self.count) if self.count else None,
+            'p50_ms': ms(self.percentile(0.50)),
+            'p95_ms': ms(self.percentile(0.95)),
+            'p99_ms': ms(self.percentile(0.99)),
+            'max_ms': ms(self.max),
+        }
+
+
+def _label(value):
+    """Escapar un valor de etiqueta de Prometheus (\\, comillas y saltos)"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
 class NetworkMonitor:
-    """Monitor de estado de red"""
+    """
+    Monitor de estado de red
+    
+    Thread-safe: lo actualizan a la vez los senders, los threads de
+    recepción y el event loop. Registra contadores y bytes por tipo de
+    paquete, histogramas de duración por etapa (conexión, espera en cola,
+    serialización, cifrado, envío...) y errores por causa.
+    
+    El tipo de un paquete recibido lo elige el peer: pasados MAX_TYPES
+    tipos distintos, los nuevos se suman a 'other'.
+    """
+    
+    MAX_TYPES = 64
     
     def __init__(self):
-        self.stats = {
-            'messages_sent': 0,
-            'messages_received': 0,
-            'bytes_sent': 0,
-            'bytes_received': 0,
-            'connection_attempts': 0,
-            'successful_connections': 0,
-            'failed_connections': 0,
-        }
+        self.lock = threading.Lock()
+        self.started_at = datetime.now()
+        self.reset_stats()
     
-    def record_message_sent(self, size):
-        """Registrar mensaje enviado"""
-        self.stats['messages_sent'] += 1
-        self.stats['bytes_sent'] += size
-    
-    def record_message_received(self, size):
-        """Registrar mensaje recibido"""
-        self.stats['messages_received'] += 1
-        self.stats['bytes_received'] += size
-    
-    def record_connection_attempt(self, success=True):
-        """Registrar intento de conexión"""
-        self.stats['connection_attempts'] += 1
-        if success:
-            self.stats['successful_connections'] += 1
-        else:
-            self.stats['failed_connections'] += 1
+    def record_message_sent(self, size, packet_type='message'):
+        """Registrar paquete enviado"""
+        with self.lock:
+            self.stats['messages_sent'] += 1
+            self.stats['bytes_sent'] += size
+            self._count_type(self.sent_by_type, packet_type, size)
+    
+    def record_message_received(self, size, packet_type='message'):
+        """Registrar paquete recibido"""
+        with self.lock:
+            self.stats['messages_received'] += 1
+            self.stats['bytes_received'] += size
+            self._count_type(self.received_by_type, packet_type, size)
+    
+    def record_connection_attempt(self, success=True, duration=None):
+        """
+        Registrar intento de conexión
+        
+        Args:
+            success: Si se conectó
+            duration: Segundos que tardó (conexión + handshake SOCKS)
+        """
+        with self.lock:
+            self.stats['connection_attempts'] += 1
+            if success:
+                self.stats['successful_connections'] += 1
+            else:
+                self.stats['failed_connections'] += 1
+                self._count_error('connect_failed')
+            
+            if duration is not None:
+                self._histogram('connect').observe(duration)
+    
+    def observe(self, stage, duration):
+        """
+        Registrar duración de una etapa
+        
+        Args:
+            stage: Nombre de la etapa ('queue_wait', 'serialize', 'send'...)
+            duration: Segundos
+        """
+        with self.lock:
+            self._histogram(stage).observe(duration)
+    
+    def record_error(self, cause):
+        """Registrar error por causa ('send_failed', 'frame_invalid'...)"""
+        with self.lock:
+            self._count_error(cause)
     
     def get_stats(self):
         """Obtener estadísticas"""
-        return self.stats.copy()
+        with self.lock:
+            return self.stats.copy()
     
     def get_success_rate(self):
         """Calcular tasa de éxito de conexiones"""
-        attempts = self.stats['connection_attempts']
-        if attempts == 0:
-            return 0.0
+        with self.lock:
+            attempts = self.stats['connection_attempts']
+            if attempts == 0:
+                return 0.0
+            
+            return self.stats['successful_connections'] / attempts * 100
+    
+    def snapshot(self):
+        """
+        Copia consistente de todas las métricas
+        
+        Returns:
+            Diccionario serializable a JSON
+        """
+        with self.lock:
+            return {
+                'uptime': (datetime.now() - self.started_at).total_seconds(),
+                'totals': self.stats.copy(),
+                'sent_by_type': {k: dict(v) for k, v in self.sent_by_type.items()},
+                'received_by_type': {k: dict(v) for k, v in self.received_by_type.items()},
+                'errors': dict(self.errors),
+                'durations': {
+                    stage: histogram.snapshot()
+                    for stage, histogram in self.histograms.items()
+                },
+            }
+    
+    def to_json(self, extra=None):
+        """
+        Exportar snapshot como JSON
+        
+        Args:
+            extra: Valores adicionales (p. ej. estado de colas) a incluir
+        """
+        snapshot = self.snapshot()
+        if extra:
+            snapshot.update(extra)
+        return json.dumps(snapshot, indent=2, default=str)
+    
+    def to_prometheus(self, prefix='deepchat', gauges=None):
+        """
+        Exportar en formato de texto de Prometheus
+        
+        Args:
+            prefix: Prefijo de los nombres de métricas
+            gauges: Diccionario {nombre: valor} con valores instantáneos
+            
+        Returns:
+            Texto en formato de exposición de Prometheus
+        """
+        lines = []
+        
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{prefix}_{name}{labels} {value}")
         
-        return self.stats['successful_connections'] / attempts * 100
+        with self.lock:
+            for key, value in self.stats.items():
+                metric(f"{key}_total", 'counter', [('', value)])
+            
+            for direction, by_type in (('sent', self.sent_by_type),
+                                       ('received', self.received_by_type)):
+                metric(f"packets_{direction}_by_type_total", 'counter', [
+                    (f'{{type="{_label(packet_type)}"}}', values['count'])
+                    for packet_type, values in sorted(by_type.items(), key=lambda item: str(item[0]))
+                ])
+                metric(f"bytes_{direction}_by_type_total", 'counter', [
+                    (f'{{type="{_label(packet_type)}"}}', values['bytes'])
+                    for packet_type, values in sorted(by_type.items(), key=lambda item: str(item[0]))
+                ])
+            
+            metric('errors_total', 'counter', [
+                (f'{{cause="{_label(cause)}"}}', count)
+                for cause, count in sorted(self.errors.items())
+            ])
+            
+            for stage, histogram in sorted(self.histograms.items()):
+                samples = []
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    samples.append((f'_bucket{{le="{bound}"}}', cumulative))
+                samples.append(('_bucket{le="+Inf"}', histogram.count))
+                samples.append(('_sum', round(histogram.total, 6)))
+                samples.append(('_count', histogram.count))
+                
+                lines.append(f"# TYPE {prefix}_{stage}_seconds histogram")
+                for suffix, value in samples:
+                    lines.append(f"{prefix}_{stage}_seconds{suffix} {value}")
+        
+        for name, value in sorted((gauges or {}).items()):
+            metric(name, 'gauge', [('', value)])
+        
+        return '\n'.join(lines) + '\n'
     
     def reset_stats(self):
         """Resetear estadísticas"""
-        for key in self.stats:
-            self.stats[key] = 0
+        with self.lock:
+            self.stats = {
+                'messages_sent': 0,
+                'messages_received': 0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'connection_attempts': 0,
+                'successful_connections': 0,
+                'failed_connections': 0,
+            }
+            self.sent_by_type = {}
+            self.received_by_type = {}
+            self.errors = {}
+            self.histograms = {}
+    
+    def _count_type(self, by_type, packet_type, size):
+        """Sumar paquete a su tipo (llamar con el lock tomado)"""
+        values = by_type.get(packet_type)
+        if values is None:
+            if len(by_type) >= self.MAX_TYPES:
+                packet_type = 'other'
+            values = by_type.setdefault(packet_type, {'count': 0, 'bytes': 0})
+        values['count'] += 1
+        values['bytes'] += size
+    
+    def _count_error(self, cause):
+        """Sumar error (llamar con el lock tomado)"""
+        self.errors[cause] = self.errors.get(cause, 0) + 1
+    
+    def _histogram(self, stage):
+        """Histograma de una etapa (llamar con el lock tomado)"""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        return histogram
 
 
 class Logger:
@@ -0,0 +1,225 @@
+"""
+Protocolo de Cable P2P
+Framing binario con cabecera de longitud fija
+"""
+
+import struct
+
+# Cabecera: magic (2) | versión (1) | tipo (1) | flags (1) | longitud (4)
+MAGIC = b'YS'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!2sBBBI')
+HEADER_SIZE = HEADER.size
+
+# Tipos de frame
+FRAME_PACKET = 1  # Paquete serializado en JSON (compatibilidad)
+FRAME_BINARY = 2  # Paquete serializado con packet_codec
+FRAME_HELLO = 3  # Saludo al abrir la conexión (packet_codec)
+FRAME_WINDOW_UPDATE = 4  # Crédito de control de flujo para un stream
+
+# Flags
+FLAG_STREAM = 0x01  # El payload empieza con el id de stream
+FLAG_COMPRESSED = 0x02  # El paquete (tras el id de stream) va comprimido
+
+STREAM_ID = struct.Struct('!H')
+WINDOW_UPDATE = struct.Struct('!HI')  # stream | incremento en bytes
+
+# Límites
+DEFAULT_MAX_FRAME_SIZE = 2 * 1024 * 1024  # 2 MB
+DEFAULT_BUFFER_SIZE = 128 * 1024  # Cabe un chunk de 64 KB con holgura
+
+
+class FrameError(Exception):
+    """Frame malformado o fuera de los límites del protocolo"""
+
+
+def encode_frame(frame_type, payload, flags=0):
+    """
+    Construir frame listo para enviar
+
+    Args:
+        frame_type: Tipo de frame (FRAME_*)
+        payload: Contenido del frame (bytes)
+        flags: Bits de flags
+
+    Returns:
+        Bytes con cabecera + payload
+    """
+    header = HEADER.pack(MAGIC, PROTOCOL_VERSION, frame_type, flags, len(payload))
+    return header + payload
+
+
+def encode_stream_frame(frame_type, stream_id, payload, flags=0):
+    """
+    Construir frame de datos de un stream multiplexado
+
+    Args:
+        frame_type: FRAME_BINARY o FRAME_PACKET
+        stream_id: Stream lógico al que pertenece el payload
+        payload: Paquete (o lote) serializado
+        flags: Flags además de FLAG_STREAM
+
+    Returns:
+        Bytes con cabecera + id de stream + payload
+    """
+    header = HEADER.pack(
+        MAGIC, PROTOCOL_VERSION, frame_type, flags | FLAG_STREAM,
+        STREAM_ID.size + len(payload)
+    )
+    return b''.join((header, STREAM_ID.pack(stream_id), payload))
+
+
+def split_stream(flags, payload):
+    """
+    Separar el id de stream del payload de un frame de datos
+
+    Returns:
+        Tupla (stream_id o None si el frame no es de un stream, payload)
+    """
+    if not flags & FLAG_STREAM:
+        return None, payload
+
+    if len(payload) < STREAM_ID.size:
+        raise FrameError("Frame de stream sin id")
+
+    return STREAM_ID.unpack_from(payload)[0], payload[STREAM_ID.size:]
+
+
+def encode_window_update(stream_id, increment):
+    """Frame que devuelve `increment` bytes de crédito al emisor de un stream"""
+    return encode_frame(FRAME_WINDOW_UPDATE, WINDOW_UPDATE.pack(stream_id, increment))
+
+
+def decode_window_update(payload):
+    """
+    Returns:
+        Tupla (stream_id, incremento)
+    """
+    if len(payload) != WINDOW_UPDATE.size:
+        raise FrameError(f"WINDOW_UPDATE de {len(payload)} bytes")
+
+    return WINDOW_UPDATE.unpack(payload)
+
+
+def decode_header(data):
+    """
+    Interpretar cabecera de frame
+
+    Args:
+        data: Al menos HEADER_SIZE bytes
+
+    Returns:
+        Tupla (frame_type, flags, length)
+    """
+    magic, version, frame_type, flags, length = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise FrameError(f"Magic inválido: {magic!r}")
+    if version != PROTOCOL_VERSION:
+        raise FrameError(f"Versión de protocolo no soportada: {version}")
+
+    return frame_type, flags, length
+
+
+class FrameReader:
+    """
+    Lector de frames sobre un socket
+
+    Lee en un buffer preasignado con recv_into, de modo que un chunk de
+    64 KB se recibe en pocas llamadas al sistema y sin concatenar bytes.
+    Varios frames pueden llegar seguidos por la misma conexión.
+
+    El payload se entrega como memoryview sobre el buffer, sin copiarlo:
+    solo es válido hasta la siguiente llamada a read_frame.
+    """
+
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Inicio de datos sin consumir
+        self.end = 0  # Fin de datos recibidos
+
+        self.bytes_received = 0
+        self.recv_calls = 0
+
+    def read_frame(self):
+        """
+        Leer el siguiente frame completo
+
+        Returns:
+            Tupla (frame_type, flags, payload) o None si el peer cerró;
+            payload es un memoryview que se reutiliza en la próxima lectura
+        """
+        if not self._fill(HEADER_SIZE):
+            return None
+
+        frame_type, flags, length = decode_header(self.view[self.start:])
+
+        if length > self.max_frame_size:
+            raise FrameError(f"Frame demasiado grande: {length} bytes")
+
+        total = HEADER_SIZE + length
+        if not self._fill(total):
+            return None
+
+        payload_start = self.start + HEADER_SIZE
+        payload = self.view[payload_start:payload_start + length]
+        self.start += total
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+            # Volver al tamaño normal tras un frame excepcionalmente grande
+            if len(self.buffer) > self.buffer_size:
+                self.buffer = bytearray(self.buffer_size)
+                self.view = memoryview(self.buffer)
+
+        return frame_type, flags, payload
+
+    @property
+    def mid_frame(self):
+        """Hay bytes de un frame recibidos a medias"""
+        return self.end > self.start
+
+    def _fill(self, needed):
+        """
+        Asegurar que haya `needed` bytes disponibles desde self.start
+
+        Returns:
+            False si la conexión se cerró antes de completarlos
+        """
+        while self.end - self.start < needed:
+            if self.start + needed > len(self.buffer):
+                self._make_room(needed)
+
+            n = self.sock.recv_into(self.view[self.end:])
+            self.recv_calls += 1
+
+            if n == 0:
+                return False
+
+            self.end += n
+            self.bytes_received += n
+
+        return True
+
+    def _make_room(self, needed):
+        """Compactar (o agrandar) el buffer para alojar `needed` bytes"""
+        pending = self.end - self.start
+
+        if pending == len(self.buffer):
+            # Buffer lleno con un frame mayor: crecer al ritmo de los datos
+            # que llegan, no del tamaño que anuncia la cabecera
+            new_buffer = bytearray(min(needed, 2 * len(self.buffer)))
+            new_buffer[:pending] = self.buffer
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        elif self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending